@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+from __future__ import print_function, division
+import six
+
+# import modules
+import sys
+import os
+import time
+import inspect
+import argparse
+import tempfile
+import numpy as np
+import h5py
+
+# user modules
+# realpath() will make your script run, even if you symlink it
+cmd_folder = os.path.realpath(os.path.abspath(
+                              os.path.split(inspect.getfile(inspect.currentframe()))[0]))
+if cmd_folder not in sys.path:
+    sys.path.insert(0, cmd_folder)
+
+# This makes python look for modules in directory above this one
+mm3_dir = os.path.realpath(os.path.abspath(
+                                 os.path.join(os.path.split(inspect.getfile(
+                                 inspect.currentframe()))[0], '..')))
+if mm3_dir not in sys.path:
+    sys.path.insert(0, mm3_dir)
+
+import mm3_helpers as mm3
+
+# compression settings compared by the benchmark. The settings from the parameters
+# file are always tested as well.
+benchmark_settings = [{'codec' : 'gzip', 'level' : 4, 'time_chunk' : 1}, # mm3 default
+                      {'codec' : 'gzip', 'level' : 1, 'time_chunk' : 1},
+                      {'codec' : 'lzf', 'time_chunk' : 1},
+                      {'codec' : 'lzf', 'time_chunk' : 16},
+                      {'codec' : 'blosc-lz4', 'level' : 5, 'time_chunk' : 1},
+                      {'codec' : 'blosc-lz4', 'level' : 5, 'time_chunk' : 16},
+                      {'codec' : 'blosc-zstd', 'level' : 3, 'time_chunk' : 16},
+                      {'codec' : 'lz4', 'time_chunk' : 16},
+                      {'codec' : 'zstd', 'level' : 3, 'time_chunk' : 16},
+                      {'codec' : 'none', 'time_chunk' : 16}]
+
+def load_sample_stacks(fov_id, peak_ids, kind, seg_img):
+    '''Loads the stacks of one kind for the sample peaks. Returns a dict by peak id.'''
+
+    if kind == 'raw':
+        color = mm3.params['phase_plane']
+    elif kind == 'sub':
+        color = 'sub_' + mm3.params['phase_plane']
+    elif kind == 'seg':
+        color = seg_img
+
+    stacks = {}
+    for peak_id in peak_ids:
+        try:
+            stacks[peak_id] = mm3.load_stack(fov_id, peak_id, color=color)
+        except Exception:
+            mm3.warning('Could not load %s stack for FOV %d, peak %d.' % (color, fov_id, peak_id))
+
+    return stacks
+
+def benchmark_setting(stacks, kind, setting, work_dir):
+    '''Writes and reads the stacks with one compression setting.
+    Returns write MB/s, read MB/s and compression ratio.'''
+
+    # same defaults as init_mm3_helpers for anything not given
+    kind_settings = {'codec' : 'gzip', 'level' : 4, 'shuffle' : True,
+                     'fletcher32' : True, 'time_chunk' : 1}
+    kind_settings.update(setting)
+    mm3.params['hdf5_compression'][kind] = kind_settings
+
+    raw_bytes = sum(stack.nbytes for stack in stacks.values())
+    h5_filename = os.path.join(work_dir, 'benchmark.hdf5')
+
+    start_time = time.time()
+    with h5py.File(h5_filename, 'w', libver='earliest') as h5f:
+        for peak_id, stack in six.iteritems(stacks):
+            h5f.create_dataset(u'p%04d' % peak_id, data=stack,
+                               maxshape=(None, stack.shape[1], stack.shape[2]),
+                               **mm3.hdf5_stack_options(kind, stack.shape[1:3]))
+    write_time = time.time() - start_time
+    file_bytes = os.path.getsize(h5_filename)
+
+    start_time = time.time()
+    with h5py.File(h5_filename, 'r') as h5f:
+        for peak_id in stacks.keys():
+            h5f[u'p%04d' % peak_id][:]
+    read_time = time.time() - start_time
+
+    os.remove(h5_filename)
+
+    mb = raw_bytes / 1024**2
+    return mb / write_time, mb / read_time, raw_bytes / file_bytes
+
+# when using this script as a function and not as a library the following will execute
+if __name__ == "__main__":
+    '''mm3_benchmark_hdf5.py compares HDF5 compression settings on the stacks of one FOV.'''
+
+    parser = argparse.ArgumentParser(prog='python mm3_benchmark_hdf5.py',
+                                     description='Reports write and read speed and compression ratio of HDF5 compression settings.')
+    parser.add_argument('-f', '--paramfile',  type=str,
+                        required=True, help='Yaml file containing parameters.')
+    parser.add_argument('-o', '--fov',  type=int,
+                        required=False, help='FOV to use as the sample. Defaults to the first FOV in specs.')
+    parser.add_argument('-s', '--segmentsource', type=str, default='seg_otsu',
+                        required=False, help='Segmented stack to use for seg, "seg_otsu" or "seg_unet".')
+    parser.add_argument('-n', '--npeaks', type=int, default=5,
+                        required=False, help='Number of analyzed peaks from the FOV to use.')
+    namespace = parser.parse_args()
+
+    p = mm3.init_mm3_helpers(namespace.paramfile)
+    specs = mm3.load_specs()
+
+    if namespace.fov:
+        fov_id = namespace.fov
+    else:
+        fov_id = sorted(specs.keys())[0]
+    peak_ids = sorted([peak_id for peak_id, spec in six.iteritems(specs[fov_id]) if spec == 1])
+    peak_ids = peak_ids[:namespace.npeaks]
+    mm3.information('Benchmarking with FOV %d, peaks %s.' % (fov_id, peak_ids))
+
+    params_settings = {kind : dict(p['hdf5_compression'][kind]) for kind in ('raw', 'sub', 'seg')}
+
+    with tempfile.TemporaryDirectory(dir=p['ana_dir']) as work_dir:
+        for kind in ('raw', 'sub', 'seg'):
+            stacks = load_sample_stacks(fov_id, peak_ids, kind, namespace.segmentsource)
+            if not stacks:
+                continue
+            mm3.information('%s: %.1f MB in %d stacks.'
+                            % (kind, sum(stack.nbytes for stack in stacks.values()) / 1024**2, len(stacks)))
+
+            print('%-12s %6s %10s %12s %11s %8s' % ('codec', 'level', 'time_chunk', 'write MB/s', 'read MB/s', 'ratio'))
+            for setting in [params_settings[kind]] + benchmark_settings:
+                if mm3.hdf5plugin is None and setting['codec'] in ('blosc-lz4', 'blosc-lz4hc', 'blosc-zstd',
+                                                                   'blosc-blosclz', 'lz4', 'zstd'):
+                    print('%-12s skipped, hdf5plugin is not installed' % setting['codec'])
+                    continue
+
+                write_speed, read_speed, ratio = benchmark_setting(stacks, kind, setting, work_dir)
+                print('%-12s %6s %10d %12.1f %11.1f %8.2f' % (setting['codec'], setting.get('level', ''),
+                      setting.get('time_chunk', 1), write_speed, read_speed, ratio))
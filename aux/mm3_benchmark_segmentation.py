@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+from __future__ import print_function, division
+import six
+
+# import modules
+import sys
+import os
+import time
+import inspect
+import argparse
+import numpy as np
+
+# user modules
+# realpath() will make your script run, even if you symlink it
+cmd_folder = os.path.realpath(os.path.abspath(
+                              os.path.split(inspect.getfile(inspect.currentframe()))[0]))
+if cmd_folder not in sys.path:
+    sys.path.insert(0, cmd_folder)
+
+# This makes python look for modules in directory above this one
+mm3_dir = os.path.realpath(os.path.abspath(
+                                 os.path.join(os.path.split(inspect.getfile(
+                                 inspect.currentframe()))[0], '..')))
+if mm3_dir not in sys.path:
+    sys.path.insert(0, mm3_dir)
+
+import mm3_helpers as mm3
+
+# engines compared against the random walker
+test_engines = ['watershed', 'watershed_distance']
+
+def label_iou(ref_labels, test_labels):
+    '''Compares two labeled images. Returns the mean over the cells in ref_labels of the
+    IoU with the best matching cell in test_labels, the IoU of the foreground of both
+    images, and the number of cells in each.'''
+
+    n_ref = int(ref_labels.max())
+    n_test = int(test_labels.max())
+
+    foreground_union = np.count_nonzero((ref_labels > 0) | (test_labels > 0))
+    if foreground_union == 0:
+        foreground_iou = 1.0
+    else:
+        foreground_iou = np.count_nonzero((ref_labels > 0) & (test_labels > 0)) / foreground_union
+
+    if n_ref == 0:
+        return (1.0 if n_test == 0 else 0.0), foreground_iou, n_ref, n_test
+
+    # overlap of every pair of labels, background included as label 0
+    overlap = np.bincount(ref_labels.ravel().astype('int64') * (n_test + 1) + test_labels.ravel().astype('int64'),
+                          minlength=(n_ref + 1) * (n_test + 1)).reshape(n_ref + 1, n_test + 1)
+    ref_areas = overlap.sum(axis=1)
+    test_areas = overlap.sum(axis=0)
+    union = ref_areas[:, np.newaxis] + test_areas[np.newaxis, :] - overlap
+
+    iou = overlap[1:, 1:] / np.maximum(union[1:, 1:], 1)
+    present = ref_areas[1:] > 0 # labels can skip numbers
+    if n_test == 0 or not np.any(present):
+        return 0.0, foreground_iou, n_ref, n_test
+
+    return iou.max(axis=1)[present].mean(), foreground_iou, n_ref, n_test
+
+def segment_stack(sub_stack, engine):
+    '''Segments every image of a stack with one engine. Returns the labels and the time.'''
+
+    start_time = time.time()
+    seg_stack = np.stack([mm3.segment_image(image, engine=engine) for image in sub_stack], axis=0)
+    return seg_stack, time.time() - start_time
+
+# when using this script as a function and not as a library the following will execute
+if __name__ == "__main__":
+    '''mm3_benchmark_segmentation.py compares the Otsu segmentation engines on the subtracted stacks of one FOV.'''
+
+    parser = argparse.ArgumentParser(prog='python mm3_benchmark_segmentation.py',
+                                     description='Reports the speed of the Otsu segmentation engines and how their labels agree with the random walker.')
+    parser.add_argument('-f', '--paramfile',  type=str,
+                        required=True, help='Yaml file containing parameters.')
+    parser.add_argument('-o', '--fov',  type=int,
+                        required=False, help='FOV to use as the sample. Defaults to the first FOV in specs.')
+    parser.add_argument('-n', '--npeaks', type=int, default=5,
+                        required=False, help='Number of analyzed peaks from the FOV to use.')
+    parser.add_argument('-t', '--nframes', type=int, default=100,
+                        required=False, help='Number of frames of each peak to use.')
+    namespace = parser.parse_args()
+
+    p = mm3.init_mm3_helpers(namespace.paramfile)
+    specs = mm3.load_specs()
+
+    if namespace.fov:
+        fov_id = namespace.fov
+    else:
+        fov_id = sorted(specs.keys())[0]
+    peak_ids = sorted([peak_id for peak_id, spec in six.iteritems(specs[fov_id]) if spec == 1])
+    peak_ids = peak_ids[:namespace.npeaks]
+    mm3.information('Benchmarking with FOV %d, peaks %s.' % (fov_id, peak_ids))
+
+    times = {engine : 0.0 for engine in ['random_walker'] + test_engines}
+    agreement = {engine : [] for engine in test_engines}
+    n_frames = 0
+
+    for peak_id in peak_ids:
+        try:
+            sub_stack = mm3.load_stack(fov_id, peak_id, color='sub_{}'.format(p['phase_plane']))
+        except Exception:
+            mm3.warning('Could not load subtracted stack for FOV %d, peak %d.' % (fov_id, peak_id))
+            continue
+        sub_stack = np.asarray(sub_stack[:namespace.nframes])
+        n_frames += sub_stack.shape[0]
+
+        ref_stack, ref_time = segment_stack(sub_stack, 'random_walker')
+        times['random_walker'] += ref_time
+
+        for engine in test_engines:
+            test_stack, test_time = segment_stack(sub_stack, engine)
+            times[engine] += test_time
+            agreement[engine].extend(label_iou(ref_labels, test_labels)
+                                     for ref_labels, test_labels in zip(ref_stack, test_stack))
+
+    if n_frames == 0:
+        mm3.warning('No subtracted images to benchmark with.')
+        sys.exit(1)
+
+    print('%-20s %12s %8s %10s %14s %12s' % ('engine', 'frames/s', 'speedup', 'cell IoU', 'foreground IoU', 'cell count'))
+    print('%-20s %12.1f %8s %10s %14s %12s' % ('random_walker', n_frames / times['random_walker'], '1.0', '', '', ''))
+    for engine in test_engines:
+        results = np.array(agreement[engine], dtype='float64')
+        # fraction of frames where both engines find the same number of cells
+        same_count = np.mean(results[:,2] == results[:,3])
+        print('%-20s %12.1f %8.1f %10.3f %14.3f %11.0f%%' % (engine, n_frames / times[engine],
+              times['random_walker'] / times[engine], results[:,0].mean(), results[:,1].mean(), 100 * same_count))
@@ -1,5 +1,6 @@
 #!/usr/bin/python
 from __future__ import print_function
+import six
 
 # import modules
 import sys
@@ -12,6 +13,7 @@ import glob
 import math
 import copy
 import json
+import collections
 try:
     import cPickle as pickle
 except:
@@ -20,6 +22,8 @@ import numpy as np
 from skimage.external import tifffile as tiff
 import pims_nd2
 import warnings
+import multiprocessing
+from multiprocessing import Pool
 
 # user modules
 # realpath() will make your script run, even if you symlink it
@@ -38,6 +42,111 @@ if mm3_dir not in sys.path:
 # this is the mm3 module with all the useful functions and classes
 import mm3_helpers as mm3
 
+### functions for ingesting straight to the HDF5 layout
+def extract_fov(nd2_file, file_prefix, fov_id, extraction_range, vertical_crop, starttime, planes):
+    '''
+    Reads all time points of one FOV from an .nd2 file, which is opened in this process.
+    The images are spooled in the orientation used for slicing to an uncompressed .npy
+    file in the HDF5 directory, and the channels are found on the phase plane.
+
+    Returns
+    -------
+    fov : int
+        The output FOV id (1 indexed).
+    fov_imgs : collections.OrderedDict
+        Metadata for each time point in the form made by mm3.get_tif_params. Keys are
+        the names the TIFFs would have been saved as.
+    spool_filename : str
+        Path of the spooled images, with axes (t, y, x, plane).
+    '''
+
+    fov = fov_id + 1
+    mm3.information('Extracting FOV %d from %s.' % (fov, file_prefix))
+
+    spool_filename = os.path.join(mm3.params['hdf5_dir'], '%s_xy%03d_spool.npy' % (file_prefix, fov))
+    spool = None
+    fov_imgs = collections.OrderedDict()
+
+    with pims_nd2.ND2_Reader(nd2_file) as nd2f:
+        if len(planes) > 1:
+            nd2f.bundle_axes = [u'c', u'y', u'x']
+        nd2f.default_coords[u'm'] = fov_id
+
+        for t_index, t in enumerate(extraction_range):
+            t_id = t - 1
+            nd2_frame = nd2f[t_id]
+
+            # get time picture was taken
+            seconds = copy.deepcopy(nd2_frame.metadata['t_ms']) / 1000.
+            acq_time = starttime + seconds / 60. / 60. / 24.
+
+            image_data = np.asarray(nd2_frame)
+            if vertical_crop:
+                if len(image_data.shape) < 3:
+                    image_data = np.expand_dims(image_data, axis=0)
+                nc, H, W = image_data.shape
+                image_data = image_data[:, int(vertical_crop[0]*H):int(vertical_crop[1]*H), :]
+
+            image_data = mm3.prepare_image_for_slicing(image_data)
+
+            if spool is None:
+                spool = np.lib.format.open_memmap(spool_filename, mode='w+', dtype=image_data.dtype,
+                                                  shape=(len(extraction_range),) + image_data.shape)
+            spool[t_index] = image_data
+
+            tif_filename = file_prefix + "_t%04dxy%02d.tif" % (t, fov)
+            fov_imgs[tif_filename] = {'filepath' : nd2_file,
+                                      'fov' : fov,
+                                      't' : t,
+                                      'jd' : acq_time,
+                                      'x' : nd2_frame.metadata['x_um'],
+                                      'y' : nd2_frame.metadata['y_um'],
+                                      'planes' : planes,
+                                      'shape' : list(image_data.shape[:2])}
+
+    # find channels on the phase plane, like mm3_Compile.py does on the TIFFs
+    ph_index = int(mm3.params['phase_plane'][1:]) - 1 if spool.shape[3] > 1 else 0
+    channels, drifts = mm3.find_channels_in_frames(spool[:,:,:,ph_index],
+                                                   mm3.params['compile']['channel_sample_frames'])
+    for idata, chnl_loc_dict, drift in zip(fov_imgs.values(), channels, drifts):
+        idata['channels'] = chnl_loc_dict
+        if drift is not None:
+            idata['drift'] = drift
+
+    spool.flush()
+    del spool
+
+    return fov, fov_imgs, spool_filename
+
+def spooled_image_blocks(spools, block_size):
+    '''Yields (block_names, image_block) from spooled FOV images, for the slicing writers.'''
+    for spool_filename, filenames in spools:
+        spool = np.load(spool_filename, mmap_mode='r')
+        for block_start in range(0, len(filenames), block_size):
+            yield (filenames[block_start:block_start+block_size],
+                   np.array(spool[block_start:block_start+block_size]))
+        del spool
+
+def slice_spooled_fov(fov, spools, channel_masks, fov_imgs, block_size):
+    '''Slices the spooled images of one FOV into the channel stacks of the HDF5 (or zarr)
+    layout used by load_stack, then removes the spools. Returns the FOV id.'''
+
+    images_to_write = [[fn, fov_imgs[fn]['t']] for spool_filename, filenames in spools
+                                              for fn in filenames]
+    image_blocks = spooled_image_blocks(spools, block_size)
+
+    if mm3.params['output'] == 'HDF5':
+        mm3.hdf5_stack_slice_and_write_blocks(images_to_write, channel_masks, fov_imgs,
+                                              block_size, image_blocks=image_blocks)
+    elif mm3.params['output'] == 'zarr':
+        mm3.zarr_stack_slice_and_write_blocks(images_to_write, channel_masks, fov_imgs,
+                                              block_size, image_blocks=image_blocks)
+
+    for spool_filename, filenames in spools:
+        os.remove(spool_filename)
+
+    return fov
+
 ### Main script
 if __name__ == "__main__":
     '''
@@ -51,6 +160,10 @@ if __name__ == "__main__":
                         required=True, help='Yaml file containing parameters.')
     parser.add_argument('-o', '--fov',  type=str,
                         required=False, help='List of fields of view to analyze. Input "1", "1,2,3", or "1-3", etc.')
+    parser.add_argument('--hdf5', action='store_true',
+                        required=False, help='Skip the TIFFs and write sliced channel stacks straight to the HDF5 (or zarr) output, like mm3_Compile.py would.')
+    parser.add_argument('-j', '--nproc', type=int,
+                        required=False, help='Number of processes to extract FOVs with in --hdf5 mode.')
     namespace = parser.parse_args()
 
     # Load the project parameters file
@@ -90,8 +203,28 @@ if __name__ == "__main__":
     # number between 0 and 9, 0 is no compression, 9 is most compression.
     tif_compress = p['nd2ToTIFF']['tiff_compress']
 
+    if namespace.hdf5:
+        if p['output'] not in ('HDF5', 'zarr'):
+            mm3.warning("--hdf5 needs output: 'HDF5' or 'zarr' in the parameters file.")
+            sys.exit(1)
+        if number_of_rows != 1:
+            mm3.warning('--hdf5 only supports one row of channels.')
+            sys.exit(1)
+
+        if namespace.nproc:
+            p['num_analyzers'] = namespace.nproc
+
+        # set up analysis folders
+        if not os.path.exists(p['hdf5_dir']):
+            os.makedirs(p['hdf5_dir'])
+        if p['output'] == 'zarr' and not os.path.exists(p['zarr_dir']):
+            os.makedirs(p['zarr_dir'])
+
+        analyzed_imgs = {} # metadata for every image, as made by mm3_Compile.py
+        fov_spools = {} # fov : list of (spool file, image names)
+
     # set up image and analysis folders if they do not already exist
-    if not os.path.exists(p['TIFF_dir']):
+    elif not os.path.exists(p['TIFF_dir']):
         os.makedirs(p['TIFF_dir'])
 
     # Load ND2 files into a list for processing
@@ -142,6 +275,30 @@ if __name__ == "__main__":
             extraction_range = range(p['nd2ToTIFF']['image_start'],
                                      p['nd2ToTIFF']['image_end']+1)
 
+            if namespace.hdf5:
+                # read each FOV once in its own process, which opens the nd2 file itself
+                fov_ids = [fov_id for fov_id in range(0, nd2f.sizes[u'm'])
+                           if len(user_spec_fovs) == 0 or fov_id + 1 in user_spec_fovs]
+
+                pool = Pool(p['num_analyzers'])
+                results = [pool.apply_async(extract_fov, args=(nd2_file, file_prefix, fov_id,
+                                                               list(extraction_range), vertical_crop,
+                                                               starttime, planes))
+                           for fov_id in fov_ids]
+                pool.close()
+                pool.join()
+
+                for result in results:
+                    if not result.successful():
+                        mm3.warning('Extracting a FOV from %s failed.' % file_prefix)
+                        continue
+                    fov, fov_imgs, spool_filename = result.get()
+                    analyzed_imgs.update(fov_imgs)
+                    fov_spools.setdefault(fov, []).append((spool_filename, list(fov_imgs.keys())))
+
+                # nothing more to do with this file
+                continue
+
             # loop through time points
             for t in extraction_range:
                 # timepoint output name (1 indexed rather than 0 indexed)
@@ -225,3 +382,37 @@ if __name__ == "__main__":
 
                     # increase FOV counter
                     fov += 1
+
+    if namespace.hdf5:
+        # save the metadata where mm3_Compile.py looks for it when do_metadata is False
+        with open(os.path.join(p['ana_dir'], 'TIFF_metadata.pkl'), 'wb') as tiff_metadata:
+            pickle.dump(analyzed_imgs, tiff_metadata, protocol=pickle.HIGHEST_PROTOCOL)
+        # mm3_Compile.py prefers the metadata index over the pickle. No TIFFs are written
+        #    in this mode so the index can't hold these images, so an old one is removed
+        metadata_db = os.path.join(p['ana_dir'], 'TIFF_metadata.db')
+        if os.path.exists(metadata_db):
+            mm3.information('Removing old metadata index %s.' % metadata_db)
+            os.remove(metadata_db)
+
+        time_table = mm3.make_time_table(analyzed_imgs)
+        channel_masks = mm3.make_masks(analyzed_imgs)
+
+        # slice the spooled FOVs in parallel, each FOV is its own file
+        block_size = p['compile']['slicing_block_size'] or 100
+        pool = Pool(p['num_analyzers'])
+        results = []
+        for fov, spools in sorted(six.iteritems(fov_spools)):
+            if not channel_masks.get(fov):
+                mm3.warning('No channels found for FOV %d, not slicing it.' % fov)
+                continue
+            fov_imgs = {fn : analyzed_imgs[fn] for spool_filename, filenames in spools for fn in filenames}
+            results.append(pool.apply_async(slice_spooled_fov,
+                                            args=(fov, spools, channel_masks, fov_imgs, block_size)))
+        pool.close()
+        pool.join()
+
+        for result in results:
+            if result.successful():
+                mm3.information('Saved channel stacks for FOV %d.' % result.get())
+            else:
+                mm3.warning('Slicing a FOV failed.')
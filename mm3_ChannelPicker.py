@@ -86,8 +86,8 @@ def fov_plot_channels(fov_id, crosscorrs, specs, outputdir='.', phase_plane='c1'
         if crosscorrs:
             peak_xc = crosscorrs[fov_id][peak_id] # get cross corr data from dict
 
-        # load data for figure
-        image_data = mm3.load_stack(fov_id, peak_id, color=phase_plane)
+        # load just the first and last images for the figure
+        image_data = mm3.load_stack(fov_id, peak_id, color=phase_plane, frames=[0, -1])
 
         first_img = rescale_intensity(image_data[0,:,:]) # phase image at t=0
         last_img = rescale_intensity(image_data[-1,:,:]) # phase image at end
@@ -186,8 +186,8 @@ def fov_CNN_plot_channels(fov_id, predictionDict, specs, outputdir='.', phase_pl
         if predictionDict:
             predictions = predictionDict[fov_id][peak_id] # get predictions array
 
-        # load data for figure
-        image_data = mm3.load_stack(fov_id, peak_id, color=phase_plane)
+        # load just the first and last images for the figure
+        image_data = mm3.load_stack(fov_id, peak_id, color=phase_plane, frames=[0, -1])
 
         first_img = rescale_intensity(image_data[0,:,:]) # phase image at t=0
         last_img = rescale_intensity(image_data[-1,:,:]) # phase image at end
@@ -285,8 +285,8 @@ def fov_cell_segger_plot_channels(fov_id, predictionDict, specs, outputdir='.',
         if predictionDict:
             predictions = predictionDict[fov_id][peak_id] # get predictions array
 
-        # load data for figure
-        image_data = mm3.load_stack(fov_id, peak_id, color=phase_plane)
+        # load just the first and last images for the figure
+        image_data = mm3.load_stack(fov_id, peak_id, color=phase_plane, frames=[0, -1])
 
         first_img = rescale_intensity(image_data[0,:,:]) # phase image at t=0
         last_img = rescale_intensity(image_data[-1,:,:]) # phase image at end
@@ -799,14 +799,16 @@ def preload_images(specs, fov_id_list):
         mm3.information("Preloading images for FOV {}.".format(fov_id))
         UI_images[fov_id] = {}
         for peak_id in specs[fov_id].keys():
-            image_data = mm3.load_stack(fov_id, peak_id, color=p['phase_plane'])
-            UI_images[fov_id][peak_id] = {'first' : None, 'last' : None} # init dictionary
-             # phase image at t=0. Rescale intenstiy and also cut the size in half
+            # only load the two images which are shown
             first_image = p['channel_picker']['first_image']
-            UI_images[fov_id][peak_id]['first'] = image_data[first_image,::2,::2]
             last_image = p['channel_picker']['last_image']
+            image_data = mm3.load_stack(fov_id, peak_id, color=p['phase_plane'],
+                                        frames=[first_image, last_image])
+            UI_images[fov_id][peak_id] = {'first' : None, 'last' : None} # init dictionary
+             # phase image at t=0. Rescale intenstiy and also cut the size in half
+            UI_images[fov_id][peak_id]['first'] = image_data[0,::2,::2]
             # phase image at end
-            UI_images[fov_id][peak_id]['last'] = image_data[last_image,::2,::2]
+            UI_images[fov_id][peak_id]['last'] = image_data[1,::2,::2]
 
     return UI_images
 
@@ -998,10 +1000,8 @@ if __name__ == "__main__":
             counter = 0
             peak_number = len(channel_masks[fov_id])
             for i,peak_id in enumerate(sorted(channel_masks[fov_id].keys())):
-                # get list of tiff file names
-                tiff_file_name = glob.glob(os.path.join(chnl_dir, "*xy{:0=3}_p{:0=4}_c1.tif".format(fov_id, peak_id)))[0]
-
-                img_array = io.imread(tiff_file_name)
+                # load the channel stack, from TIFF, HDF5 or memory mapped .npy files
+                img_array = mm3.load_stack(fov_id, peak_id, color='c1')
                 img_height = img_array.shape[1]
                 img_width = img_array.shape[2]
                 slice_increment = int(img_array.shape[0]/5)
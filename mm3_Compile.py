@@ -62,6 +62,8 @@ if __name__ == "__main__":
                         required=False, help='Number of processors to use.')
     parser.add_argument('-m', '--modelfile', type=str,
                         required=False, help='Path to trained U-net model.')
+    parser.add_argument('--follow', action='store_true',
+                        required=False, help='After compiling, keep slicing new images as they are acquired.')
     namespace = parser.parse_args()
 
     # Load the project parameters file
@@ -111,58 +113,76 @@ if __name__ == "__main__":
     elif p['output'] == 'HDF5':
         if not os.path.exists(p['hdf5_dir']):
             os.makedirs(p['hdf5_dir'])
+    elif p['output'] == 'zarr':
+        if not os.path.exists(p['zarr_dir']):
+            os.makedirs(p['zarr_dir'])
 
     # declare information variables
     analyzed_imgs = {} # for storing get_params pool results.
 
+    # get all the TIFFs in the folder
+    found_files = glob.glob(os.path.join(p['TIFF_dir'],'*.tif')) # get all tiffs
+    found_files = [filepath.split('/')[-1] for filepath in found_files] # remove pre-path
+    found_files = sorted(found_files) # should sort by timepoint
+
+    # keep images starting at this timepoint
+    if t_start is not None:
+        mm3.information('Removing images before time {}'.format(t_start))
+        # go through list and find first place where timepoint is equivalent to t_start
+        for n, ifile in enumerate(found_files):
+            string = re.compile('t{:0=3}xy|t{:0=4}xy'.format(t_start,t_start)) # account for 3 and 4 digit
+            # if re.search == True then a match was found
+            if re.search(string, ifile):
+                # cut off every file name prior to this one and quit the loop
+                found_files = found_files[n:]
+                break
+
+    # remove images after this timepoint
+    if t_end is not None:
+        mm3.information('Removing images after time {}'.format(t_end))
+        # go through list and find first place where timepoint is equivalent to t_end
+        for n, ifile in enumerate(found_files):
+            string = re.compile('t%03dxy|t%04dxy' % (t_end, t_end)) # account for 3 and 4 digit
+            if re.search(string, ifile):
+                found_files = found_files[:n]
+                break
+
+
+    # if user has specified only certain FOVs, filter for those
+    if (len(user_spec_fovs) > 0):
+        mm3.information('Filtering TIFFs by FOV.')
+        fitered_files = []
+        for fov_id in user_spec_fovs:
+            fov_string = 'xy%02d' % fov_id # xy01
+            fitered_files += [ifile for ifile in found_files if fov_string in ifile]
+
+        found_files = fitered_files[:]
+
+    # persistent index of image metadata, so only new or changed images are analyzed. It is
+    #    not made when only loading metadata, so a pickle from older versions or from
+    #    mm3_nd2ToTIFF.py --hdf5 is used when there is no index
+    metadata_db = os.path.join(p['ana_dir'], 'TIFF_metadata.db')
+    if p['compile']['do_metadata'] or os.path.exists(metadata_db):
+        metadata_index = mm3.TiffMetadataIndex(metadata_db)
+    else:
+        metadata_index = None
+
     ### process TIFFs for metadata #################################################################
     if not p['compile']['do_metadata']:
         mm3.information("Loading image parameters dictionary.")
 
-        with open(os.path.join(p['ana_dir'], 'TIFF_metadata.pkl'), 'rb') as tiff_metadata:
-            analyzed_imgs = pickle.load(tiff_metadata)
+        if metadata_index is not None:
+            # only images which are still in the TIFF folder, the index keeps every image
+            #    it has seen
+            analyzed_imgs = metadata_index.to_dict(found_files)
+        else:
+            # fall back to the pickle written by older versions
+            with open(os.path.join(p['ana_dir'], 'TIFF_metadata.pkl'), 'rb') as tiff_metadata:
+                analyzed_imgs = pickle.load(tiff_metadata)
 
     else:
         mm3.information("Finding image parameters.")
 
-        # get all the TIFFs in the folder
-        found_files = glob.glob(os.path.join(p['TIFF_dir'],'*.tif')) # get all tiffs
-        found_files = [filepath.split('/')[-1] for filepath in found_files] # remove pre-path
-        found_files = sorted(found_files) # should sort by timepoint
-
-        # keep images starting at this timepoint
-        if t_start is not None:
-            mm3.information('Removing images before time {}'.format(t_start))
-            # go through list and find first place where timepoint is equivalent to t_start
-            for n, ifile in enumerate(found_files):
-                string = re.compile('t{:0=3}xy|t{:0=4}xy'.format(t_start,t_start)) # account for 3 and 4 digit
-                # if re.search == True then a match was found
-                if re.search(string, ifile):
-                    # cut off every file name prior to this one and quit the loop
-                    found_files = found_files[n:]
-                    break
-
-        # remove images after this timepoint
-        if t_end is not None:
-            mm3.information('Removing images after time {}'.format(t_end))
-            # go through list and find first place where timepoint is equivalent to t_end
-            for n, ifile in enumerate(found_files):
-                string = re.compile('t%03dxy|t%04dxy' % (t_end, t_end)) # account for 3 and 4 digit
-                if re.search(string, ifile):
-                    found_files = found_files[:n]
-                    break
-
-
-        # if user has specified only certain FOVs, filter for those
-        if (len(user_spec_fovs) > 0):
-            mm3.information('Filtering TIFFs by FOV.')
-            fitered_files = []
-            for fov_id in user_spec_fovs:
-                fov_string = 'xy%02d' % fov_id # xy01
-                fitered_files += [ifile for ifile in found_files if fov_string in ifile]
-
-            found_files = fitered_files[:]
-
         # get information for all these starting tiffs
         if len(found_files) > 0:
             mm3.information("Found %d image files." % len(found_files))
@@ -171,11 +191,20 @@ if __name__ == "__main__":
 
         if p['compile']['find_channels_method'] == 'peaks':
 
+            # with channel sampling, only metadata is read here and channels are found
+            # below on a few images per FOV
+            sample_channels = bool(p['compile']['channel_sample_frames'])
+
+            # only analyze images which are not already in the metadata index
+            stale_files = metadata_index.stale_files(found_files, channels=True)
+            mm3.information("Using indexed metadata for %d images, analyzing %d images."
+                            % (len(found_files) - len(stale_files), len(stale_files)))
+
             # initialize pool for analyzing image metadata
             pool = Pool(p['num_analyzers'])
 
             # loop over images and get information
-            for fn in found_files:
+            for fn in stale_files:
                 # get_params gets the image metadata and puts it in analyzed_imgs dictionary
                 # for each file name. True means look for channels
 
@@ -183,7 +212,7 @@ if __name__ == "__main__":
                 # analyzed_imgs[fn] = mm3.get_tif_params(fn, True)
 
                 # Parallelized
-                analyzed_imgs[fn] = pool.apply_async(mm3.get_tif_params, args=(fn, True))
+                analyzed_imgs[fn] = pool.apply_async(mm3.get_tif_params, args=(fn, not sample_channels))
 
             mm3.information('Waiting for image analysis pool to be finished.')
 
@@ -200,6 +229,23 @@ if __name__ == "__main__":
                 else:
                     analyzed_imgs[fn] = False # put a false there if it's bad
 
+            # add the new results to the index and get back metadata for all found images
+            metadata_index.add(analyzed_imgs)
+            analyzed_imgs = metadata_index.to_dict(found_files)
+
+            if sample_channels:
+                # FOVs with new images have their channels and drift found again
+                new_fovs = set(idata['fov'] for idata in analyzed_imgs.values()
+                               if idata and idata.get('analyze_success', True) != False
+                               and 'channels' not in idata)
+                fov_imgs = {fn : idata for fn, idata in six.iteritems(analyzed_imgs)
+                            if idata and idata.get('analyze_success', True) != False
+                            and idata['fov'] in new_fovs}
+
+                mm3.find_channels_sampled(fov_imgs)
+                metadata_index.add(fov_imgs)
+                analyzed_imgs.update(fov_imgs)
+
         elif p['compile']['find_channels_method'] == 'Unet':
             # Use Unet trained on trap and central channel locations to locate, crop, and align traps
             mm3.information("Identifying channel locations and aligning images using U-net.")
@@ -217,11 +263,16 @@ if __name__ == "__main__":
                                                       'cce_tversky_loss': mm3.cce_tversky_loss})
             mm3.information("Model loaded.")
 
+            # only read metadata for images which are not already in the metadata index
+            stale_files = metadata_index.stale_files(found_files)
+            mm3.information("Using indexed metadata for %d images, analyzing %d images."
+                            % (len(found_files) - len(stale_files), len(stale_files)))
+
             # initialize pool for getting image metadata
             pool = Pool(p['num_analyzers'])
 
             # loop over images and get information
-            for fn in found_files:
+            for fn in stale_files:
                 # get_params gets the image metadata and puts it in analyzed_imgs dictionary
                 # for each file name. Won't look for channels, just gets the metadata for later use by Unet
 
@@ -245,6 +296,9 @@ if __name__ == "__main__":
                else:
                    analyzed_imgs[fn] = False # put a false there if it's bad
 
+            metadata_index.add(analyzed_imgs)
+            analyzed_imgs = metadata_index.to_dict(found_files)
+
             # print(analyzed_imgs)
 
             # set up some variables for Unet and image aligment/cropping
@@ -268,7 +322,7 @@ if __name__ == "__main__":
                 fov_file_names = [file_names[idx] for idx in fov_indices]
                 trap_align_metadata = {'first_frame_name': fov_file_names[0],
                                     'frame_count': len(fov_file_names),
-                                    'plane_number': len(analyzed_imgs[fn]['planes']),
+                                    'plane_number': len(analyzed_imgs[fov_file_names[0]]['planes']),
                                     'trap_height': p['compile']['trap_crop_height'],
                                     'trap_width': p['compile']['trap_crop_width'],
                                     'phase_plane': p['phase_plane'],
@@ -386,16 +440,16 @@ if __name__ == "__main__":
                 if p['debug']:
                     print(centroid)
 
-                # get the (frame_number,512,512,1)-sized stack for image aligment
-                align_region_stack = np.zeros((trap_align_metadata['frame_count'],512,512,1), dtype='uint16')
+                good_trap_bboxes_dict = {}
+                for trap in good_trap_props:
+                    good_trap_bboxes_dict[trap.label] = trap.bbox
 
-                for frame,fn in enumerate(fov_file_names):
-                    imgPath = os.path.join(p['experiment_directory'],p['image_directory'],fn)
-                    frame_img = io.imread(imgPath)
-                    # detect if there are multiple imaging channels, and rearrange image if necessary, keeping only the phase image
-                    frame_img = mm3.permute_image(frame_img, trap_align_metadata)
-                    align_region_stack[frame,:,:,0] = frame_img[centroid[0]-256:centroid[0]+256,
-                                                             centroid[1]-256:centroid[1]+256]
+                # get the (frame_number,512,512,1)-sized stack for image aligment. Each frame is read once,
+                #    and the regions around the traps are kept so they can be cropped once the shifts are known
+                mm3.information("Reading frames for trap alignment and cropping.")
+                align_region_stack, trap_regions = mm3.read_trap_alignment_frames(fov_file_names, centroid,
+                                                                                  good_trap_bboxes_dict,
+                                                                                  trap_align_metadata)
 
                 # if p['debug']:
                 #     colNum = 10
@@ -407,143 +461,150 @@ if __name__ == "__main__":
                 #     plt.title('Alignment stack images');
                 #     plt.show();
 
-                # run model on all frames
-                batch_size=p['compile']['channel_prediction_batch_size']
-                mm3.information("Predicting trap regions for (512,512) slice through all frames.")
-
-                data_gen_args = {'batch_size':batch_size,
-                         'n_channels':1,
-                         'normalize_to_one':True,
-                         'shuffle':False}
-                predict_gen_args = {'verbose':1,
-                        'use_multiprocessing':True,
-                        'workers':p['num_analyzers']}
-
-                img_generator = mm3.TrapSegmentationDataGenerator(align_region_stack, **data_gen_args)
-
-                align_region_predictions = model.predict_generator(img_generator, **predict_gen_args)
-                #align_region_stack = mm3.apply_median_filter_and_normalize(align_region_stack)
-                #align_region_predictions = model.predict(align_region_stack, batch_size=batch_size)
-                # reduce dimensionality such that the class predictions are now (frame_number,512,512), and each voxel is labelled as the predicted region, i.e., 0=trap, 1=central trough, 2=background.
-                align_region_class_predictions = np.argmax(align_region_predictions, axis=3)
-
-                # if p['debug']:
-                #     colNum = 10
-                #     fig,ax = plt.subplots(ncols=colNum, figsize=(20,20))
-
-                #     for pltIdx in range(colNum):
-                #         ax[pltIdx].imshow(align_region_class_predictions[pltIdx*10,:,:])
-
-                #     plt.title('Alignment stack predictions');
-                #     plt.show();
-
-                # get boolean array where trap predictions are True
-                align_traps = align_region_class_predictions == 0
-
-                # if p['debug']:
-                #     colNum = 10
-                #     fig,ax = plt.subplots(ncols=colNum, figsize=(20,20))
-
-                #     for pltIdx in range(colNum):
-                #         ax[pltIdx].imshow(align_traps[pltIdx*10,:,:])
-
-                #     plt.title('Alignment trap masks');
-                #     plt.show();
-
-                # allocate array to store filtered traps over time
-                align_trap_mask_stack = np.zeros(align_traps.shape)
-                for frame in range(trap_align_metadata['frame_count']):
-
-                    frame_trap_labels = measure.label(align_traps[frame,:,:])
-                    frame_trap_props = measure.regionprops(frame_trap_labels)
-
-                    trap_bboxes = mm3.get_frame_trap_bounding_boxes(frame_trap_labels,
-                                                                    frame_trap_props,
-                                                                    trapAreaThreshold=trap_area_threshold,
-                                                                    trapWidth=trap_align_metadata['trap_width'],
-                                                                    trapHeight=trap_align_metadata['trap_height'])
-
-                    for i,bbox in enumerate(trap_bboxes):
-                        align_trap_mask_stack[frame,bbox[0]:bbox[2],bbox[1]:bbox[3]] = True
+                if p['compile']['trap_alignment_method'] == 'phase_correlation':
+                    # register the phase alignment region of all frames to the first frame
+                    mm3.information("Registering (512,512) slice through all frames.")
+                    shifts = mm3.phase_correlation_shifts(align_region_stack[...,0],
+                                                          max_shift=p['compile']['channel_drift_max_shift'])
 
-                # if p['debug']:
-                #     colNum = 10
-                #     fig,ax = plt.subplots(ncols=colNum, figsize=(20,20))
-
-                #     for pltIdx in range(colNum):
-                #         ax[pltIdx].imshow(align_trap_mask_stack[pltIdx*10,:,:])
-
-                #     plt.title('Filtered alignment trap masks');
-                #     plt.show();
-
-                labelled_align_trap_mask_stack = measure.label(align_trap_mask_stack)
-
-                trapTriggered = False
-                for frame in range(trap_align_metadata['frame_count']):
-                    anyTraps = np.any(labelled_align_trap_mask_stack[frame,:,:] > 0)
-                    # if anyTraps is False, that means no traps were detected for this frame. This usuall occurs due to a bug in our imaging system,
-                    #    which can cause it to miss the occasional frame. Should be fine to snag labels from prior frame.
-                    if not anyTraps:
-                        trapTriggered = True
-                        mm3.information("Frame at index {} has no detected traps. Borrowing labels from an adjacent frame.".format(frame))
-                        if frame > 0:
-                            labelled_align_trap_mask_stack[frame,:,:] = labelled_align_trap_mask_stack[frame-1,:,:]
+                else:
+                    # run model on all frames
+                    batch_size=p['compile']['channel_prediction_batch_size']
+                    mm3.information("Predicting trap regions for (512,512) slice through all frames.")
+
+                    data_gen_args = {'batch_size':batch_size,
+                             'n_channels':1,
+                             'normalize_to_one':True,
+                             'shuffle':False}
+                    predict_gen_args = {'verbose':1,
+                            'use_multiprocessing':True,
+                            'workers':p['num_analyzers']}
+
+                    img_generator = mm3.TrapSegmentationDataGenerator(align_region_stack, **data_gen_args)
+
+                    align_region_predictions = model.predict_generator(img_generator, **predict_gen_args)
+                    #align_region_stack = mm3.apply_median_filter_and_normalize(align_region_stack)
+                    #align_region_predictions = model.predict(align_region_stack, batch_size=batch_size)
+                    # reduce dimensionality such that the class predictions are now (frame_number,512,512), and each voxel is labelled as the predicted region, i.e., 0=trap, 1=central trough, 2=background.
+                    align_region_class_predictions = np.argmax(align_region_predictions, axis=3)
+
+                    # if p['debug']:
+                    #     colNum = 10
+                    #     fig,ax = plt.subplots(ncols=colNum, figsize=(20,20))
+
+                    #     for pltIdx in range(colNum):
+                    #         ax[pltIdx].imshow(align_region_class_predictions[pltIdx*10,:,:])
+
+                    #     plt.title('Alignment stack predictions');
+                    #     plt.show();
+
+                    # get boolean array where trap predictions are True
+                    align_traps = align_region_class_predictions == 0
+
+                    # if p['debug']:
+                    #     colNum = 10
+                    #     fig,ax = plt.subplots(ncols=colNum, figsize=(20,20))
+
+                    #     for pltIdx in range(colNum):
+                    #         ax[pltIdx].imshow(align_traps[pltIdx*10,:,:])
+
+                    #     plt.title('Alignment trap masks');
+                    #     plt.show();
+
+                    # allocate array to store filtered traps over time
+                    align_trap_mask_stack = np.zeros(align_traps.shape)
+                    for frame in range(trap_align_metadata['frame_count']):
+
+                        frame_trap_labels = measure.label(align_traps[frame,:,:])
+                        frame_trap_props = measure.regionprops(frame_trap_labels)
+
+                        trap_bboxes = mm3.get_frame_trap_bounding_boxes(frame_trap_labels,
+                                                                        frame_trap_props,
+                                                                        trapAreaThreshold=trap_area_threshold,
+                                                                        trapWidth=trap_align_metadata['trap_width'],
+                                                                        trapHeight=trap_align_metadata['trap_height'])
+
+                        for i,bbox in enumerate(trap_bboxes):
+                            align_trap_mask_stack[frame,bbox[0]:bbox[2],bbox[1]:bbox[3]] = True
+
+                    # if p['debug']:
+                    #     colNum = 10
+                    #     fig,ax = plt.subplots(ncols=colNum, figsize=(20,20))
+
+                    #     for pltIdx in range(colNum):
+                    #         ax[pltIdx].imshow(align_trap_mask_stack[pltIdx*10,:,:])
+
+                    #     plt.title('Filtered alignment trap masks');
+                    #     plt.show();
+
+                    labelled_align_trap_mask_stack = measure.label(align_trap_mask_stack)
+
+                    trapTriggered = False
+                    for frame in range(trap_align_metadata['frame_count']):
+                        anyTraps = np.any(labelled_align_trap_mask_stack[frame,:,:] > 0)
+                        # if anyTraps is False, that means no traps were detected for this frame. This usuall occurs due to a bug in our imaging system,
+                        #    which can cause it to miss the occasional frame. Should be fine to snag labels from prior frame.
+                        if not anyTraps:
+                            trapTriggered = True
+                            mm3.information("Frame at index {} has no detected traps. Borrowing labels from an adjacent frame.".format(frame))
+                            if frame > 0:
+                                labelled_align_trap_mask_stack[frame,:,:] = labelled_align_trap_mask_stack[frame-1,:,:]
+                            else:
+                                labelled_align_trap_mask_stack[frame,:,:] = labelled_align_trap_mask_stack[frame+1,:,:]
+
+                    if trapTriggered:
+                        repaired_align_trap_mask_stack = labelled_align_trap_mask_stack > 0
+                        labelled_align_trap_mask_stack = measure.label(repaired_align_trap_mask_stack)
+
+                    align_trap_props = measure.regionprops(labelled_align_trap_mask_stack)
+
+                    areas = np.array([trap.area for trap in align_trap_props])
+                    labels = [trap.label for trap in align_trap_props]
+                    good_align_trap_props = []
+                    bad_align_trap_props = []
+                    #mode_area = stats.mode(areas)[0]
+                    expected_area = trap_align_metadata['trap_width'] * trap_align_metadata['trap_height'] * trap_align_metadata['frame_count']
+
+                    if p['debug']:
+                        pprint(areas)
+                        print(expected_area)
+
+                        if not expected_area in areas:
+                            print("No trap has expected total area. Saving labelled masks for debugging as labelled_align_trap_mask_stack.tif")
+                            io.imsave("labelled_align_trap_mask_stack.tif", labelled_align_trap_mask_stack.astype('uint8'))
+                            io.imsave("masks.tif", align_traps.astype('uint8'))
+                            # occasionally our microscope misses an image, resulting in no traps for a single frame. This obviously messes up image alignment here....
+
+                    for trap in align_trap_props:
+                        if trap.area != expected_area:
+                            bad_align_trap_props.append(trap.label)
                         else:
-                            labelled_align_trap_mask_stack[frame,:,:] = labelled_align_trap_mask_stack[frame+1,:,:]
-
-                if trapTriggered:
-                    repaired_align_trap_mask_stack = labelled_align_trap_mask_stack > 0
-                    labelled_align_trap_mask_stack = measure.label(repaired_align_trap_mask_stack)
+                            good_align_trap_props.append(trap)
 
-                align_trap_props = measure.regionprops(labelled_align_trap_mask_stack)
+                    for label in bad_align_trap_props:
+                        labelled_align_trap_mask_stack[labelled_align_trap_mask_stack == label] = 0
 
-                areas = np.array([trap.area for trap in align_trap_props])
-                labels = [trap.label for trap in align_trap_props]
-                good_align_trap_props = []
-                bad_align_trap_props = []
-                #mode_area = stats.mode(areas)[0]
-                expected_area = trap_align_metadata['trap_width'] * trap_align_metadata['trap_height'] * trap_align_metadata['frame_count']
+                    align_centroids = []
+                    for frame in range(trap_align_metadata['frame_count']):
+                        align_centroids.append([reg.centroid for reg in measure.regionprops(labelled_align_trap_mask_stack[frame,:,:])])
 
-                if p['debug']:
-                    pprint(areas)
-                    print(expected_area)
-
-                    if not expected_area in areas:
-                        print("No trap has expected total area. Saving labelled masks for debugging as labelled_align_trap_mask_stack.tif")
-                        io.imsave("labelled_align_trap_mask_stack.tif", labelled_align_trap_mask_stack.astype('uint8'))
-                        io.imsave("masks.tif", align_traps.astype('uint8'))
-                        # occasionally our microscope misses an image, resulting in no traps for a single frame. This obviously messes up image alignment here....
-
-                for trap in align_trap_props:
-                    if trap.area != expected_area:
-                        bad_align_trap_props.append(trap.label)
-                    else:
-                        good_align_trap_props.append(trap)
-
-                for label in bad_align_trap_props:
-                    labelled_align_trap_mask_stack[labelled_align_trap_mask_stack == label] = 0
-
-                align_centroids = []
-                for frame in range(trap_align_metadata['frame_count']):
-                    align_centroids.append([reg.centroid for reg in measure.regionprops(labelled_align_trap_mask_stack[frame,:,:])])
-
-                align_centroids = np.asarray(align_centroids)
-                shifts = np.mean(align_centroids - align_centroids[0,:,:], axis=1)
+                    align_centroids = np.asarray(align_centroids)
+                    shifts = np.mean(align_centroids - align_centroids[0,:,:], axis=1)
                 integer_shifts = np.round(shifts).astype('int16')
 
-                good_trap_bboxes_dict = {}
-                for trap in good_trap_props:
-                    good_trap_bboxes_dict[trap.label] = trap.bbox
-
                 # pprint(good_trap_bboxes_dict) # uncomment for debugging
                 bbox_shift_dict = mm3.shift_bounding_boxes(good_trap_bboxes_dict, integer_shifts, img.shape[0])
                 # pprint(bbox_shift_dict) # uncomment for debugging
 
-                trap_images_fov_dict, trap_closed_end_px_dict = mm3.crop_traps(fov_file_names, good_trap_props, good_trap_labels, bbox_shift_dict, trap_align_metadata)
+                trap_images_fov_dict, trap_closed_end_px_dict = mm3.crop_traps(fov_file_names, good_trap_props, good_trap_labels, bbox_shift_dict, trap_align_metadata,
+                                                                             trapRegions=trap_regions)
 
                 for fn in fov_file_names:
                     analyzed_imgs[fn]['channels'] = trap_closed_end_px_dict[fn]
 
+                # save the trap locations for this fov to the metadata index
+                metadata_index.add({fn : analyzed_imgs[fn] for fn in fov_file_names})
+
                 if p['compile']['do_channel_masks']:
                     fov_channel_masks = mm3.make_channel_masks_CNN(bbox_shift_dict)
                     channel_masks[fov_id] = fov_channel_masks
@@ -561,14 +622,17 @@ if __name__ == "__main__":
                         # Or write it to hdf5
                         mm3.save_hdf5(trap_images_fov_dict, fov_file_names, analyzed_imgs, fov_id, channel_masks)
 
-        # save metadata to a .pkl and a human readable txt file
-        mm3.information('Saving metadata from analyzed images...')
-        with open(os.path.join(p['ana_dir'], 'TIFF_metadata.pkl'), 'wb') as tiff_metadata:
-            pickle.dump(analyzed_imgs, tiff_metadata, protocol=pickle.HIGHEST_PROTOCOL)
-        with open(os.path.join(p['ana_dir'], 'TIFF_metadata.txt'), 'w') as tiff_metadata:
-            pprint(analyzed_imgs, stream=tiff_metadata)
+                    elif p['output'] == "zarr":
+                        mm3.save_zarr(trap_images_fov_dict, fov_file_names, analyzed_imgs, fov_id, channel_masks)
+
+        mm3.information('Metadata from analyzed images saved to %s.' % metadata_index.db_path)
+
+    if metadata_index is not None:
+        metadata_index.close()
 
-        mm3.information('Saved metadata from analyzed images.')
+    # images which could not be analyzed are left out
+    analyzed_imgs = {fn : idata for fn, idata in six.iteritems(analyzed_imgs)
+                     if idata and idata.get('analyze_success', True) != False}
 
     ### Make table for jd time to FOV and time point
     if not p['compile']['do_time_table']:
@@ -607,27 +671,95 @@ if __name__ == "__main__":
 
         if p['compile']['find_channels_method'] == 'peaks':
 
-            # do it by FOV. Not set up for multiprocessing
+            # collect the images for each FOV
+            fov_images = {}
             for fov, peaks in six.iteritems(channel_masks):
 
                 # skip fov if not in the group
                 if user_spec_fovs and fov not in user_spec_fovs:
                     continue
 
-                mm3.information("Loading images for FOV %03d." % fov)
-
                 # get filenames just for this fov along with the julian date of acquistion
                 send_to_write = [[k, v['t']] for k, v in six.iteritems(analyzed_imgs) if v['fov'] == fov]
 
+                if len(send_to_write) == 0:
+                    mm3.warning("No images found for FOV %03d." % fov)
+                    continue
+
                 # sort the filenames by jdn
-                send_to_write = sorted(send_to_write, key=lambda time: time[1])
+                fov_images[fov] = sorted(send_to_write, key=lambda time: time[1])
+
+            if p['compile']['parallel_slicing']:
+                # each process slices whole FOVs, which are written to separate files
+                mm3.information("Slicing %d FOVs with %d processes." % (len(fov_images), p['num_analyzers']))
+
+                # report progress as each FOV finishes
+                fovs_done = []
+                def report_fov_done(result):
+                    fovs_done.append(result[0])
+                    mm3.information("Sliced FOV %03d, %d images in %.1f s (%d of %d FOVs)."
+                                    % (result[0], result[1], result[2], len(fovs_done), len(fov_images)))
+                def report_fov_failed(error):
+                    mm3.warning("Slicing an FOV failed:", error)
+
+                pool = Pool(p['num_analyzers'])
+
+                for fov, send_to_write in sorted(six.iteritems(fov_images)):
+                    # only send the metadata and masks for this fov to the worker
+                    fov_analyzed_imgs = {fn : analyzed_imgs[fn] for fn, t in send_to_write}
+
+                    # limit the time points held in memory by each process if asked
+                    if p['compile']['slicing_memory_per_process']:
+                        block_size = mm3.slicing_block_size_for_memory(analyzed_imgs[send_to_write[0][0]],
+                                                                   p['compile']['slicing_memory_per_process'])
+                    else:
+                        block_size = p['compile']['slicing_block_size']
+
+                    pool.apply_async(mm3.slice_and_write_fov,
+                                     args=(send_to_write, {fov : channel_masks[fov]}, fov_analyzed_imgs, block_size),
+                                     callback=report_fov_done, error_callback=report_fov_failed)
 
-                if p['output'] == 'TIFF':
-                    #This is for loading the whole raw tiff stack and then slicing through it
-                    mm3.tiff_stack_slice_and_write(send_to_write, channel_masks, analyzed_imgs)
+                pool.close()
+                pool.join()
+
+            else:
+                # do it by FOV in this process
+                for fov, send_to_write in sorted(six.iteritems(fov_images)):
+                    mm3.information("Loading images for FOV %03d." % fov)
 
-                elif p['output'] == 'HDF5':
-                    # Or write it to hdf5
-                    mm3.hdf5_stack_slice_and_write(send_to_write, channel_masks, analyzed_imgs)
+                    if p['compile']['slicing_block_size']:
+                        # stream the images a block of time points at a time to bound memory
+                        if p['output'] == 'TIFF':
+                            mm3.tiff_stack_slice_and_write_blocks(send_to_write, channel_masks, analyzed_imgs)
+
+                        elif p['output'] == 'HDF5':
+                            mm3.hdf5_stack_slice_and_write_blocks(send_to_write, channel_masks, analyzed_imgs)
+
+                        elif p['output'] == 'zarr':
+                            mm3.zarr_stack_slice_and_write_blocks(send_to_write, channel_masks, analyzed_imgs)
+
+                    elif p['output'] == 'TIFF':
+                        #This is for loading the whole raw tiff stack and then slicing through it
+                        mm3.tiff_stack_slice_and_write(send_to_write, channel_masks, analyzed_imgs)
+
+                    elif p['output'] == 'HDF5':
+                        # Or write it to hdf5
+                        mm3.hdf5_stack_slice_and_write(send_to_write, channel_masks, analyzed_imgs)
+
+                    elif p['output'] == 'zarr':
+                        # each channel and plane is its own chunked array in the FOV store
+                        mm3.zarr_stack_slice_and_write_blocks(send_to_write, channel_masks, analyzed_imgs)
 
             mm3.information("Channel slices saved.")
+
+    ### Follow an acquisition in progress ##########################################################
+    if namespace.follow:
+        if p['output'] != 'HDF5' or p['compile']['find_channels_method'] != 'peaks':
+            mm3.warning("Following an acquisition requires output: 'HDF5' and find_channels_method: 'peaks'.")
+        else:
+            # channel masks from this run or a previous one are applied to the new images
+            if not (p['compile']['do_channel_masks'] or p['compile']['do_slicing']):
+                channel_masks = mm3.load_channel_masks()
+
+            mm3.follow_acquisition(channel_masks, fov_ids=user_spec_fovs,
+                                   t_start=t_start, t_end=t_end)
@@ -94,6 +94,8 @@ if __name__ == "__main__":
     ### Do Segmentation by FOV and then peak #######################################################
     mm3.information("Segmenting channels using Otsu method.")
 
+    # channels of all FOVs are segmented with one pool and saved as they finish
+    fov_peak_ids = []
     for fov_id in fov_id_list:
         # determine which peaks are to be analyzed (those which have been subtracted)
         ana_peak_ids = []
@@ -102,8 +104,9 @@ if __name__ == "__main__":
                 ana_peak_ids.append(peak_id)
         ana_peak_ids = sorted(ana_peak_ids) # sort for repeatability
 
-        for peak_id in ana_peak_ids:
-            # send to segmentation
-            mm3.segment_chnl_stack(fov_id, peak_id)
+        fov_peak_ids.extend((fov_id, peak_id) for peak_id in ana_peak_ids)
+
+    with mm3.SegmentationEngine() as engine:
+        engine.segment_peaks(fov_peak_ids)
 
     mm3.information("Finished segmentation.")
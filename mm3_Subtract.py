@@ -52,7 +52,9 @@ if __name__ == "__main__":
     parser.add_argument('-j', '--nproc',  type=int,
                         required=False, help='Number of processors to use.')
     parser.add_argument('-c', '--color', type=str,
-                        required=False, help='Color plane to subtract. "c1", "c2", etc.')
+                        required=False, help='Color plane to subtract. "c1", "c2", etc. Several planes, like "c1,c2,c3", are subtracted in one pass, with fluorescence aligned by the phase plane.')
+    parser.add_argument('-s', '--segment', action='store_true',
+                        required=False, help='Also segment the subtracted phase channels with the Otsu method, like mm3_Segment-Otsu.py.')
     namespace = parser.parse_args()
 
     # Load the project parameters file
@@ -80,9 +82,9 @@ if __name__ == "__main__":
 
     # which color channel with which to do subtraction
     if namespace.color:
-        sub_plane = namespace.color
+        sub_planes = namespace.color.split(',')
     else:
-        sub_plane = 'c1'
+        sub_planes = ['c1']
 
     # Create folders for subtracted info if they don't exist
     if p['output'] == 'TIFF':
@@ -90,6 +92,12 @@ if __name__ == "__main__":
             os.makedirs(p['empty_dir'])
         if not os.path.exists(p['sub_dir']):
             os.makedirs(p['sub_dir'])
+        if namespace.segment and not os.path.exists(p['seg_dir']):
+            os.makedirs(p['seg_dir'])
+
+    # set segmentation image name for saving segmented images
+    if namespace.segment:
+        p['seg_img'] = 'seg_otsu'
 
     # load specs file
     specs = mm3.load_specs()
@@ -104,11 +112,9 @@ if __name__ == "__main__":
     mm3.information("Found %d FOVs to process." % len(fov_id_list))
 
     # determine if we are doing fluorescence or phase subtraction, and set flags
-    if sub_plane == p['phase_plane']:
-        align = True # used when averaging empties
+    if sub_planes[0] == p['phase_plane']:
         sub_method = 'phase' # used in subtract_fov_stack
     else:
-        align = False
         sub_method = 'fluor'
 
     ### Make average empty channels ###############################################################
@@ -117,30 +123,39 @@ if __name__ == "__main__":
         pass # just skip this part and go to subtraction
 
     else:
-        mm3.information("Calculating averaged empties for channel {}.".format(sub_plane))
-
-        need_empty = [] # list holds fov_ids of fov's that did not have empties
-        for fov_id in fov_id_list:
-            # send to function which will create empty stack for each fov.
-            averaging_result = mm3.average_empties_stack(fov_id, specs,
-                                                         color=sub_plane, align=align)
-            # add to list for FOVs that need to be given empties from other FOvs
-            if not averaging_result:
-                need_empty.append(fov_id)
-
-        # deal with those problem FOVs without empties
-        have_empty = list(set(fov_id_list).difference(set(need_empty))) # fovs with empties
-        for fov_id in need_empty:
-            from_fov = min(have_empty, key=lambda x: abs(x-fov_id)) # find closest FOV with an empty
-            copy_result = mm3.copy_empty_stack(from_fov, fov_id, color=sub_plane)
+        for sub_plane in sub_planes:
+            mm3.information("Calculating averaged empties for channel {}.".format(sub_plane))
+            align = sub_plane == p['phase_plane'] # used when averaging empties
+
+            need_empty = [] # list holds fov_ids of fov's that did not have empties
+            for fov_id in fov_id_list:
+                # send to function which will create empty stack for each fov.
+                averaging_result = mm3.average_empties_stack(fov_id, specs,
+                                                             color=sub_plane, align=align)
+                # add to list for FOVs that need to be given empties from other FOvs
+                if not averaging_result:
+                    need_empty.append(fov_id)
+
+            # deal with those problem FOVs without empties
+            have_empty = list(set(fov_id_list).difference(set(need_empty))) # fovs with empties
+            for fov_id in need_empty:
+                from_fov = min(have_empty, key=lambda x: abs(x-fov_id)) # find closest FOV with an empty
+                copy_result = mm3.copy_empty_stack(from_fov, fov_id, color=sub_plane)
 
     ### Subtract ##################################################################################
     if p['subtract']['do_subtraction']:
-        mm3.information("Subtracting channels for channel {}.".format(sub_plane))
-        for fov_id in fov_id_list:
-            # send to function which will create empty stack for each fov.
-            subtraction_result = mm3.subtract_fov_stack(fov_id, specs,
-                                                        color=sub_plane, method=sub_method)
+        mm3.information("Subtracting channels for channel {}.".format(', '.join(sub_planes)))
+        # all planes are done in one pass, phase first
+        sub_color = sub_planes[0] if len(sub_planes) == 1 else sub_planes
+        # one pool of processes is used for all FOVs. With --segment, the phase channels are
+        # segmented while still in memory
+        with mm3.SubtractionEngine(segment=namespace.segment,
+                                   write_subtracted=p['subtract']['write_subtracted']) as engine:
+            for fov_id in fov_id_list:
+                # send to function which will create empty stack for each fov.
+                subtraction_result = mm3.subtract_fov_stack(fov_id, specs,
+                                                            color=sub_color, method=sub_method,
+                                                            engine=engine)
         mm3.information("Finished subtraction.")
 
     # Else just end, they only wanted to do empty averaging.
@@ -9,8 +9,10 @@ import os # interacting with file systems
 import time # getting time
 import datetime
 import inspect # get passed parameters
+import glob # finding files
 import yaml # parameter importing
 import json # for importing tiff metadata
+import sqlite3 # for the image metadata index
 try:
     import cPickle as pickle # loading and saving python objects
 except:
@@ -18,11 +20,23 @@ except:
 import numpy as np # numbers package
 import struct # for interpretting strings as binary data
 import re # regular expressions
+import shutil # removing temporary directories
+import tempfile # temporary files shared with worker processes
+import threading # background writing of stacks
 from pprint import pprint # for human readable file output
 import traceback # for error messaging
 import warnings # error messaging
 import copy # not sure this is needed
 import h5py # working with HDF5 files
+try:
+    import hdf5plugin # optional Blosc, LZ4 and Zstd filters for HDF5
+except ImportError:
+    hdf5plugin = None
+try:
+    import zarr # optional chunked directory store output
+    import numcodecs
+except ImportError:
+    zarr = None
 import pandas as pd
 import networkx as nx
 import collections
@@ -34,6 +48,10 @@ from scipy.optimize import leastsq # fitting 2d gaussian
 from scipy import ndimage as ndi # labeling and distance transform
 from skimage import io
 from skimage import segmentation # used in make_masks and segmentation
+try:
+    from skimage.segmentation import watershed # marker watershed segmentation
+except ImportError:
+    from skimage.morphology import watershed # older scikit-image
 from skimage.transform import rotate
 from skimage.feature import match_template # used to align images
 from skimage.feature import blob_log # used for foci finding
@@ -58,6 +76,7 @@ from tensorflow.keras import backend as K
 # Parralelization modules
 import multiprocessing
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool # for reading frames ahead
 
 # Plotting for debug
 import matplotlib as mpl
@@ -103,6 +122,7 @@ def init_mm3_helpers(param_file_path):
     params['TIFF_dir'] = os.path.join(params['experiment_directory'], params['image_directory'])
     params['ana_dir'] = os.path.join(params['experiment_directory'], params['analysis_directory'])
     params['hdf5_dir'] = os.path.join(params['ana_dir'], 'hdf5')
+    params['zarr_dir'] = os.path.join(params['ana_dir'], 'zarr')
     params['chnl_dir'] = os.path.join(params['ana_dir'], 'channels')
     params['empty_dir'] = os.path.join(params['ana_dir'], 'empties')
     params['sub_dir'] = os.path.join(params['ana_dir'], 'subtracted')
@@ -123,6 +143,83 @@ def init_mm3_helpers(param_file_path):
     if not 'save_predictions' in params['segment'].keys():
         params['segment']['save_predictions'] = False
 
+    # reader used by load_stack. Sizes of the stack cache in MB and of the open file pool
+    if not 'load_stack_cache_mb' in params.keys():
+        params['load_stack_cache_mb'] = 0
+    if not 'load_stack_open_files' in params.keys():
+        params['load_stack_open_files'] = 0
+    # save TIFF output stacks as uncompressed .npy files which load_stack memory maps
+    if not 'memmap_stacks' in params.keys():
+        params['memmap_stacks'] = False
+
+    global stack_reader
+    stack_reader = StackReader(cache_mb=params['load_stack_cache_mb'],
+                               max_open_files=params['load_stack_open_files'])
+
+    # compression and chunking for each kind of HDF5 image stack. Missing settings
+    # keep the original gzip, one frame per chunk layout
+    hdf5_compression = params.get('hdf5_compression') or {}
+    for kind in ('raw', 'sub', 'seg'):
+        kind_settings = {'codec' : 'gzip', 'level' : 4, 'shuffle' : True,
+                         'fletcher32' : True, 'time_chunk' : 1}
+        kind_settings.update(hdf5_compression.get(kind) or {})
+        hdf5_compression[kind] = kind_settings
+    params['hdf5_compression'] = hdf5_compression
+
+    # zarr output uses the same compression settings, but needs the zarr package
+    if params['output'] == 'zarr' and zarr is None:
+        raise ImportError("The zarr package is needed for zarr output. Install it or set output to TIFF or HDF5.")
+
+    # number of time points to hold in memory while slicing. None loads whole FOVs
+    if not 'slicing_block_size' in params['compile'].keys():
+        params['compile']['slicing_block_size'] = None
+
+    # slice FOVs in parallel processes, and the memory in GB each process may use
+    if not 'parallel_slicing' in params['compile'].keys():
+        params['compile']['parallel_slicing'] = False
+    if not 'slicing_memory_per_process' in params['compile'].keys():
+        params['compile']['slicing_memory_per_process'] = None
+
+    # find channels on this many images per FOV and follow the drift for the rest.
+    # None finds channels on every image. Largest drift in pixels looked for, None is
+    # half the channel separation
+    if not 'channel_sample_frames' in params['compile'].keys():
+        params['compile']['channel_sample_frames'] = None
+    if not 'channel_drift_max_shift' in params['compile'].keys():
+        params['compile']['channel_drift_max_shift'] = None
+
+    # how Unet trap finding gets the drift of each frame. 'phase_correlation' registers the
+    # alignment region by FFT, 'trap_labels' tracks the centroids of traps predicted in every frame
+    if not 'trap_alignment_method' in params['compile'].keys():
+        params['compile']['trap_alignment_method'] = 'phase_correlation'
+
+    # how phase channels are aligned to the empty before subtraction. 'fft' aligns all
+    # frames of a block together, 'match_template' aligns one frame at a time
+    if not 'phase_alignment' in params['subtract'].keys():
+        params['subtract']['phase_alignment'] = 'fft'
+
+    # how segment_image grows markers into cells, 'random_walker', 'watershed' or 'watershed_distance'
+    if not 'otsu_engine' in params['segment'].keys():
+        params['segment']['otsu_engine'] = 'random_walker'
+
+    # save subtracted phase stacks when mm3_Subtract.py also segments them
+    if not 'write_subtracted' in params['subtract'].keys():
+        params['subtract']['write_subtracted'] = True
+
+    # how the empties of an FOV are combined, 'mean', 'median' or 'trimmed_mean'
+    if not 'empty_average' in params['subtract'].keys():
+        params['subtract']['empty_average'] = 'mean'
+
+    # align fluorescence empties with the offsets saved by phase subtraction, when there are any
+    if not 'align_fluor_to_phase' in params['subtract'].keys():
+        params['subtract']['align_fluor_to_phase'] = True
+
+    # seconds between checks for new images, and seconds without new images before stopping, when following an acquisition
+    if not 'follow_poll_interval' in params['compile'].keys():
+        params['compile']['follow_poll_interval'] = 30
+    if not 'follow_timeout' in params['compile'].keys():
+        params['compile']['follow_timeout'] = 1800
+
     return params
 
 def julian_day_number():
@@ -162,11 +259,20 @@ def get_time(filepath):
         return None
 
 # loads and image stack from TIFF or HDF5 using mm3 conventions
-def load_stack(fov_id, peak_id, color='c1', image_return_number=None):
+def load_stack(fov_id, peak_id, color='c1', image_return_number=None,
+               t_range=None, frames=None, roi=None):
     '''
     Loads an image stack.
 
-    Supports reading TIFF stacks or HDF5 files.
+    Supports reading TIFF stacks or HDF5 files. Reading is done by the module's
+    StackReader, which can keep HDF5 files open and cache decoded stacks between calls.
+
+    Only part of the stack can be asked for with t_range, frames and roi. For HDF5
+    only the requested frames and region are read from disk, for TIFF only the
+    requested pages are decoded.
+
+    Stacks saved with memmap_stacks are returned as copy on write memory maps, so
+    no data is read until it is indexed. Changes to them are not saved to disk.
 
     Parameters
     ----------
@@ -181,6 +287,15 @@ def load_stack(fov_id, peak_id, color='c1', image_return_number=None):
         sub : subtracted images
         seg : segmented images
         empty : get the empty channel for this fov, slightly different
+    image_return_number : None
+        Not used.
+    t_range : slice or tuple
+        Range of frame indexes to return, as a slice or (start, stop[, step]).
+    frames : int or list of ints
+        Frame indexes to return, in the order given. Negative indexes count from the end.
+        The time axis is kept for a single int. Can't be used with t_range.
+    roi : list
+        Spatial region to return, as [[y1, y2], [x1, x2]] like channel masks.
 
     Returns
     -------
@@ -188,21 +303,72 @@ def load_stack(fov_id, peak_id, color='c1', image_return_number=None):
         The image stack through time. Shape is (t, y, x)
     '''
 
+    return stack_reader.read(fov_id, peak_id, color, t_range=t_range, frames=frames, roi=roi)
+
+# turns the t_range and frames arguments of load_stack into frame indexes
+def stack_frame_indexes(n_frames, t_range=None, frames=None):
+    '''Returns a slice for t_range, an array of non-negative frame indexes for frames,
+    or a slice of all frames if neither is given.'''
+
+    if frames is not None:
+        if t_range is not None:
+            raise ValueError('Only one of t_range and frames can be given.')
+        return np.arange(n_frames)[np.atleast_1d(frames)]
+
+    if t_range is None:
+        return slice(None)
+    if isinstance(t_range, slice):
+        return t_range
+    return slice(*t_range)
+
+# takes part of an in memory stack like load_stack does from disk
+def select_from_stack(img_stack, t_range=None, frames=None, roi=None):
+    '''Returns the frames and region of img_stack given by the load_stack arguments.'''
+
+    t_sel = stack_frame_indexes(img_stack.shape[0], t_range, frames)
+    if roi is None:
+        return img_stack[t_sel]
+    return img_stack[t_sel, roi[0][0]:roi[0][1], roi[1][0]:roi[1][1]]
+
+# number of frames in an image stack
+def stack_length(fov_id, peak_id, color='c1'):
+    '''Returns the number of frames in a stack without reading the image data.'''
+
+    filepath, dataset = stack_location(fov_id, peak_id, color)
+
+    if dataset is None:
+        if filepath.endswith('.npy'):
+            return np.load(filepath, mmap_mode='r').shape[0]
+        with tiff.TiffFile(filepath) as tif:
+            return len(tif.pages)
+
+    if params['output'] == 'zarr':
+        return zarr.open_array(os.path.join(filepath, dataset), mode='r').shape[0]
+
+    with h5py.File(filepath, 'r') as h5f:
+        return h5f[dataset].shape[0]
+
+# where an image stack is saved, using mm3 conventions
+def stack_location(fov_id, peak_id, color):
+    '''Returns the file path and, for HDF5 and zarr output, the dataset name of an image
+    stack. The dataset name is None for TIFF output, where the file is a .npy file if
+    memmap_stacks is set. For zarr the file path is the FOV store directory and the
+    dataset name is the array path inside it.
+    '''
+
     # things are slightly different for empty channels
     if 'empty' in color:
         if params['output'] == 'TIFF':
             img_filename = params['experiment_name'] + '_xy%03d_%s.tif' % (fov_id, color)
-
-            with tiff.TiffFile(os.path.join(params['empty_dir'],img_filename)) as tif:
-                img_stack = tif.asarray()
+            return tiff_stack_path(os.path.join(params['empty_dir'], img_filename)), None
 
         if params['output'] == 'HDF5':
-            with h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % fov_id), 'r') as h5f:
-                img_stack = h5f[color][:]
+            return os.path.join(params['hdf5_dir'], 'xy%03d.hdf5' % fov_id), color
 
-        return img_stack
+        if params['output'] == 'zarr':
+            return zarr_fov_path(fov_id), color
 
-    # load normal images for either TIFF or HDF5
+    # normal images for either TIFF or HDF5
     if params['output'] == 'TIFF':
         if color[0] == 'c':
             img_dir = params['chnl_dir']
@@ -214,33 +380,556 @@ def load_stack(fov_id, peak_id, color='c1', image_return_number=None):
             img_dir = params['seg_dir']
 
         img_filename = params['experiment_name'] + '_xy%03d_p%04d_%s.tif' % (fov_id, peak_id, color)
-
-        with tiff.TiffFile(os.path.join(img_dir, img_filename)) as tif:
-            img_stack = tif.asarray()
+        return tiff_stack_path(os.path.join(img_dir, img_filename)), None
 
     if params['output'] == 'HDF5':
-        with h5py.File(os.path.join(params['hdf5_dir'], 'xy%03d.hdf5' % fov_id), 'r') as h5f:
-            # normal naming
-            # need to use [:] to get a copy, else it references the closed hdf5 dataset
-            img_stack = h5f['channel_%04d/p%04d_%s' % (peak_id, peak_id, color)][:]
+        return (os.path.join(params['hdf5_dir'], 'xy%03d.hdf5' % fov_id),
+                'channel_%04d/p%04d_%s' % (peak_id, peak_id, color))
+
+    if params['output'] == 'zarr':
+        return zarr_fov_path(fov_id), 'channel_%04d/p%04d_%s' % (peak_id, peak_id, color)
+
+# file used for a stack with TIFF output
+def tiff_stack_path(filepath):
+    '''Returns the .npy path in place of the .tif path for memory mapped stacks.'''
+    if params['memmap_stacks']:
+        return os.path.splitext(filepath)[0] + '.npy'
+    return filepath
+
+# saves a stack for TIFF output
+def save_tiff_stack(filepath, img_stack, compress=4):
+    '''Saves an image stack as a TIFF at filepath with the given compression. If
+    memmap_stacks is set, the stack is instead saved uncompressed as a .npy file with
+    the same name, which load_stack can memory map without decoding or copying.
+    '''
+
+    if params['memmap_stacks']:
+        # write to a new file and swap it in, so memory maps of the old stack stay valid
+        npy_filepath = tiff_stack_path(filepath)
+        np.save(npy_filepath + '.tmp.npy', np.ascontiguousarray(img_stack))
+        os.replace(npy_filepath + '.tmp.npy', npy_filepath)
+    else:
+        tiff.imsave(filepath, img_stack, compress=compress)
+
+# directory store of an FOV for zarr output
+def zarr_fov_path(fov_id):
+    '''Returns the path of the zarr store for an FOV.'''
+    return os.path.join(params['zarr_dir'], 'xy%03d.zarr' % fov_id)
+
+# reads image stacks for load_stack, reusing open files and caching decoded stacks
+class StackReader():
+    '''
+    Reads image stacks for load_stack.
+
+    Up to max_open_files per FOV HDF5 files are kept open between reads, and decoded
+    stacks are kept in a least recently used cache of at most cache_mb megabytes.
+    Both are off when set to 0. Cached stacks are copied on return so callers may
+    modify them. Counts of cache hits and misses are kept in hits and misses.
+
+    Memory mapped .npy stacks are not cached, the OS page cache already keeps them.
+
+    Writers must call release for an FOV before writing to it, so that open handles
+    are closed and stale stacks are dropped.
+    '''
+
+    def __init__(self, cache_mb=0, max_open_files=0):
+        self.cache_bytes = int(cache_mb * 1024**2)
+        self.max_open_files = max_open_files
+
+        self.hits = 0
+        self.misses = 0
+
+        self.h5_files = collections.OrderedDict() # file path : open h5py.File
+        self.stacks = collections.OrderedDict() # (fov_id, peak_id, color) : stack
+        self.cached_bytes = 0
+        self.pid = os.getpid()
+
+    def check_process(self):
+        '''Forget handles and stacks inherited from a parent process. HDF5 handles must
+        not be shared across a fork, so they are dropped without being closed.'''
+        if os.getpid() != self.pid:
+            self.h5_files = collections.OrderedDict()
+            self.stacks = collections.OrderedDict()
+            self.cached_bytes = 0
+            self.pid = os.getpid()
+
+    def h5_file(self, filepath):
+        '''Returns an open HDF5 file, opening it if needed and closing the least
+        recently used file if too many are open.'''
+
+        if filepath in self.h5_files:
+            self.h5_files.move_to_end(filepath)
+            return self.h5_files[filepath]
+
+        h5f = h5py.File(filepath, 'r')
+        self.h5_files[filepath] = h5f
+        while len(self.h5_files) > self.max_open_files:
+            self.h5_files.popitem(last=False)[1].close()
+
+        return h5f
+
+    def read_uncached(self, fov_id, peak_id, color, t_range=None, frames=None, roi=None):
+        '''Reads a stack, or the requested part of it, from disk.'''
+
+        filepath, dataset = stack_location(fov_id, peak_id, color)
+        partial = t_range is not None or frames is not None or roi is not None
+
+        if dataset is None and filepath.endswith('.npy'):
+            # copy on write memory map, only the pages indexed are read from disk and
+            # changes made by the caller stay in memory
+            return select_from_stack(np.load(filepath, mmap_mode='c'), t_range, frames, roi)
+
+        if dataset is None:
+            with tiff.TiffFile(filepath) as tif:
+                if not partial:
+                    return tif.asarray()
+
+                # decode only the pages (frames) which are asked for
+                t_sel = stack_frame_indexes(len(tif.pages), t_range, frames)
+                page_indexes = np.arange(len(tif.pages))[t_sel]
+                img_stack = tif.asarray(key=[int(page) for page in page_indexes])
+                img_stack = img_stack.reshape((len(page_indexes),) + img_stack.shape[-2:])
+
+            return select_from_stack(img_stack, roi=roi)
+
+        if params['output'] == 'zarr':
+            # zarr arrays are opened per read, only the needed chunks are decoded
+            return self.read_dataset(zarr.open_array(os.path.join(filepath, dataset), mode='r'),
+                                     t_range, frames, roi)
+
+        if self.max_open_files > 0:
+            return self.read_dataset(self.h5_file(filepath)[dataset], t_range, frames, roi)
+
+        with h5py.File(filepath, 'r') as h5f:
+            # need to read to get a copy, else it references the closed hdf5 dataset
+            return self.read_dataset(h5f[dataset], t_range, frames, roi)
+
+    def read_dataset(self, h5ds, t_range=None, frames=None, roi=None):
+        '''Reads the requested part of an HDF5 dataset, or zarr array, with a single
+        hyperslab selection.'''
+
+        if roi is None:
+            yx_sel = (slice(None), slice(None))
+        else:
+            yx_sel = (slice(roi[0][0], roi[0][1]), slice(roi[1][0], roi[1][1]))
+
+        t_sel = stack_frame_indexes(h5ds.shape[0], t_range, frames)
+        if isinstance(t_sel, slice):
+            return h5ds[(t_sel,) + yx_sel]
+
+        # HDF5 needs increasing, unique indexes, so read those and put them in order after
+        unique_frames, order = np.unique(t_sel, return_inverse=True)
+        unique_frames = [int(frame) for frame in unique_frames]
+        if zarr is not None and isinstance(h5ds, zarr.Array):
+            # zarr takes index lists through orthogonal indexing
+            img_stack = h5ds.oindex[(unique_frames,) + yx_sel]
+        else:
+            img_stack = h5ds[(unique_frames,) + yx_sel]
+        return img_stack[order]
+
+    def read(self, fov_id, peak_id, color, t_range=None, frames=None, roi=None):
+        '''Returns a stack, or part of it, from the cache if possible. Only whole stacks
+        are added to the cache.'''
+
+        self.check_process()
+
+        key = (fov_id, peak_id, color)
+        if key in self.stacks:
+            self.hits += 1
+            self.stacks.move_to_end(key)
+            return select_from_stack(self.stacks[key], t_range, frames, roi).copy()
+
+        self.misses += 1
+        if t_range is not None or frames is not None or roi is not None:
+            return self.read_uncached(fov_id, peak_id, color, t_range, frames, roi)
+
+        img_stack = self.read_uncached(fov_id, peak_id, color)
+
+        # only cache stacks which fit in the budget. Memory maps are left to the OS page cache
+        if 0 < img_stack.nbytes <= self.cache_bytes and not isinstance(img_stack, np.memmap):
+            self.stacks[key] = img_stack.copy()
+            self.cached_bytes += img_stack.nbytes
+            while self.cached_bytes > self.cache_bytes:
+                self.cached_bytes -= self.stacks.popitem(last=False)[1].nbytes
+
+        return img_stack
+
+    def release(self, fov_id=None):
+        '''Closes open files and drops cached stacks for one FOV, or for all if None.'''
+
+        self.check_process()
+
+        for key in list(self.stacks.keys()):
+            if fov_id is None or key[0] == fov_id:
+                self.cached_bytes -= self.stacks.pop(key).nbytes
+
+        if fov_id is None:
+            filepaths = list(self.h5_files.keys())
+        else:
+            filepaths = [filepath for filepath in self.h5_files.keys()
+                         if filepath == os.path.join(params['hdf5_dir'], 'xy%03d.hdf5' % fov_id)]
+        for filepath in filepaths:
+            self.h5_files.pop(filepath).close()
+
+    def stats(self):
+        '''Returns a dictionary of cache hits, misses, cached megabytes and open files.'''
+        return {'hits' : self.hits,
+                'misses' : self.misses,
+                'cached_mb' : self.cached_bytes / 1024**2,
+                'open_files' : len(self.h5_files)}
+
+# options for creating HDF5 datasets of image stacks
+def hdf5_stack_options(kind, frame_shape):
+    '''Returns the keyword arguments for h5py create_dataset for an image stack, using the
+    compression settings for that kind of stack in params['hdf5_compression'].
+
+    Parameters
+    ----------
+    kind : str
+        'raw' for sliced channels and empties, 'sub' for subtracted stacks or 'seg' for
+        segmented stacks.
+    frame_shape : tuple
+        The (y, x) shape of one frame of the stack.
+
+    Returns
+    -------
+    options : dict
+        chunks, compression, compression_opts, shuffle and fletcher32 arguments.
+        maxshape and data should be given by the caller.
+    '''
+
+    settings = params['hdf5_compression'][kind]
+    codec = settings['codec']
+    level = settings['level']
+
+    # chunks hold time_chunk whole frames
+    options = {'chunks' : (settings['time_chunk'],) + tuple(frame_shape),
+               'fletcher32' : settings['fletcher32']}
+
+    if codec in ('blosc-lz4', 'blosc-lz4hc', 'blosc-zstd', 'blosc-blosclz', 'lz4', 'zstd'):
+        if hdf5plugin is None:
+            warning("hdf5plugin is needed for the %s codec, using gzip instead." % codec)
+            codec = 'gzip'
+            level = 4
+
+    if codec == 'gzip':
+        options.update(compression='gzip', compression_opts=level, shuffle=settings['shuffle'])
+    elif codec == 'lzf':
+        options.update(compression='lzf', shuffle=settings['shuffle'])
+    elif codec.startswith('blosc-'):
+        # blosc does its own byte shuffling
+        blosc_shuffle = hdf5plugin.Blosc.SHUFFLE if settings['shuffle'] else hdf5plugin.Blosc.NOSHUFFLE
+        options.update(hdf5plugin.Blosc(cname=codec.split('-')[1], clevel=level, shuffle=blosc_shuffle))
+    elif codec == 'lz4':
+        options.update(hdf5plugin.LZ4(), shuffle=settings['shuffle'])
+    elif codec == 'zstd':
+        options.update(hdf5plugin.Zstd(clevel=level), shuffle=settings['shuffle'])
+    elif codec != 'none':
+        warning("Unknown HDF5 codec %s, saving without compression." % codec)
+
+    return options
+
+# options for creating zarr arrays of image stacks
+def zarr_stack_options(kind, frame_shape):
+    '''Returns the chunks and compressor keyword arguments for a zarr image stack, using
+    the same settings in params['hdf5_compression'] as hdf5_stack_options. Codecs are
+    taken from numcodecs, so no HDF5 plugins are needed. fletcher32 is not used, zarr
+    chunks are separate files which are checked by their compressor.
+    '''
 
-    return img_stack
+    settings = params['hdf5_compression'][kind]
+    codec = settings['codec']
+    level = settings['level']
+
+    if codec.startswith('blosc-'):
+        blosc_shuffle = numcodecs.Blosc.SHUFFLE if settings['shuffle'] else numcodecs.Blosc.NOSHUFFLE
+        compressor = numcodecs.Blosc(cname=codec.split('-')[1], clevel=level, shuffle=blosc_shuffle)
+    elif codec == 'gzip':
+        compressor = numcodecs.GZip(level=level)
+    elif codec == 'zstd':
+        compressor = numcodecs.Zstd(level=level)
+    elif codec == 'lz4':
+        compressor = numcodecs.LZ4()
+    elif codec == 'none':
+        compressor = None
+    else:
+        # lzf is HDF5 only, blosc lz4 is the closest fast codec
+        warning("Codec %s is not available for zarr, using blosc-lz4 instead." % codec)
+        compressor = numcodecs.Blosc(cname='lz4', clevel=5, shuffle=numcodecs.Blosc.SHUFFLE)
+
+    return {'chunks' : (settings['time_chunk'],) + tuple(frame_shape),
+            'compressor' : compressor}
+
+# zarr attributes are stored as JSON, so numpy values are converted first
+def zarr_attr(value):
+    '''Returns value as plain python types which can be saved as a zarr attribute.'''
+    return np.asarray(value).tolist()
+
+# writes an image stack to a zarr store, replacing it if it exists
+def save_zarr_stack(fov_id, peak_id, color, img_stack, kind):
+    '''Saves an image stack as a zarr array in the FOV store, using the array path
+    from stack_location. Each stack is its own directory of chunk files, so stacks
+    of different peaks and planes can be written by separate processes without locks.
+
+    Parameters
+    ----------
+    fov_id : int
+    peak_id : int
+        Dummy None value for empties.
+    color : str
+        Stack type, as for load_stack, such as 'c1', 'sub_c1', 'seg_otsu' or 'empty_c1'.
+    img_stack : np.ndarray
+        The stack to save. Shape is (t, y, x).
+    kind : str
+        'raw', 'sub' or 'seg', for the compression settings.
+
+    Returns
+    -------
+    z : zarr.Array
+        The saved array, so attributes can be added.
+    '''
+
+    filepath, dataset = stack_location(fov_id, peak_id, color)
+
+    # the FOV store and channel group are made if needed. Creating them in more than
+    # one process at once is fine, they just write the same small metadata file.
+    fov_group = zarr.open_group(filepath, mode='a')
+    if '/' in dataset:
+        fov_group.require_group(dataset.split('/')[0])
+
+    z = zarr.open_array(os.path.join(filepath, dataset), mode='w',
+                        shape=img_stack.shape, dtype=img_stack.dtype,
+                        **zarr_stack_options(kind, img_stack.shape[1:3]))
+    z[:] = img_stack
+
+    return z
+
+# adds frames to the end of a zarr image stack, making it if needed
+def append_zarr_stack(fov_id, peak_id, color, img_block, kind):
+    '''Appends a block of frames to a zarr image stack. Arguments are as for
+    save_zarr_stack. Only the chunks holding the new frames are written.
+    '''
+
+    filepath, dataset = stack_location(fov_id, peak_id, color)
+
+    fov_group = zarr.open_group(filepath, mode='a')
+    if '/' in dataset:
+        fov_group.require_group(dataset.split('/')[0])
+
+    # mode 'a' opens the array if it exists and only uses the shape when making it
+    z = zarr.open_array(os.path.join(filepath, dataset), mode='a',
+                        shape=(0,) + img_block.shape[1:], dtype=img_block.dtype,
+                        **zarr_stack_options(kind, img_block.shape[1:3]))
+    z.append(img_block, axis=0)
+
+    return
+
+# compression settings used for a stack
+def stack_kind(color):
+    '''Returns 'sub', 'seg' or 'raw', the kind of stack for the compression settings.'''
+    if 'sub' in color:
+        return 'sub'
+    if 'seg' in color:
+        return 'seg'
+    return 'raw'
+
+# reads and writes the image stacks of one FOV for any output type
+class StackStore():
+    '''
+    Reads and writes the image stacks of one FOV, for the TIFF, HDF5 or zarr output
+    set in params. Stages save their stacks through a store instead of handling each
+    output type, so a new output type only needs to be added here.
+
+    Stacks are named like for load_stack, by peak id and color, such as 'c1', 'sub_c1',
+    params['seg_img'] or 'empty_c1'. The compression settings follow from the color.
+
+    For HDF5 the FOV file is opened on the first write and kept open until close, and
+    it is flushed after each write. Use the store in a with statement so the file is
+    always closed:
+
+        with StackStore(fov_id) as store:
+            store.write(peak_id, 'sub_c1', subtracted_stack)
+    '''
+
+    def __init__(self, fov_id):
+        self.fov_id = fov_id
+        self.h5f = None # HDF5 file, open for writing
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        '''Closes the HDF5 file if it is open.'''
+        if self.h5f is not None:
+            self.h5f.close()
+            self.h5f = None
+
+    def h5_file(self):
+        '''Returns the HDF5 file for the FOV, opening it for writing if needed.'''
+        if self.h5f is None:
+            # read only handles to the file must be closed before it is opened for writing
+            stack_reader.release(self.fov_id)
+            self.h5f = h5py.File(os.path.join(params['hdf5_dir'], 'xy%03d.hdf5' % self.fov_id), 'r+')
+        return self.h5f
+
+    def read(self, peak_id, color, t_range=None, frames=None, roi=None):
+        '''Returns a stack, or part of it, like load_stack.'''
+
+        if self.h5f is not None:
+            # the file is open for writing, so read through the same handle
+            filepath, dataset = stack_location(self.fov_id, peak_id, color)
+            return stack_reader.read_dataset(self.h5f[dataset], t_range, frames, roi)
+
+        return load_stack(self.fov_id, peak_id, color=color,
+                          t_range=t_range, frames=frames, roi=roi)
+
+    def write(self, peak_id, color, img_stack, attrs=None):
+        '''Saves a stack, replacing it if it exists. attrs is a dictionary of attributes
+        saved with the stack for HDF5 and zarr output.'''
+
+        filepath, dataset = stack_location(self.fov_id, peak_id, color)
+        kind = stack_kind(color)
+
+        # drop cached copies of the old stack
+        stack_reader.release(self.fov_id)
+
+        if params['output'] == 'TIFF':
+            save_tiff_stack(filepath, img_stack)
+
+        elif params['output'] == 'HDF5':
+            h5f = self.h5_file()
+
+            # delete the dataset if it exists (important for debug)
+            if dataset in h5f:
+                del h5f[dataset]
+
+            h5ds = h5f.create_dataset(dataset, data=img_stack,
+                            maxshape=(None, img_stack.shape[1], img_stack.shape[2]),
+                            **hdf5_stack_options(kind, img_stack.shape[1:3]))
+            for key, value in six.iteritems(attrs or {}):
+                h5ds.attrs.create(key, value)
+            h5f.flush()
+
+        elif params['output'] == 'zarr':
+            z = save_zarr_stack(self.fov_id, peak_id, color, img_stack, kind)
+            z.attrs.update({key : zarr_attr(value) for key, value in six.iteritems(attrs or {})})
+
+    def append(self, peak_id, color, img_block):
+        '''Adds frames to the end of a stack, making the stack if it does not exist.
+        TIFF stacks can't be extended in place, so they are read and saved again.'''
+
+        filepath, dataset = stack_location(self.fov_id, peak_id, color)
+        kind = stack_kind(color)
+
+        if params['output'] == 'TIFF':
+            if os.path.exists(filepath):
+                img_block = np.concatenate([self.read(peak_id, color), img_block], axis=0)
+            self.write(peak_id, color, img_block)
+
+        elif params['output'] == 'HDF5':
+            stack_reader.release(self.fov_id)
+            h5f = self.h5_file()
+
+            if dataset not in h5f:
+                h5f.create_dataset(dataset,
+                            shape=(0, img_block.shape[1], img_block.shape[2]),
+                            dtype=img_block.dtype,
+                            maxshape=(None, img_block.shape[1], img_block.shape[2]),
+                            **hdf5_stack_options(kind, img_block.shape[1:3]))
+            append_hdf5_rows(h5f[dataset], img_block)
+            h5f.flush()
+
+        elif params['output'] == 'zarr':
+            stack_reader.release(self.fov_id)
+            append_zarr_stack(self.fov_id, peak_id, color, img_block, kind)
 
 # load the time table and add it to the global params
 def load_time_table():
     '''Add the time table dictionary to the params global dictionary.
     This is so it can be used during Cell creation.
+
+    The table is a dictionary of FOV : FOVTimeTable. It is read from time_table.npz,
+    or from the YAML or pickled dictionary if an older analysis has no .npz file.
     '''
 
-    # try first for yaml, then for pkl
+    # try first for npz, then for yaml, then for pkl
+    npz_path = os.path.join(params['ana_dir'], 'time_table.npz')
+    if os.path.exists(npz_path):
+        with np.load(npz_path) as arrays:
+            params['time_table'] = {int(name[2:]) : FOVTimeTable(arrays[name][0], arrays[name][1])
+                                    for name in arrays.files}
+        return params['time_table']
+
     try:
         with open(os.path.join(params['ana_dir'], 'time_table.yaml'), 'rb') as time_table_file:
-            params['time_table'] = yaml.safe_load(time_table_file)
+            time_table = yaml.safe_load(time_table_file)
     except:
         with open(os.path.join(params['ana_dir'], 'time_table.pkl'), 'rb') as time_table_file:
-            params['time_table'] = pickle.load(time_table_file)
+            time_table = pickle.load(time_table_file)
 
-    return
+    params['time_table'] = {int(fov) : FOVTimeTable(list(times.keys()), list(times.values()))
+                            for fov, times in six.iteritems(time_table)}
+
+    return params['time_table']
+
+# elapsed times of one FOV
+class FOVTimeTable():
+    '''
+    Elapsed time in seconds of each time index of one FOV. It is used like the
+    {t: seconds} dictionary of the YAML time table, so params['time_table'][fov][t]
+    works as before, but a lookup is an index into a list by t. All times of the
+    FOV are also available as the sorted arrays times and seconds.
+    '''
+
+    def __init__(self, times, seconds):
+        times = np.asarray(times, dtype='int64')
+        order = np.argsort(times)
+        self.times = times[order] # time indices
+        self.seconds = np.asarray(seconds, dtype='int64')[order] # elapsed seconds at each time index
+
+        # seconds by time index, None for time indices without an image
+        self.lookup = [None] * (int(self.times[-1]) + 1 if len(self.times) else 0)
+        for t, t_seconds in zip(self.times.tolist(), self.seconds.tolist()):
+            self.lookup[t] = t_seconds
+
+    def __getitem__(self, t):
+        if t >= 0:
+            try:
+                t_seconds = self.lookup[t]
+            except IndexError:
+                t_seconds = None
+            if t_seconds is not None:
+                return t_seconds
+        raise KeyError(t)
+
+    def __contains__(self, t):
+        return 0 <= t < len(self.lookup) and self.lookup[t] is not None
+
+    def __iter__(self):
+        return iter(self.times.tolist())
+
+    def __len__(self):
+        return len(self.times)
+
+    def get(self, t, default=None):
+        return self[t] if t in self else default
+
+    def keys(self):
+        return self.times.tolist()
+
+    def values(self):
+        return self.seconds.tolist()
+
+    def items(self):
+        return list(zip(self.times.tolist(), self.seconds.tolist()))
+
+# all time indices in the time table
+def time_table_all_times():
+    '''Returns the sorted time indices which are in the time table of any FOV.'''
+    return np.unique(np.concatenate([times.times for times in params['time_table'].values()])).astype(np.int_)
 
 # function for loading the channel masks
 def load_channel_masks():
@@ -309,13 +998,14 @@ def get_initial_tif_params(image_filename):
     try:
         # open up file and get metadata
         with tiff.TiffFile(os.path.join(params['TIFF_dir'],image_filename)) as tif:
-            image_data = tif.asarray()
-            #print(image_data.shape) # uncomment for debug
-            #if len(image_data.shape) == 2:
-            #    img_shape = [image_data.shape[0],image_data.shape[1]]
+            # the shape comes from the tags, so the pixel data is never decoded
+            image_shape = tif.series[0].shape
+            #print(image_shape) # uncomment for debug
+            #if len(image_shape) == 2:
+            #    img_shape = [image_shape[0],image_shape[1]]
             #else:
-            img_shape = [image_data.shape[1],image_data.shape[2]]
-            plane_list = [str(i+1) for i in range(image_data.shape[0])]
+            img_shape = [image_shape[1],image_shape[2]]
+            plane_list = [str(i+1) for i in range(image_shape[0])]
             #print(plane_list) # uncomment for debug
 
             if params['TIFF_source'] == 'elements':
@@ -372,7 +1062,11 @@ def get_tif_params(image_filename, find_channels=True):
     try:
         # open up file and get metadata
         with tiff.TiffFile(os.path.join(params['TIFF_dir'],image_filename)) as tif:
-            image_data = tif.asarray()
+            # only decode the pixels if they are needed for channel finding
+            if find_channels:
+                image_data = tif.asarray()
+            else:
+                img_shape = list(tif.series[0].shape[-2:])
 
             if params['TIFF_source'] == 'elements':
                 image_metadata = get_tif_metadata_elements(tif)
@@ -383,15 +1077,8 @@ def get_tif_params(image_filename, find_channels=True):
 
         # look for channels if flagged
         if find_channels:
-            # fix the image orientation and get the number of planes
-            image_data = fix_orientation(image_data)
-
-            # if the image data has more than 1 plane restrict image_data to phase,
-            # which should have highest mean pixel data
-            if len(image_data.shape) > 2:
-                #ph_index = np.argmax([np.mean(image_data[ci]) for ci in range(image_data.shape[0])])
-                ph_index = int(params['phase_plane'][1:]) - 1
-                image_data = image_data[ph_index]
+            # fix the image orientation and restrict to the phase plane
+            image_data = channel_finding_image(image_data)
 
             # get shape of single plane
             img_shape = [image_data.shape[0], image_data.shape[1]]
@@ -402,16 +1089,20 @@ def get_tif_params(image_filename, find_channels=True):
         information('Analyzed %s' % image_filename)
 
         # return the file name, the data for the channels in that image, and the metadata
-        return {'filepath': os.path.join(params['TIFF_dir'], image_filename),
-                'fov' : image_metadata['fov'], # fov id
-                't' : image_metadata['t'], # time point
-                'jd' : image_metadata['jd'], # absolute julian time
-                'x' : image_metadata['x'], # x position on stage [um]
-                'y' : image_metadata['y'], # y position on stage [um]
-                'planes' : image_metadata['planes'], # list of plane names
-                'shape' : img_shape, # image shape x y in pixels
-                # 'channels' : {1 : {'A' : 1, 'B' : 2}, 2 : {'C' : 3, 'D' : 4}}}
-                'channels' : chnl_loc_dict} # dictionary of channel locations
+        image_params = {'filepath': os.path.join(params['TIFF_dir'], image_filename),
+                        'fov' : image_metadata['fov'], # fov id
+                        't' : image_metadata['t'], # time point
+                        'jd' : image_metadata['jd'], # absolute julian time
+                        'x' : image_metadata['x'], # x position on stage [um]
+                        'y' : image_metadata['y'], # y position on stage [um]
+                        'planes' : image_metadata['planes'], # list of plane names
+                        'shape' : img_shape} # image shape x y in pixels
+
+        # 'channels' : {1 : {'A' : 1, 'B' : 2}, 2 : {'C' : 3, 'D' : 4}}}
+        if find_channels:
+            image_params['channels'] = chnl_loc_dict # dictionary of channel locations
+
+        return image_params
 
     except:
         warning('Failed get_params for ' + image_filename.split("/")[-1])
@@ -420,6 +1111,135 @@ def get_tif_params(image_filename, find_channels=True):
         print(traceback.print_tb(sys.exc_info()[2]))
         return {'filepath': os.path.join(params['TIFF_dir'],image_filename), 'analyze_success': False}
 
+# the plane of a raw image which channels are found on
+def channel_finding_image(image_data):
+    '''Fixes the orientation of raw image data and returns only the phase plane.
+
+    Called by
+    get_tif_params
+    get_tif_drift
+    '''
+
+    # fix the image orientation and get the number of planes
+    image_data = fix_orientation(image_data)
+
+    # if the image data has more than 1 plane restrict image_data to phase,
+    # which should have highest mean pixel data
+    if len(image_data.shape) > 2:
+        #ph_index = np.argmax([np.mean(image_data[ci]) for ci in range(image_data.shape[0])])
+        ph_index = int(params['phase_plane'][1:]) - 1
+        image_data = image_data[ph_index]
+
+    return image_data
+
+# y and x projections of an image, used to measure drift
+def image_projections(image_data):
+    '''Returns the projections of an image onto the y and x axes, as floats.'''
+    return image_data.sum(axis=1).astype('float64'), image_data.sum(axis=0).astype('float64')
+
+# shift between two 1-D projections
+def projection_shift(ref_projection, projection, max_shift):
+    '''Returns the shift in pixels of projection relative to ref_projection, as the
+    peak of their cross-correlation within +/- max_shift. A positive shift means the
+    features in projection are at higher pixel positions.'''
+
+    ref_projection = ref_projection - ref_projection.mean()
+    projection = projection - projection.mean()
+
+    # cross-correlation by FFT, padded so shifts don't wrap around
+    n = len(ref_projection) + len(projection)
+    xcorr = np.fft.irfft(np.fft.rfft(projection, n) * np.conj(np.fft.rfft(ref_projection, n)), n)
+
+    # negative shifts are at the end of the array
+    shifts = np.arange(-max_shift, max_shift + 1)
+    return int(shifts[np.argmax(xcorr[shifts])])
+
+# translations of a stack of images by phase correlation
+def phase_correlation_shifts(img_stack, ref_index=0, max_shift=None, subpixel=True):
+    '''Returns the [y, x] shift in pixels of every image in a stack relative to one
+    reference image of the stack, as a (frames, 2) float array. All frames are
+    registered together with FFT phase correlation, so missing or odd features in
+    some frames don't matter as long as most of the image is the same. A positive
+    shift means the features are at higher pixel positions, as in projection_shift.
+
+    Parameters
+    ----------
+    img_stack : array
+        (frames, rows, columns) stack of one region through time.
+    ref_index : int
+        Frame the shifts are relative to.
+    max_shift : int
+        Largest shift in pixels looked for. None looks for any shift.
+    subpixel : bool
+        Refine the peak position with a parabola through its neighbors.
+    '''
+
+    img_stack = np.asarray(img_stack, dtype='float32')
+    n_frames, height, width = img_stack.shape
+    img_stack = img_stack - img_stack.mean(axis=(1,2), keepdims=True)
+
+    # taper the edges, which otherwise correlate with each other as if not shifted
+    window = np.outer(np.hanning(height), np.hanning(width)).astype('float32')
+    stack_fft = np.fft.rfft2(img_stack * window, axes=(1,2))
+
+    # normalized cross-power spectrum of each frame with the reference
+    cross_power = stack_fft * np.conj(stack_fft[ref_index])
+    cross_power /= np.maximum(np.abs(cross_power), 1e-12)
+    xcorr = np.fft.irfft2(cross_power, s=(height, width), axes=(1,2))
+
+    # shifts of each row and column of the correlation, negative shifts are at the end
+    row_shifts = np.fft.fftfreq(height) * height
+    col_shifts = np.fft.fftfreq(width) * width
+
+    if max_shift is None:
+        search = xcorr
+    else:
+        in_range = np.outer(np.abs(row_shifts) <= max_shift, np.abs(col_shifts) <= max_shift)
+        search = np.where(in_range, xcorr, -np.inf)
+    peak_rows, peak_cols = np.unravel_index(np.argmax(search.reshape(n_frames, -1), axis=1),
+                                            (height, width))
+
+    shifts = np.stack((row_shifts[peak_rows], col_shifts[peak_cols]), axis=1)
+
+    if subpixel:
+        frames = np.arange(n_frames)
+        peak = xcorr[frames, peak_rows, peak_cols]
+        neighbors = [(xcorr[frames, (peak_rows-1) % height, peak_cols],
+                      xcorr[frames, (peak_rows+1) % height, peak_cols]),
+                     (xcorr[frames, peak_rows, (peak_cols-1) % width],
+                      xcorr[frames, peak_rows, (peak_cols+1) % width])]
+        for axis, (before, after) in enumerate(neighbors):
+            curvature = before - 2*peak + after
+            with np.errstate(divide='ignore', invalid='ignore'):
+                offset = np.where(curvature < 0, 0.5 * (before - after) / curvature, 0)
+            shifts[:,axis] += np.clip(offset, -0.5, 0.5)
+
+    return shifts
+
+# drift of one raw image relative to a reference image
+def get_tif_drift(image_filename, ref_projections, max_shift):
+    '''Returns the [y, x] drift in pixels of the phase plane of a raw TIFF relative to
+    the reference projections made by image_projections, or None if the image could
+    not be read.
+
+    Called by
+    find_channels_sampled
+    '''
+
+    try:
+        with tiff.TiffFile(os.path.join(params['TIFF_dir'], image_filename)) as tif:
+            image_data = channel_finding_image(tif.asarray())
+
+        projection_y, projection_x = image_projections(image_data)
+        return [projection_shift(ref_projections[0], projection_y, max_shift),
+                projection_shift(ref_projections[1], projection_x, max_shift)]
+
+    except:
+        warning('Failed get_tif_drift for ' + image_filename.split("/")[-1])
+        print(sys.exc_info()[0])
+        print(sys.exc_info()[1])
+        return None
+
 # finds metdata in a tiff image which has been expoted with Nikon Elements.
 def get_tif_metadata_elements(tif):
     '''This function pulls out the metadata from a tif file and returns it as a dictionary.
@@ -587,6 +1407,162 @@ def get_tif_metadata_filename(tif):
 
     return idata
 
+# on-disk index of the metadata found by get_tif_params and get_initial_tif_params
+class TiffMetadataIndex():
+    '''
+    Persistent index of raw TIFF metadata, stored as an SQLite database in the analysis
+    directory. Each entry is keyed by file name and records the file size and
+    modification time when it was analyzed, so repeated runs only need to analyze new
+    or changed files. Entries can be queried by FOV and time without loading the rest.
+    The number of sampled images the channels were found from is also recorded, 0 when
+    they were found on the image itself, so changing channel_sample_frames finds the
+    channels again.
+
+    The metadata dictionary for each image is the same as returned by get_tif_params.
+    '''
+
+    def __init__(self, db_path=None):
+        if db_path is None:
+            db_path = os.path.join(params['ana_dir'], 'TIFF_metadata.db')
+        self.db_path = db_path
+
+        self.db = sqlite3.connect(self.db_path)
+        self.db.execute('''CREATE TABLE IF NOT EXISTS images (
+                               filename TEXT PRIMARY KEY,
+                               size INTEGER,
+                               mtime REAL,
+                               fov INTEGER,
+                               t INTEGER,
+                               has_channels INTEGER,
+                               metadata BLOB,
+                               channel_samples INTEGER DEFAULT 0)''')
+        # indexes made before channel sampling was recorded
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(images)')]
+        if 'channel_samples' not in columns:
+            self.db.execute('ALTER TABLE images ADD COLUMN channel_samples INTEGER DEFAULT 0')
+        self.db.execute('CREATE INDEX IF NOT EXISTS fov_t ON images (fov, t)')
+        self.db.commit()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def file_stat(self, filename):
+        '''Returns the (size, mtime) of a raw TIFF, used to check if an entry is stale.'''
+        stat = os.stat(os.path.join(params['TIFF_dir'], filename))
+        return stat.st_size, stat.st_mtime
+
+    def stale_files(self, filenames, channels=False):
+        '''Returns the file names which are not in the index, have changed on disk since
+        they were indexed, or failed analysis. If channels is True, entries without
+        channel locations, or whose channels were found with another
+        params['compile']['channel_sample_frames'], are also returned.
+        '''
+
+        channel_samples = int(params['compile']['channel_sample_frames'] or 0)
+
+        indexed = {}
+        for fn, size, mtime, has_channels, fov, samples in self.db.execute(
+                'SELECT filename, size, mtime, has_channels, fov, channel_samples FROM images'):
+            indexed[fn] = (size, mtime, has_channels, fov, samples)
+
+        stale = []
+        for fn in filenames:
+            if fn not in indexed:
+                stale.append(fn)
+                continue
+
+            size, mtime, has_channels, fov, samples = indexed[fn]
+            if (size, mtime) != self.file_stat(fn) or fov is None:
+                stale.append(fn)
+            elif channels and (not has_channels or (samples or 0) != channel_samples):
+                stale.append(fn)
+
+        return stale
+
+    def add(self, metadata_dict):
+        '''Adds or replaces entries. metadata_dict is keyed by file name.'''
+
+        rows = []
+        for fn, idata in six.iteritems(metadata_dict):
+            # failed analyses are stored without an fov so they are retried
+            if not idata or idata.get('analyze_success', True) == False:
+                fov, t = None, None
+            else:
+                fov, t = int(idata['fov']), int(idata['t'])
+            size, mtime = self.file_stat(fn)
+            has_channels = int(bool(idata) and 'channels' in idata)
+            channel_samples = int(idata.get('channel_samples') or 0) if idata else 0
+            rows.append((fn, size, mtime, fov, t, has_channels,
+                         sqlite3.Binary(pickle.dumps(idata, protocol=pickle.HIGHEST_PROTOCOL)),
+                         channel_samples))
+
+        self.db.executemany('''INSERT OR REPLACE INTO images (filename, size, mtime, fov, t,
+                               has_channels, metadata, channel_samples)
+                               VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', rows)
+        self.db.commit()
+
+        return
+
+    def get(self, filename):
+        '''Returns the metadata dictionary for one file, or None if it is not indexed.'''
+
+        row = self.db.execute('SELECT metadata FROM images WHERE filename = ?',
+                              (filename,)).fetchone()
+        if row is None:
+            return None
+
+        return pickle.loads(bytes(row[0]))
+
+    def to_dict(self, filenames=None):
+        '''Returns the metadata for the given file names, or all entries, as a
+        dictionary in the same form as analyzed_imgs.
+        '''
+
+        analyzed_imgs = {}
+        for fn, blob in self.db.execute('SELECT filename, metadata FROM images'):
+            analyzed_imgs[fn] = blob
+
+        if filenames is not None:
+            analyzed_imgs = {fn : analyzed_imgs[fn] for fn in filenames if fn in analyzed_imgs}
+
+        return {fn : pickle.loads(bytes(blob)) for fn, blob in six.iteritems(analyzed_imgs)}
+
+    def query(self, fov_id=None, t_start=None, t_end=None):
+        '''Returns metadata for images of one FOV and/or between two time points
+        (inclusive) as a dictionary in the same form as analyzed_imgs.
+        '''
+
+        conditions = ['fov IS NOT NULL']
+        values = []
+        if fov_id is not None:
+            conditions.append('fov = ?')
+            values.append(int(fov_id))
+        if t_start is not None:
+            conditions.append('t >= ?')
+            values.append(int(t_start))
+        if t_end is not None:
+            conditions.append('t <= ?')
+            values.append(int(t_end))
+
+        sql = 'SELECT filename, metadata FROM images WHERE ' + ' AND '.join(conditions) + ' ORDER BY fov, t'
+
+        return collections.OrderedDict((fn, pickle.loads(bytes(blob)))
+                                       for fn, blob in self.db.execute(sql, values))
+
+    def fovs(self):
+        '''Returns the sorted FOV ids in the index.'''
+        return [row[0] for row in self.db.execute(
+                'SELECT DISTINCT fov FROM images WHERE fov IS NOT NULL ORDER BY fov')]
+
 # make a lookup time table for converting nominal time to elapsed time in seconds
 def make_time_table(analyzed_imgs):
     '''
@@ -640,12 +1616,30 @@ def make_time_table(analyzed_imgs):
     #     pickle.dump(time_table, time_table_file, protocol=pickle.HIGHEST_PROTOCOL)
     # with open(os.path.join(params['ana_dir'], 'time_table.txt'), 'w') as time_table_file:
     #     pprint(time_table, stream=time_table_file)
-    with open(os.path.join(params['ana_dir'], 'time_table.yaml'), 'w') as time_table_file:
-        yaml.dump(data=time_table, stream=time_table_file, default_flow_style=False, tags=None)
+    time_table = {fov : FOVTimeTable(list(times.keys()), list(times.values()))
+                  for fov, times in six.iteritems(time_table)}
+    save_time_table(time_table)
     information('Time table saved.')
 
     return time_table
 
+# saves the time table as binary arrays, and as YAML for reading
+def save_time_table(time_table):
+    '''Saves the time table made by make_time_table to time_table.npz in the analysis
+    directory, which load_time_table reads quickly. The same table is exported to
+    time_table.yaml as a {fov: {t: seconds}} dictionary for humans and other tools.'''
+
+    # one (2, n) array of time indices and seconds per FOV
+    arrays = {'xy%03d' % fov : np.stack((times.times, times.seconds))
+              for fov, times in six.iteritems(time_table)}
+    np.savez(os.path.join(params['ana_dir'], 'time_table.npz'), **arrays)
+
+    with open(os.path.join(params['ana_dir'], 'time_table.yaml'), 'w') as time_table_file:
+        yaml.dump(data={int(fov) : dict(times.items()) for fov, times in six.iteritems(time_table)},
+                  stream=time_table_file, default_flow_style=False, tags=None)
+
+    return
+
 # saves traps sliced via Unet
 def save_tiffs(imgDict, analyzed_imgs, fov_id):
 
@@ -664,7 +1658,7 @@ def save_tiffs(imgDict, analyzed_imgs, fov_id):
         for planeNumber in image_params['planes']:
 
             channel_filename = os.path.join(savePath, params['experiment_name'] + '_xy{0:0=3}_p{1:0=4}_c{2}.tif'.format(fov_id, peak, planeNumber))
-            io.imsave(channel_filename, img[:,:,:,int(planeNumber)-1])
+            save_tiff_stack(channel_filename, img[:,:,:,int(planeNumber)-1], compress=0)
 
 # slice_and_write cuts up the image files one at a time and writes them out to tiff stacks
 def tiff_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs):
@@ -729,7 +1723,7 @@ def tiff_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs):
             # # chnl_dir and p will be looked for in the scope above (__main__)
             channel_filename = os.path.join(params['chnl_dir'], params['experiment_name'] + '_xy%03d_p%04d_c%1d.tif' % (fov_id, peak, color_index+1))
             # save stack
-            tiff.imsave(channel_filename, channel_stack[:,:,:,color_index], compress=4)
+            save_tiff_stack(channel_filename, channel_stack[:,:,:,color_index], compress=4)
 
     return
 
@@ -807,9 +1801,8 @@ def save_hdf5(imgDict, img_names, analyzed_imgs, fov_id, channel_masks):
                 # create the dataset for the image. Review docs for these options.
                 h5ds = h5g.create_dataset(u'p%04d_c%1d' % (peak, color_index+1),
                                 data=channel_stack[:,:,:,color_index],
-                                chunks=(1, channel_stack.shape[1], channel_stack.shape[2]),
                                 maxshape=(None, channel_stack.shape[1], channel_stack.shape[2]),
-                                compression="gzip", shuffle=True, fletcher32=True)
+                                **hdf5_stack_options('raw', channel_stack.shape[1:3]))
 
                 # h5ds.attrs.create('plane', image_planes[color_index].encode('utf8'))
 
@@ -876,6 +1869,8 @@ def hdf5_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs):
     # concatenate the list into one big ass stack
     image_fov_stack = np.stack(image_fov_stack, axis=0)
 
+    stack_reader.release(fov_id)
+
     # create the HDF5 file for the FOV, first time this is being done.
     with h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % fov_id), 'w', libver='earliest') as h5f:
 
@@ -927,9 +1922,8 @@ def hdf5_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs):
                 # create the dataset for the image. Review docs for these options.
                 h5ds = h5g.create_dataset(u'p%04d_c%1d' % (peak, color_index+1),
                                 data=channel_stack[:,:,:,color_index],
-                                chunks=(1, channel_stack.shape[1], channel_stack.shape[2]),
                                 maxshape=(None, channel_stack.shape[1], channel_stack.shape[2]),
-                                compression="gzip", shuffle=True, fletcher32=True)
+                                **hdf5_stack_options('raw', channel_stack.shape[1:3]))
 
                 # h5ds.attrs.create('plane', image_planes[color_index].encode('utf8'))
 
@@ -938,111 +1932,611 @@ def hdf5_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs):
 
     return
 
-def tileImage(img, subImageNumber):
-    divisor = int(np.sqrt(subImageNumber))
-    M = img.shape[0]//divisor
-    N = img.shape[0]//divisor
-    #print(img.shape, M, N, divisor, subImageNumber)
-    tiles = np.asarray([img[x:x+M,y:y+N] for x in range(0,img.shape[0],M) for y in range(0,img.shape[1],N)])
-    return(tiles)
-
-def get_weights(img, subImageNumber):
-    divisor = int(np.sqrt(subImageNumber))
-    M = img.shape[0]//divisor
-    N = img.shape[0]//divisor
-    weights = np.ones((img.shape[0],img.shape[1]),dtype='uint8')
-    for i in range(divisor-1):
-        weights[(M*(i+1))-25:(M*(i+1)+25),:] = 0
-        weights[:,(N*(i+1))-25:(N*(i+1)+25)] = 0
-    return(weights)
-
-def permute_image(img, trap_align_metadata):
-    # are there three dimensions?
-    if len(img.shape) == 3:
-        if img.shape[0] < 3: # for tifs with fewer than three imageing channels, the first dimension separates channels
-            # img = np.transpose(img, (1,2,0))
-            img = img[trap_align_metadata['phase_plane_index'],:,:] # grab just the phase channel
-        else:
-            img = img[:,:,trap_align_metadata['phase_plane_index']] # grab just the phase channel
+# loads a raw TIFF and puts it in the orientation and axis order used for slicing
+def load_tif_for_slicing(filepath):
+    '''Loads one raw TIFF, fixes its orientation, and returns it with axes (y, x, plane).
+    This is the per image preparation done by tiff_stack_slice_and_write.
 
-    return(img)
+    Called by
+    load_fov_image_blocks
+    '''
 
-def imageConcatenatorFeatures(imgStack, subImageNumber = 64):
+    with tiff.TiffFile(filepath) as tif:
+        image_data = tif.asarray()
 
-    rowNumPerImage = int(np.sqrt(subImageNumber)) # here I'm assuming our large images are square, with equal number of crops in each dimension
-    #print(rowNumPerImage)
-    imageNum = int(imgStack.shape[0]/subImageNumber) # total number of sub-images divided by the number of sub-images in each original large image
-    iterNum = int(imageNum*rowNumPerImage)
-    imageDims = int(np.sqrt(imgStack.shape[1]*imgStack.shape[2]*subImageNumber))
-    featureNum = int(imgStack.shape[3])
-    bigImg = np.zeros(shape=(imageNum, imageDims, imageDims, featureNum), dtype='float32') # create array to store reconstructed images
+    return prepare_image_for_slicing(image_data)
 
-    featureRowDicts = []
+# puts raw image data in the orientation and axis order used for slicing
+def prepare_image_for_slicing(image_data):
+    '''Fixes the orientation of raw image data with axes (plane, y, x) or (y, x) and
+    returns it with axes (y, x, plane).
 
-    for j in range(featureNum):
+    Called by
+    load_tif_for_slicing
+    aux/mm3_nd2ToTIFF.py
+    '''
 
-        rowDict = {}
+    # channel finding was also done on images after orientation was fixed
+    image_data = fix_orientation(image_data)
 
-        for i in range(iterNum):
-            baseNum = int(i*iterNum/imageNum)
-            # concatenate columns of 256x256 images to build each 256x2048 row
-            rowDict[i] = np.column_stack((imgStack[baseNum,:,:,j],imgStack[baseNum+1,:,:,j],
-                                          imgStack[baseNum+2,:,:,j], imgStack[baseNum+3,:,:,j]))#,
-                                          #imgStack[baseNum+4,:,:,j],imgStack[baseNum+5,:,:,j],
-                                          #imgStack[baseNum+6,:,:,j],imgStack[baseNum+7,:,:,j]))
-        featureRowDicts.append(rowDict)
+    # add additional axis if the image is flat
+    if len(image_data.shape) == 2:
+        image_data = np.expand_dims(image_data, 0)
 
-    for j in range(featureNum):
+    # change axis so it goes Y, X, Plane
+    image_data = np.rollaxis(image_data, 0, 3)
 
-        for i in range(imageNum):
-            baseNum = int(i*rowNumPerImage)
-            # concatenate appropriate 256x2048 rows to build a 2048x2048 image and place it into bigImg
-            bigImg[i,:,:,j] = np.row_stack((featureRowDicts[j][baseNum],featureRowDicts[j][baseNum+1],
-                                            featureRowDicts[j][baseNum+2],featureRowDicts[j][baseNum+3]))#,
-                                            #featureRowDicts[j][baseNum+4],featureRowDicts[j][baseNum+5],
-                                            #featureRowDicts[j][baseNum+6],featureRowDicts[j][baseNum+7]))
+    return image_data
 
-    return(bigImg)
+# yields the images of an FOV a block of time points at a time
+def load_fov_image_blocks(images_to_write, analyzed_imgs, block_size):
+    '''Generator which loads the images of one FOV in blocks of time points.
+    Only one block is held in memory at a time.
 
-def imageConcatenatorFeatures2(imgStack, subImageNumber = 81):
+    Parameters
+    ----------
+    images_to_write : list
+        List of [filename, t] pairs for one FOV, sorted by time.
+    analyzed_imgs : dict
+        Image metadata dictionary as made by get_tif_params.
+    block_size : int
+        Number of time points to load per block.
+
+    Yields
+    ------
+    block_names : list
+        The filenames of the images in this block.
+    image_block : np.ndarray
+        The image data for this block. Shape is (t, y, x, plane).
+
+    Called by
+    tiff_stack_slice_and_write_blocks
+    hdf5_stack_slice_and_write_blocks
+    '''
+
+    for block_start in range(0, len(images_to_write), block_size):
+        block_names = []
+        image_block = []
+
+        for image in images_to_write[block_start:block_start+block_size]:
+            image_params = analyzed_imgs[image[0]]
+            information("Loading %s." % image_params['filepath'].split('/')[-1])
+
+            block_names.append(image[0])
+            image_block.append(load_tif_for_slicing(image_params['filepath']))
+
+        yield block_names, np.stack(image_block, axis=0)
+
+# streaming version of tiff_stack_slice_and_write with memory set by the block size
+def tiff_stack_slice_and_write_blocks(images_to_write, channel_masks, analyzed_imgs,
+                                      block_size=None):
+    '''Writes out stacks of TIFF images per channel, like tiff_stack_slice_and_write,
+    but loads and slices the raw images a block of time points at a time.
+
+    Sliced blocks are spooled to an uncompressed memory mapped .npy file per channel in
+    the channel directory, which is then written to the final TIFF stacks and removed.
+    Peak memory thus depends on the block size and not on the length of the experiment.
+
+    Parameters
+    ----------
+    images_to_write : list
+        List of [filename, t] pairs for one FOV, sorted by time.
+    channel_masks : dict
+        Channel masks as made by make_masks.
+    analyzed_imgs : dict
+        Image metadata dictionary as made by get_tif_params.
+    block_size : int
+        Number of time points to load at once. Defaults to params['compile']['slicing_block_size'].
+
+    Called by
+    mm3_Compile.py
+    '''
+
+    if block_size is None:
+        block_size = params['compile']['slicing_block_size']
 
-    rowNumPerImage = int(np.sqrt(subImageNumber)) # here I'm assuming our large images are square, with equal number of crops in each dimension
-    imageNum = int(imgStack.shape[0]/subImageNumber) # total number of sub-images divided by the number of sub-images in each original large image
-    iterNum = int(imageNum*rowNumPerImage)
-    imageDims = int(np.sqrt(imgStack.shape[1]*imgStack.shape[2]*subImageNumber))
-    featureNum = int(imgStack.shape[3])
-    bigImg = np.zeros(shape=(imageNum, imageDims, imageDims, featureNum), dtype='float32') # create array to store reconstructed images
+    fov_id = analyzed_imgs[images_to_write[0][0]]['fov']
+    n_times = len(images_to_write)
 
-    featureRowDicts = []
+    spool_stacks = {} # memory mapped stacks for each peak, made with the first block
+    t_index = 0
+    for block_names, image_block in load_fov_image_blocks(images_to_write, analyzed_imgs, block_size):
+        for peak, channel_loc in six.iteritems(channel_masks[fov_id]):
+            channel_block = cut_slice(image_block, channel_loc)
+
+            if peak not in spool_stacks:
+                spool_filename = os.path.join(params['chnl_dir'],
+                    params['experiment_name'] + '_xy%03d_p%04d_spool.npy' % (fov_id, peak))
+                spool_stacks[peak] = np.lib.format.open_memmap(spool_filename, mode='w+',
+                    dtype=channel_block.dtype, shape=(n_times,) + channel_block.shape[1:])
+
+            spool_stacks[peak][t_index:t_index+channel_block.shape[0]] = channel_block
+
+        t_index += image_block.shape[0]
+        del image_block
+
+    # write the spooled channels out to the TIFF stacks one at a time
+    for peak, spool_stack in six.iteritems(spool_stacks):
+        information('Saving channel peak %d.' % peak)
+
+        for color_index in range(spool_stack.shape[3]):
+            channel_filename = os.path.join(params['chnl_dir'], params['experiment_name'] + '_xy%03d_p%04d_c%1d.tif' % (fov_id, peak, color_index+1))
+            save_tiff_stack(channel_filename, np.ascontiguousarray(spool_stack[:,:,:,color_index]), compress=4)
 
-    for j in range(featureNum):
+        spool_filename = spool_stack.filename
+        del spool_stack
+        spool_stacks[peak] = None
+        os.remove(spool_filename)
 
-        rowDict = {}
+    return
+
+# streaming version of hdf5_stack_slice_and_write with memory set by the block size
+def hdf5_stack_slice_and_write_blocks(images_to_write, channel_masks, analyzed_imgs,
+                                      block_size=None, append=False, image_blocks=None):
+    '''Writes out stacks of images per channel to an HDF5 file, like
+    hdf5_stack_slice_and_write, but loads and slices the raw images a block of
+    time points at a time and appends each block to the resizable datasets.
+    Peak memory thus depends on the block size and not on the length of the experiment.
+
+    Parameters
+    ----------
+    images_to_write : list
+        List of [filename, t] pairs for one FOV, sorted by time.
+    channel_masks : dict
+        Channel masks as made by make_masks.
+    analyzed_imgs : dict
+        Image metadata dictionary as made by get_tif_params.
+    block_size : int
+        Number of time points to load at once. Defaults to params['compile']['slicing_block_size'].
+    append : bool
+        If True, add to an existing HDF5 file for the FOV instead of overwriting it.
+        Images whose file names are already in the file are skipped.
+    image_blocks : iterable
+        Blocks of (block_names, image_block) to slice instead of loading the raw TIFFs,
+        in the form yielded by load_fov_image_blocks. Not used with append.
+
+    Called by
+    mm3_Compile.py
+    follow_acquisition
+    '''
+
+    if block_size is None:
+        block_size = params['compile']['slicing_block_size']
+
+    # declare identification variables for saving using first image
+    image_params = analyzed_imgs[images_to_write[0][0]]
+    fov_id = image_params['fov']
+
+    stack_reader.release(fov_id)
+
+    h5_mode = 'a' if append else 'w'
+    with h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % fov_id), h5_mode, libver='earliest') as h5f:
+
+        # add in metadata for this FOV
+        # these attributes should be common for all channel
+        if 'fov_id' not in h5f.attrs:
+            h5f.attrs.create('fov_id', fov_id)
+            h5f.attrs.create('stage_x_loc', image_params['x'])
+            h5f.attrs.create('stage_y_loc', image_params['y'])
+            h5f.attrs.create('image_shape', image_params['shape'])
+            # encoding is because HDF5 has problems with numpy unicode
+            h5f.attrs.create('planes', [plane.encode('utf8') for plane in image_params['planes']])
+            h5f.attrs.create('peaks', sorted(channel_masks[fov_id].keys()))
+
+        # time datasets start empty and grow with each block
+        if u'filenames' not in h5f:
+            h5f.create_dataset(u'filenames', shape=(0, 1),
+                               chunks=True, maxshape=(None, 1), dtype='S100',
+                               compression="gzip", shuffle=True, fletcher32=True)
+            h5f.create_dataset(u'times', shape=(0, 1), dtype='int64',
+                               chunks=True, maxshape=(None, 1),
+                               compression="gzip", shuffle=True, fletcher32=True)
+            h5f.create_dataset(u'times_jd', shape=(0, 1), dtype='float64',
+                               chunks=True, maxshape=(None, 1),
+                               compression="gzip", shuffle=True, fletcher32=True)
+
+        # skip images which have already been written
+        written_files = set(fn.decode('utf8') for fn in h5f[u'filenames'][:,0])
+        images_to_write = [image for image in images_to_write if image[0] not in written_files]
+
+        for peak, channel_loc in six.iteritems(channel_masks[fov_id]):
+            if 'channel_%04d' % peak in h5f:
+                continue
+
+            # create group for this channel
+            h5g = h5f.create_group('channel_%04d' % peak)
+
+            # add attribute for peak_id, channel location
+            h5g.attrs.create('peak_id', peak)
+            h5g.attrs.create('channel_loc', channel_loc)
 
-        for i in range(iterNum):
-            baseNum = int(i*iterNum/imageNum)
-            # concatenate columns of 256x256 images to build each 256x2048 row
-            rowDict[i] = np.column_stack((imgStack[baseNum,:,:,j],imgStack[baseNum+1,:,:,j],
-                                          imgStack[baseNum+2,:,:,j], imgStack[baseNum+3,:,:,j],
-                                          imgStack[baseNum+4,:,:,j]))#,imgStack[baseNum+5,:,:,j],
-                                          #imgStack[baseNum+6,:,:,j],imgStack[baseNum+7,:,:,j],
-                                         #imgStack[baseNum+8,:,:,j]))
-        featureRowDicts.append(rowDict)
+        if image_blocks is None:
+            image_blocks = load_fov_image_blocks(images_to_write, analyzed_imgs, block_size)
 
-    for j in range(featureNum):
+        for block_names, image_block in image_blocks:
+            information('Slicing and saving %d time points.' % image_block.shape[0])
 
-        for i in range(imageNum):
-            baseNum = int(i*rowNumPerImage)
-            # concatenate appropriate 256x2048 rows to build a 2048x2048 image and place it into bigImg
-            bigImg[i,:,:,j] = np.row_stack((featureRowDicts[j][baseNum],featureRowDicts[j][baseNum+1],
-                                            featureRowDicts[j][baseNum+2],featureRowDicts[j][baseNum+3],
-                                            featureRowDicts[j][baseNum+4]))#,featureRowDicts[j][baseNum+5],
-                                            #featureRowDicts[j][baseNum+6],featureRowDicts[j][baseNum+7],
-                                            #featureRowDicts[j][baseNum+8]))
+            append_hdf5_rows(h5f[u'filenames'], np.expand_dims(block_names, 1).astype('S100'))
+            append_hdf5_rows(h5f[u'times'],
+                np.expand_dims([analyzed_imgs[fn]['t'] for fn in block_names], 1))
+            append_hdf5_rows(h5f[u'times_jd'],
+                np.expand_dims([analyzed_imgs[fn]['jd'] for fn in block_names], 1))
 
-    return(bigImg)
+            # cut out the channels as per channel masks for this fov
+            for peak, channel_loc in six.iteritems(channel_masks[fov_id]):
+                h5g = h5f['channel_%04d' % peak]
+                channel_block = cut_slice(image_block, channel_loc)
+
+                # save a different dataset for all colors
+                for color_index in range(channel_block.shape[3]):
+                    ds_name = u'p%04d_c%1d' % (peak, color_index+1)
+                    if ds_name not in h5g:
+                        h5g.create_dataset(ds_name,
+                            shape=(0, channel_block.shape[1], channel_block.shape[2]),
+                            dtype=channel_block.dtype,
+                            maxshape=(None, channel_block.shape[1], channel_block.shape[2]),
+                            **hdf5_stack_options('raw', channel_block.shape[1:3]))
+
+                    append_hdf5_rows(h5g[ds_name], channel_block[:,:,:,color_index])
+
+            # write the data even though we have more to write (free up memory)
+            h5f.flush()
+            del image_block
+
+    return
+
+# zarr version of hdf5_stack_slice_and_write_blocks
+def zarr_stack_slice_and_write_blocks(images_to_write, channel_masks, analyzed_imgs,
+                                      block_size=None, image_blocks=None):
+    '''Writes out stacks of images per channel to a zarr store for the FOV, with the
+    same layout and attributes as the HDF5 files. The raw images are loaded a block of
+    time points at a time, and each block is appended to one array per peak and plane.
+    The whole FOV is loaded at once if no block size is given.
+
+    Parameters
+    ----------
+    images_to_write : list
+        List of [filename, t] pairs for one FOV, sorted by time.
+    channel_masks : dict
+        Channel masks as made by make_masks.
+    analyzed_imgs : dict
+        Image metadata dictionary as made by get_tif_params.
+    block_size : int
+        Number of time points to load at once.
+    image_blocks : iterable
+        Blocks of (block_names, image_block) to slice instead of loading the raw TIFFs,
+        in the form yielded by load_fov_image_blocks.
+
+    Called by
+    mm3_Compile.py
+    slice_and_write_fov
+    '''
+
+    if not block_size:
+        block_size = len(images_to_write)
+
+    # declare identification variables for saving using first image
+    image_params = analyzed_imgs[images_to_write[0][0]]
+    fov_id = image_params['fov']
+
+    stack_reader.release(fov_id)
+
+    # mode 'w' removes anything saved for this FOV before
+    fov_group = zarr.open_group(zarr_fov_path(fov_id), mode='w')
+    fov_group.attrs.update({'fov_id' : zarr_attr(fov_id),
+                            'stage_x_loc' : zarr_attr(image_params['x']),
+                            'stage_y_loc' : zarr_attr(image_params['y']),
+                            'image_shape' : zarr_attr(image_params['shape']),
+                            'planes' : list(image_params['planes']),
+                            'peaks' : zarr_attr(sorted(channel_masks[fov_id].keys()))})
+
+    # time arrays start empty and grow with each block
+    fov_group.create_dataset('filenames', shape=(0, 1), chunks=(1024, 1), dtype='S100')
+    fov_group.create_dataset('times', shape=(0, 1), chunks=(1024, 1), dtype='int64')
+    fov_group.create_dataset('times_jd', shape=(0, 1), chunks=(1024, 1), dtype='float64')
+
+    for peak, channel_loc in six.iteritems(channel_masks[fov_id]):
+        z_group = fov_group.create_group('channel_%04d' % peak)
+        z_group.attrs.update({'peak_id' : zarr_attr(peak),
+                              'channel_loc' : zarr_attr(channel_loc)})
+
+    if image_blocks is None:
+        image_blocks = load_fov_image_blocks(images_to_write, analyzed_imgs, block_size)
+
+    for block_names, image_block in image_blocks:
+        information('Slicing and saving %d time points.' % image_block.shape[0])
+
+        fov_group['filenames'].append(np.expand_dims(block_names, 1).astype('S100'))
+        fov_group['times'].append(
+            np.expand_dims([analyzed_imgs[fn]['t'] for fn in block_names], 1).astype('int64'))
+        fov_group['times_jd'].append(
+            np.expand_dims([analyzed_imgs[fn]['jd'] for fn in block_names], 1).astype('float64'))
+
+        # cut out the channels as per channel masks for this fov
+        for peak, channel_loc in six.iteritems(channel_masks[fov_id]):
+            channel_block = cut_slice(image_block, channel_loc)
+
+            # save a different array for all colors
+            for color_index in range(channel_block.shape[3]):
+                append_zarr_stack(fov_id, peak, 'c%1d' % (color_index+1),
+                                  channel_block[:,:,:,color_index], 'raw')
+
+        del image_block
+
+    return
+
+# zarr version of save_hdf5, for traps found and cropped by the U-net
+def save_zarr(imgDict, img_names, analyzed_imgs, fov_id, channel_masks):
+    '''Writes out 4D stacks of cropped trap images to a zarr store for the FOV.
+
+    Called by
+    mm3_Compile.py
+    '''
+
+    image_params = analyzed_imgs[img_names[0]]
+    fov_id = image_params['fov']
+
+    stack_reader.release(fov_id)
+
+    fov_group = zarr.open_group(zarr_fov_path(fov_id), mode='w')
+    fov_group.attrs.update({'fov_id' : zarr_attr(fov_id),
+                            'stage_x_loc' : zarr_attr(image_params['x']),
+                            'stage_y_loc' : zarr_attr(image_params['y']),
+                            'image_shape' : zarr_attr(image_params['shape']),
+                            'planes' : list(image_params['planes']),
+                            'peaks' : zarr_attr(sorted(imgDict.keys()))})
+
+    fov_group.create_dataset('filenames', data=np.expand_dims(img_names, 1).astype('S100'))
+    fov_group.create_dataset('times',
+        data=np.expand_dims([analyzed_imgs[key]['t'] for key in img_names], 1).astype('int64'))
+    fov_group.create_dataset('times_jd',
+        data=np.expand_dims([analyzed_imgs[key]['jd'] for key in img_names], 1).astype('float64'))
+
+    for peak, channel_stack in six.iteritems(imgDict):
+        channel_stack = channel_stack.astype('uint16')
+
+        z_group = fov_group.create_group('channel_%04d' % peak)
+        z_group.attrs.update({'peak_id' : zarr_attr(peak),
+                              'channel_loc' : zarr_attr(channel_masks[fov_id][peak])})
+
+        for color_index in range(channel_stack.shape[3]):
+            save_zarr_stack(fov_id, peak, 'c%1d' % (color_index+1),
+                            channel_stack[:,:,:,color_index], 'raw')
+
+    return
+
+# slices and writes all the images of one FOV. Used as the worker for parallel slicing
+def slice_and_write_fov(images_to_write, channel_masks, analyzed_imgs, block_size=None):
+    '''Slices one FOV with the writer for the output type, streaming the images in blocks
+    if block_size is given. Returns the FOV id, number of images and the time taken so
+    the caller can report progress.
+
+    Called by
+    mm3_Compile.py
+    '''
+
+    start_time = time.time()
+    fov_id = analyzed_imgs[images_to_write[0][0]]['fov']
+
+    if block_size:
+        if params['output'] == 'TIFF':
+            tiff_stack_slice_and_write_blocks(images_to_write, channel_masks, analyzed_imgs, block_size)
+        elif params['output'] == 'HDF5':
+            hdf5_stack_slice_and_write_blocks(images_to_write, channel_masks, analyzed_imgs, block_size)
+        elif params['output'] == 'zarr':
+            zarr_stack_slice_and_write_blocks(images_to_write, channel_masks, analyzed_imgs, block_size)
+    else:
+        if params['output'] == 'TIFF':
+            tiff_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs)
+        elif params['output'] == 'HDF5':
+            hdf5_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs)
+        elif params['output'] == 'zarr':
+            zarr_stack_slice_and_write_blocks(images_to_write, channel_masks, analyzed_imgs)
+
+    return fov_id, len(images_to_write), time.time() - start_time
+
+# how many time points can be sliced at once within a memory budget
+def slicing_block_size_for_memory(image_params, memory_gb):
+    '''Returns the number of time points per block which keeps one slicing process
+    under memory_gb gigabytes, based on the image shape and number of planes.
+    '''
+
+    n_planes = max(len(image_params['planes']), 1)
+    frame_bytes = image_params['shape'][0] * image_params['shape'][1] * n_planes * 2 # uint16
+
+    # a block is held twice while it is stacked, plus once more as channel slices
+    return max(1, int(memory_gb * 1024**3 / (3 * frame_bytes)))
+
+# compile images into the HDF5 files while the microscope is still acquiring them
+def follow_acquisition(channel_masks, fov_ids=None, metadata_index=None, t_start=None, t_end=None):
+    '''
+    Watches the TIFF directory for new images and slices them as they arrive, appending
+    them to the per FOV HDF5 files along with their file names and times. The time table
+    is remade after each batch of new images. Returns when no new images have arrived
+    for params['compile']['follow_timeout'] seconds.
+
+    Only consensus channel masks (find_channels_method: 'peaks') and HDF5 output are
+    supported, as the masks are applied unchanged to the new images.
+
+    Parameters
+    ----------
+    channel_masks : dict
+        Channel masks as made by make_masks or loaded by load_channel_masks.
+    fov_ids : list
+        Only follow these FOVs. All FOVs in channel_masks are followed if empty or None.
+    metadata_index : TiffMetadataIndex
+        Index to check for and record new images. Opened in the analysis directory if None.
+    t_start, t_end : int
+        Only images from time point t_start up to, but not including, t_end are compiled,
+        as for the compile parameters of the same names. No limit if None.
+
+    Called by
+    mm3_Compile.py
+    '''
+
+    poll_interval = params['compile']['follow_poll_interval']
+    timeout = params['compile']['follow_timeout']
+    # new images per poll are few, so a small block keeps memory low when catching up
+    block_size = params['compile']['slicing_block_size'] or 20
+
+    if not fov_ids:
+        fov_ids = sorted(channel_masks.keys())
+
+    if metadata_index is None:
+        metadata_index = TiffMetadataIndex()
+
+    def in_time_window(fn):
+        t = get_time(fn)
+        if t is None:
+            return False
+        return (t_start is None or t >= t_start) and (t_end is None or t < t_end)
+
+    def indexed_imgs():
+        '''All compiled images in the index within the time window, of every FOV.'''
+        return {fn : idata for fn, idata in six.iteritems(metadata_index.to_dict())
+                if 'fov' in idata and in_time_window(fn)}
+
+    # all images so far for these FOVs
+    analyzed_imgs = {fn : idata for fn, idata in six.iteritems(indexed_imgs())
+                     if idata['fov'] in fov_ids}
+    # images in the index are compiled on the first pass in case they were never sliced
+    fovs_to_write = set(idata['fov'] for idata in analyzed_imgs.values())
+
+    information('Following acquisition in %s. Polling every %d seconds.'
+                % (params['TIFF_dir'], poll_interval))
+
+    pool = Pool(params['num_analyzers'])
+    last_new_image_time = time.time()
+    try:
+        while True:
+            found_files = sorted(os.path.basename(filepath) for filepath in
+                                 glob.glob(os.path.join(params['TIFF_dir'], '*.tif')))
+            found_files = [fn for fn in found_files if get_fov(fn) in fov_ids and in_time_window(fn)]
+
+            # only read files which have not been modified for a poll interval,
+            # so files which are still being written are left for the next pass
+            now = time.time()
+            new_files = [fn for fn in metadata_index.stale_files(found_files)
+                         if now - os.path.getmtime(os.path.join(params['TIFF_dir'], fn)) > poll_interval]
+
+            if len(new_files) > 0:
+                # only the tags are read, channels are already known from the masks
+                new_imgs = dict(zip(new_files, pool.map(get_initial_tif_params, new_files)))
+                metadata_index.add(new_imgs)
+
+                # failed files stay stale in the index and will be retried
+                new_imgs = {fn : idata for fn, idata in six.iteritems(new_imgs) if 'fov' in idata}
+                analyzed_imgs.update(new_imgs)
+                fovs_to_write.update(idata['fov'] for idata in new_imgs.values())
+
+                if len(new_imgs) > 0:
+                    information('Found %d new images.' % len(new_imgs))
+                    last_new_image_time = time.time()
+
+            if len(fovs_to_write) > 0:
+                for fov_id in sorted(fovs_to_write):
+                    if fov_id not in channel_masks:
+                        warning('No channel masks for FOV %03d, not compiling it.' % fov_id)
+                        continue
+
+                    # images already in the HDF5 file are skipped by the writer
+                    send_to_write = [[fn, idata['t']] for fn, idata in six.iteritems(analyzed_imgs)
+                                     if idata['fov'] == fov_id]
+                    send_to_write = sorted(send_to_write, key=lambda time: time[1])
+                    hdf5_stack_slice_and_write_blocks(send_to_write, channel_masks, analyzed_imgs,
+                                                      block_size=block_size, append=True)
+                fovs_to_write = set()
+
+                # the table is remade from the whole index so FOVs not followed are kept
+                make_time_table(indexed_imgs())
+
+            elif time.time() - last_new_image_time > timeout:
+                information('No new images for %d seconds, done following acquisition.' % timeout)
+                break
+
+            else:
+                time.sleep(poll_interval)
+
+    finally:
+        pool.close()
+        pool.join()
+
+    return analyzed_imgs
+
+# appends rows along the first axis of a resizable HDF5 dataset
+def append_hdf5_rows(h5ds, data):
+    '''Resizes an HDF5 dataset along axis 0 and writes data to the new rows.
+    The dataset must have been created with maxshape=(None, ...).
+    '''
+
+    n_old = h5ds.shape[0]
+    h5ds.resize(n_old + data.shape[0], axis=0)
+    h5ds[n_old:] = data
+
+    return
+
+def tileImage(img, subImageNumber):
+    '''Cuts a square image into subImageNumber equal crops, ordered row by row.
+    Returns an array of shape (subImageNumber, M, N, ...).'''
+    divisor = int(np.sqrt(subImageNumber))
+    M = img.shape[0]//divisor
+    N = img.shape[0]//divisor
+    #print(img.shape, M, N, divisor, subImageNumber)
+    tiles = img[:M*divisor,:N*divisor].reshape((divisor, M, divisor, N) + img.shape[2:]).swapaxes(1,2)
+    return(tiles.reshape((divisor*divisor, M, N) + img.shape[2:]))
+
+def untileImage(tiles, subImageNumber):
+    '''Puts crops made by tileImage back together into one image. Works for
+    crops with trailing feature dimensions, such as Unet predictions.'''
+    divisor = int(np.sqrt(subImageNumber))
+    M = tiles.shape[1]
+    N = tiles.shape[2]
+    img = tiles.reshape((divisor, divisor, M, N) + tiles.shape[3:]).swapaxes(1,2)
+    return(img.reshape((divisor*M, divisor*N) + tiles.shape[3:]))
+
+# shifts an image, filling the uncovered edge with zeros
+def shift_image(img, rows, cols):
+    '''Shifts the first two axes of an image by rows and cols pixels, like padding on
+    one side and cropping the other. Positive values move the content down and right.'''
+    shifted = np.zeros_like(img)
+    height, width = img.shape[0], img.shape[1]
+    shifted[max(rows,0):height+min(rows,0), max(cols,0):width+min(cols,0)] = \
+        img[max(-rows,0):height+min(-rows,0), max(-cols,0):width+min(-cols,0)]
+    return(shifted)
+
+def get_weights(img, subImageNumber):
+    divisor = int(np.sqrt(subImageNumber))
+    M = img.shape[0]//divisor
+    N = img.shape[0]//divisor
+    weights = np.ones((img.shape[0],img.shape[1]),dtype='uint8')
+    for i in range(divisor-1):
+        weights[(M*(i+1))-25:(M*(i+1)+25),:] = 0
+        weights[:,(N*(i+1))-25:(N*(i+1)+25)] = 0
+    return(weights)
+
+def permute_image(img, trap_align_metadata):
+    # are there three dimensions?
+    if len(img.shape) == 3:
+        if img.shape[0] < 3: # for tifs with fewer than three imageing channels, the first dimension separates channels
+            # img = np.transpose(img, (1,2,0))
+            img = img[trap_align_metadata['phase_plane_index'],:,:] # grab just the phase channel
+        else:
+            img = img[:,:,trap_align_metadata['phase_plane_index']] # grab just the phase channel
+
+    return(img)
+
+# blend weights by image shape, shift distance and numbers of crops, see get_weights_array
+weights_array_cache = {}
 
 def get_weights_array(arr=np.zeros((2048,2048)), shiftDistance=128, subImageNumber=64, padSubImageNumber=81):
+    '''Weights for blending the Unet predictions made by predict_first_image_channels,
+    which are low at the crop edges of each run. They only depend on the shape of arr
+    and the tiling, so they are computed once and then reused. The returned array
+    is shared and read only.'''
+
+    cache_key = (arr.shape, shiftDistance, subImageNumber, padSubImageNumber)
+    if cache_key in weights_array_cache:
+        return(weights_array_cache[cache_key])
 
     originalImageWeights = get_weights(arr, subImageNumber=subImageNumber)
     shiftLeftWeights = np.pad(originalImageWeights, pad_width=((0,0),(0,shiftDistance)),
@@ -1058,6 +2552,8 @@ def get_weights_array(arr=np.zeros((2048,2048)), shiftDistance=128, subImageNumb
     allWeights = np.stack((originalImageWeights, expandedImageWeights, shiftUpWeights, shiftDownWeights, shiftLeftWeights,shiftRightWeights), axis=-1)
     stackWeights = np.stack((allWeights,allWeights),axis=0)
     stackWeights = np.stack((stackWeights,stackWeights,stackWeights),axis=3)
+    stackWeights.flags.writeable = False
+    weights_array_cache[cache_key] = stackWeights
     return(stackWeights)
 
 # predicts locations of channels in an image using deep learning model
@@ -1118,8 +2614,16 @@ def predict_first_image_channels(img, model,
                                mode='constant', constant_values=((0,0),(0,0)))[:-shiftDistance,:]
     #print(imgStackShiftUp.shape)
 
-    crops = tileImage(imgStack, subImageNumber=subImageNumber)
-    crops = np.expand_dims(crops, -1)
+    # each run of the network is (image, number of crops, row shift, column shift). The
+    #    shifted runs move the content of the image, and their predictions are moved back.
+    #    The order is the same as in get_weights_array.
+    runs = [(imgStack, subImageNumber, 0, 0),
+            (imgStackExpand, padSubImageNumber, 0, 0),
+            (imgStackShiftUp, subImageNumber, shiftDistance, 0),
+            (imgStackShiftDown, subImageNumber, -shiftDistance, 0),
+            (imgStackShiftLeft, subImageNumber, 0, shiftDistance),
+            (imgStackShiftRight, subImageNumber, 0, -shiftDistance)]
+    run_crops = [tileImage(run_img, subImageNumber=n_crops) for run_img, n_crops, _, _ in runs]
 
     data_gen_args = {'batch_size':params['compile']['channel_prediction_batch_size'],
                          'n_channels':1,
@@ -1129,59 +2633,32 @@ def predict_first_image_channels(img, model,
                         'use_multiprocessing':True,
                         'workers':params['num_analyzers']}
 
-    img_generator = TrapSegmentationDataGenerator(crops, **data_gen_args)
-    predictions = model.predict_generator(img_generator, **predict_gen_args)
-    prediction = imageConcatenatorFeatures(predictions, subImageNumber=subImageNumber)
-    #print(prediction.shape)
-
-    cropsExpand = tileImage(imgStackExpand, subImageNumber=padSubImageNumber)
-    cropsExpand = np.expand_dims(cropsExpand, -1)
-    img_generator = TrapSegmentationDataGenerator(cropsExpand, **data_gen_args)
-    predictions = model.predict_generator(img_generator, **predict_gen_args)
-    predictionExpand = imageConcatenatorFeatures2(predictions, subImageNumber=padSubImageNumber)
-    predictionExpand = util.crop(predictionExpand, ((0,0),(shiftDistance,shiftDistance),(shiftDistance,shiftDistance),(0,0)))
-    #print(predictionExpand.shape)
-
-    cropsShiftLeft = tileImage(imgStackShiftLeft, subImageNumber=subImageNumber)
-    cropsShiftLeft = np.expand_dims(cropsShiftLeft, -1)
-    img_generator = TrapSegmentationDataGenerator(cropsShiftLeft, **data_gen_args)
-    predictions = model.predict_generator(img_generator, **predict_gen_args)
-    predictionLeft = imageConcatenatorFeatures(predictions, subImageNumber=subImageNumber)
-    predictionLeft = np.pad(predictionLeft, pad_width=((0,0),(0,0),(0,shiftDistance),(0,0)),
-                      mode='constant', constant_values=((0,0),(0,0),(0,0),(0,0)))[:,:,shiftDistance:,:]
-    #print(predictionLeft.shape)
-
-    cropsShiftRight = tileImage(imgStackShiftRight, subImageNumber=subImageNumber)
-    cropsShiftRight = np.expand_dims(cropsShiftRight, -1)
-    img_generator = TrapSegmentationDataGenerator(cropsShiftRight, **data_gen_args)
-    predictions = model.predict_generator(img_generator, **predict_gen_args)
-    predictionRight = imageConcatenatorFeatures(predictions, subImageNumber=subImageNumber)
-    predictionRight = np.pad(predictionRight, pad_width=((0,0),(0,0),(shiftDistance,0),(0,0)),
-                      mode='constant', constant_values=((0,0),(0,0),(0,0),(0,0)))[:,:,:(-1*shiftDistance),:]
-    #print(predictionRight.shape)
-
-    cropsShiftUp = tileImage(imgStackShiftUp, subImageNumber=subImageNumber)
-    #print(cropsShiftUp.shape)
-    cropsShiftUp = np.expand_dims(cropsShiftUp, -1)
-    img_generator = TrapSegmentationDataGenerator(cropsShiftUp, **data_gen_args)
-    predictions = model.predict_generator(img_generator, **predict_gen_args)
-    predictionUp = imageConcatenatorFeatures(predictions, subImageNumber=subImageNumber)
-    predictionUp = np.pad(predictionUp, pad_width=((0,0),(0,shiftDistance),(0,0),(0,0)),
-                      mode='constant', constant_values=((0,0),(0,0),(0,0),(0,0)))[:,shiftDistance:,:,:]
-    #print(predictionUp.shape)
-
-    cropsShiftDown = tileImage(imgStackShiftDown, subImageNumber=subImageNumber)
-    cropsShiftDown = np.expand_dims(cropsShiftDown, -1)
-    img_generator = TrapSegmentationDataGenerator(cropsShiftDown, **data_gen_args)
-    predictions = model.predict_generator(img_generator, **predict_gen_args)
-    predictionDown = imageConcatenatorFeatures(predictions, subImageNumber=subImageNumber)
-    predictionDown = np.pad(predictionDown, pad_width=((0,0),(shiftDistance,0),(0,0),(0,0)),
-                      mode='constant', constant_values=((0,0),(0,0),(0,0),(0,0)))[:,:(-1*shiftDistance),:,:]
-    #print(predictionDown.shape)
-
-    allPredictions = np.stack((prediction, predictionExpand,
-                               predictionUp, predictionDown,
-                               predictionLeft, predictionRight), axis=-1)
+    # crops from all runs go through the network together. Crops of a different size
+    #    can't share a batch, so there is one pass per crop size. With shiftDistance
+    #    equal to half the crop size, as used by mm3_Compile.py, this is a single pass.
+    run_predictions = [None] * len(runs)
+    for crop_shape in sorted(set(crops.shape[1:] for crops in run_crops)):
+        run_indices = [i for i, crops in enumerate(run_crops) if crops.shape[1:] == crop_shape]
+        crops = np.expand_dims(np.concatenate([run_crops[i] for i in run_indices]), -1)
+
+        img_generator = TrapSegmentationDataGenerator(crops, **data_gen_args)
+        predictions = model.predict_generator(img_generator, **predict_gen_args)
+
+        split_points = np.cumsum([run_crops[i].shape[0] for i in run_indices])[:-1]
+        for i, predictions_i in zip(run_indices, np.split(predictions, split_points)):
+            run_predictions[i] = predictions_i
+
+    allPredictions = []
+    for (run_img, n_crops, row_shift, col_shift), predictions in zip(runs, run_predictions):
+        prediction = untileImage(predictions, n_crops).astype('float32')
+        if run_img is imgStackExpand:
+            prediction = prediction[shiftDistance:-shiftDistance,shiftDistance:-shiftDistance]
+        else:
+            prediction = shift_image(prediction, -row_shift, -col_shift)
+        allPredictions.append(prediction)
+
+    # first axis is the image, as for the stacked predictions of several images
+    allPredictions = np.stack(allPredictions, axis=-1)[np.newaxis,...]
 
     return(allPredictions)
 
@@ -1221,8 +2698,109 @@ def get_frame_trap_bounding_boxes(trapLabels, trapProps, trapAreaThreshold=2000,
 
     return(trapBboxes)
 
+# reads raw frames ahead of their use with a thread pool
+def prefetch_frames(file_names, n_threads=None, n_ahead=None):
+    '''Yields (frame index, image) for the raw TIFFs in file_names, in order.
+    Frames are read and decoded by a pool of threads up to n_ahead frames before
+    they are used, so reading overlaps with the work done on each frame.'''
+
+    if n_threads is None:
+        n_threads = params['num_analyzers']
+    if n_ahead is None:
+        n_ahead = 2 * n_threads
+
+    def read_frame(fn):
+        return io.imread(os.path.join(params['experiment_directory'], params['image_directory'], fn))
+
+    pool = ThreadPool(n_threads)
+    try:
+        pending = collections.deque()
+        for frame, fn in enumerate(file_names):
+            pending.append((frame, pool.apply_async(read_frame, (fn,))))
+            if len(pending) > n_ahead:
+                frame_done, result = pending.popleft()
+                yield frame_done, result.get()
+
+        while pending:
+            frame_done, result = pending.popleft()
+            yield frame_done, result.get()
+    finally:
+        pool.terminate()
+
+# puts the planes of a raw frame on the last axis, as used for cropping traps
+def frame_planes_last(fullFrameImg):
+    if len(fullFrameImg.shape) == 3:
+        if fullFrameImg.shape[0] < 3: # for tifs with less than three imaging channels, the first dimension separates channels
+            fullFrameImg = np.transpose(fullFrameImg, (1,2,0))
+    else:
+        fullFrameImg = fullFrameImg[:,:,np.newaxis]
+    return(fullFrameImg)
+
+# reads every frame of an FOV once for Unet trap alignment and cropping
+def read_trap_alignment_frames(fileNames, centroid, bboxesDict, trap_align_metadata, margin=None):
+    '''Reads the frames of an FOV in one pass and keeps what is needed both to align
+    and to crop the traps, so crop_traps does not have to read the frames again.
+
+    Parameters
+    ----------
+    fileNames : list
+        File names of the FOV in time order.
+    centroid : array
+        Center of the (512,512) phase region used for alignment.
+    bboxesDict : dict
+        Trap label : bounding box in the first frame.
+    trap_align_metadata : dict
+        As made in mm3_Compile.py.
+    margin : int
+        Pixels kept around each trap bounding box to allow for drift. Defaults to
+        params['compile']['channel_drift_max_shift'], or 64 if that is not set.
+
+    Returns
+    -------
+    align_region_stack : array
+        (frame_number,512,512,1) phase stack for predicting trap locations.
+    trapRegions : dict
+        Trap label : ((row, column) origin, (frame_number, rows, columns, planes) array)
+        of the region around each trap, for crop_traps.
+    '''
+
+    if margin is None:
+        margin = params['compile']['channel_drift_max_shift'] or 64
+
+    frameNum = trap_align_metadata['frame_count']
+    align_region_stack = np.zeros((frameNum,512,512,1), dtype='uint16')
+    phase_index = trap_align_metadata['phase_plane_index']
+    trapRegions = {}
+
+    for frame, fullFrameImg in prefetch_frames(fileNames):
+        fullFrameImg = frame_planes_last(fullFrameImg)
+
+        if frame == 0:
+            if fullFrameImg.shape[2] == 1: # single plane images
+                phase_index = 0
+            for key, bbox in six.iteritems(bboxesDict):
+                minRow, minCol = max(bbox[0]-margin, 0), max(bbox[1]-margin, 0)
+                maxRow = min(bbox[2]+margin, fullFrameImg.shape[0])
+                maxCol = min(bbox[3]+margin, fullFrameImg.shape[1])
+                trapRegions[key] = ((minRow, minCol),
+                                    np.zeros((frameNum, maxRow-minRow, maxCol-minCol, fullFrameImg.shape[2]),
+                                             dtype=fullFrameImg.dtype))
+
+        align_region_stack[frame,:,:,0] = fullFrameImg[centroid[0]-256:centroid[0]+256,
+                                                       centroid[1]-256:centroid[1]+256,
+                                                       phase_index]
+
+        for key, (origin, region) in six.iteritems(trapRegions):
+            region[frame] = fullFrameImg[origin[0]:origin[0]+region.shape[1],
+                                         origin[1]:origin[1]+region.shape[2]]
+
+    return(align_region_stack, trapRegions)
+
 # this function performs image alignment as defined by the shifts passed as an argument
-def crop_traps(fileNames, trapProps, labelledTraps, bboxesDict, trap_align_metadata):
+def crop_traps(fileNames, trapProps, labelledTraps, bboxesDict, trap_align_metadata, trapRegions=None):
+    '''Crops each trap through time with the shifted bounding boxes. If trapRegions from
+    read_trap_alignment_frames are given, traps are cropped from them, and a frame is
+    only read again when a trap has drifted out of its region.'''
 
     frameNum = trap_align_metadata['frame_count']
     channelNum = trap_align_metadata['plane_number']
@@ -1239,17 +2817,27 @@ def crop_traps(fileNames, trapProps, labelledTraps, bboxesDict, trap_align_metad
         if (frame+1) % 20 == 0:
             print("Cropping trap regions for frame number {} of {}.".format(frame+1, frameNum))
 
-        imgPath = os.path.join(params['experiment_directory'],params['image_directory'],fileNames[frame])
-        fullFrameImg = io.imread(imgPath)
-        if len(fullFrameImg.shape) == 3:
-            if fullFrameImg.shape[0] < 3: # for tifs with less than three imaging channels, the first dimension separates channels
-                fullFrameImg = np.transpose(fullFrameImg, (1,2,0))
+        fullFrameImg = None
         trapClosedEndPxDict[fileNames[frame]] = {key:{} for key in bboxesDict.keys()}
 
         for key in trapImagesDict.keys():
 
             bbox = bboxesDict[key][frame]
-            trapImagesDict[key][frame,:,:,:] = fullFrameImg[bbox[0]:bbox[2],bbox[1]:bbox[3],:]
+
+            trapImg = None
+            if trapRegions is not None:
+                origin, region = trapRegions[key]
+                if (bbox[0] >= origin[0] and bbox[2] <= origin[0]+region.shape[1] and
+                        bbox[1] >= origin[1] and bbox[3] <= origin[1]+region.shape[2]):
+                    trapImg = region[frame,bbox[0]-origin[0]:bbox[2]-origin[0],bbox[1]-origin[1]:bbox[3]-origin[1],:]
+
+            if trapImg is None:
+                if fullFrameImg is None:
+                    imgPath = os.path.join(params['experiment_directory'],params['image_directory'],fileNames[frame])
+                    fullFrameImg = frame_planes_last(io.imread(imgPath))
+                trapImg = fullFrameImg[bbox[0]:bbox[2],bbox[1]:bbox[3],:]
+
+            trapImagesDict[key][frame,:,:,:] = trapImg
 
             #tmpImg = np.reshape(fullFrameImg[trapMask==key], (trapHeight,trapWidth,channelNum))
 
@@ -1384,6 +2972,173 @@ def find_channel_locs(image_data):
 
     return chnl_loc_dict
 
+# finds channels on some images of each FOV and moves them with the drift for the rest
+def find_channels_sampled(analyzed_imgs, n_samples=None):
+    '''
+    Finds the channels in every image from only a few sampled images per FOV, instead
+    of running find_channel_locs on each image.
+
+    For each FOV, find_channel_locs is run on n_samples images spread evenly through
+    time. The drift of every image relative to the first image of the FOV is then
+    measured by cross-correlating the y and x projections of the phase plane, which is
+    much cheaper than finding the channels. The channels of each image are those of
+    the nearest sampled image, moved by the difference in drift between the two.
+
+    The drift is also saved for each image as 'drift', [y, x] in pixels, and n_samples
+    as 'channel_samples'.
+
+    Parameters
+    ----------
+    analyzed_imgs : dict
+        Image metadata dictionary as made by get_tif_params without finding channels.
+        'channels', 'drift' and 'channel_samples' are added to each entry in place.
+    n_samples : int
+        Number of images per FOV to find channels on. Defaults to
+        params['compile']['channel_sample_frames'].
+
+    Returns
+    -------
+    analyzed_imgs : dict
+        The same dictionary, with the channel locations added.
+
+    Called by
+    mm3_Compile.py
+
+    Calls
+    get_tif_params
+    get_tif_drift
+    '''
+
+    if n_samples is None:
+        n_samples = params['compile']['channel_sample_frames']
+    max_shift = params['compile']['channel_drift_max_shift']
+    if max_shift is None:
+        max_shift = int(params['compile']['channel_separation'] / 2)
+
+    # file names of the images to do for each FOV
+    fov_files = {}
+    for fn, idata in six.iteritems(analyzed_imgs):
+        if not idata or idata.get('analyze_success', True) == False:
+            continue
+        fov_files.setdefault(idata['fov'], []).append(fn)
+
+    pool = Pool(params['num_analyzers'])
+
+    for fov_id, filenames in sorted(six.iteritems(fov_files)):
+        filenames = sorted(filenames, key=lambda fn: analyzed_imgs[fn]['t'])
+        sample_indexes = np.unique(np.linspace(0, len(filenames) - 1,
+                                               min(n_samples, len(filenames))).round().astype(int))
+        information('Finding channels on %d of %d images for FOV %d.'
+                    % (len(sample_indexes), len(filenames), fov_id))
+
+        # the first image is the reference for the drift
+        with tiff.TiffFile(analyzed_imgs[filenames[0]]['filepath']) as tif:
+            ref_projections = image_projections(channel_finding_image(tif.asarray()))
+
+        sample_results = {i : pool.apply_async(get_tif_params, args=(filenames[i], True))
+                          for i in sample_indexes}
+        drift_results = [pool.apply_async(get_tif_drift, args=(fn, ref_projections, max_shift))
+                         for fn in filenames]
+
+        sample_channels = {}
+        for i, result in six.iteritems(sample_results):
+            image_params = result.get()
+            if image_params.get('analyze_success', True) != False:
+                sample_channels[i] = image_params['channels']
+        drifts = [result.get() for result in drift_results]
+
+        if not sample_channels:
+            warning('Could not find channels on any sampled image of FOV %d.' % fov_id)
+            for fn in filenames:
+                analyzed_imgs[fn]['channels'] = {}
+                analyzed_imgs[fn]['channel_samples'] = n_samples
+            continue
+
+        for fn, channels, drift in zip(filenames, move_sampled_channels(sample_channels, drifts), drifts):
+            analyzed_imgs[fn]['channels'] = channels
+            analyzed_imgs[fn]['drift'] = drift
+            analyzed_imgs[fn]['channel_samples'] = n_samples
+
+    pool.close()
+    pool.join()
+
+    return analyzed_imgs
+
+# channels of every frame from the channels of sampled frames and the drift
+def move_sampled_channels(sample_channels, drifts):
+    '''Returns the channel locations of every frame, taken from the nearest sampled
+    frame and moved by the difference in drift between the two frames.
+
+    Parameters
+    ----------
+    sample_channels : dict
+        Channel locations as found by find_channel_locs, keyed by frame index.
+    drifts : list
+        [y, x] drift of each frame relative to a common reference, or None where it
+        could not be measured.
+
+    Returns
+    -------
+    channels : list
+        Channel location dictionaries for each frame.
+    '''
+
+    sampled = np.array(sorted(sample_channels.keys()))
+
+    channels = []
+    for i in range(len(drifts)):
+        nearest = int(sampled[np.argmin(np.abs(sampled - i))])
+
+        # move the channels by the drift since the sampled image, if both were measured
+        if drifts[i] is not None and drifts[nearest] is not None:
+            dy = drifts[i][0] - drifts[nearest][0]
+            dx = drifts[i][1] - drifts[nearest][1]
+        else:
+            dy, dx = 0, 0
+
+        channels.append({int(peak) + dx :
+                {'closed_end_px' : int(ends['closed_end_px']) + dy,
+                 'open_end_px' : int(ends['open_end_px']) + dy}
+                for peak, ends in six.iteritems(sample_channels[nearest])})
+
+    return channels
+
+# finds the channels of frames which are already in memory
+def find_channels_in_frames(phase_frames, n_samples=None):
+    '''Finds the channels in each frame of a stack of phase images of one FOV, already
+    oriented like channel_finding_image. If n_samples is given, channels are found on
+    that many frames and moved with the drift for the others, like
+    find_channels_sampled. Otherwise find_channel_locs is run on every frame.
+
+    Returns
+    -------
+    channels : list
+        Channel location dictionaries for each frame.
+    drifts : list
+        [y, x] drift of each frame relative to the first, or None for each frame if
+        channels were found on every frame.
+    '''
+
+    if not n_samples:
+        return [find_channel_locs(frame) for frame in phase_frames], [None] * len(phase_frames)
+
+    max_shift = params['compile']['channel_drift_max_shift']
+    if max_shift is None:
+        max_shift = int(params['compile']['channel_separation'] / 2)
+
+    sample_indexes = np.unique(np.linspace(0, len(phase_frames) - 1,
+                                           min(n_samples, len(phase_frames))).round().astype(int))
+    sample_channels = {int(i) : find_channel_locs(phase_frames[i]) for i in sample_indexes}
+
+    ref_projections = image_projections(phase_frames[0])
+    drifts = []
+    for frame in phase_frames:
+        projection_y, projection_x = image_projections(frame)
+        drifts.append([projection_shift(ref_projections[0], projection_y, max_shift),
+                       projection_shift(ref_projections[1], projection_x, max_shift)])
+
+    return move_sampled_channels(sample_channels, drifts), drifts
+
 # make masks from initial set of images (same images as clusters)
 def make_masks(analyzed_imgs):
     '''
@@ -1425,12 +3180,21 @@ def make_masks(analyzed_imgs):
         image_cols = img_v['shape'][1] # y pixels
         break # just need one. using iteritems mean the whole dict doesn't load
 
-    # get the fov ids
-    fovs = []
-    for img_k in analyzed_imgs.keys():
-        img_v = analyzed_imgs[img_k]
-        if img_v['fov'] not in fovs:
-            fovs.append(img_v['fov'])
+    # go through the images once and collect the channel rectangles of each fov,
+    # as rows of [y1, y2, x1, x2]
+    fov_rects = collections.OrderedDict()
+    for img_k, img_v in six.iteritems(analyzed_imgs):
+        if not img_v or 'channels' not in img_v:
+            continue
+
+        # pull out the peak location and top and bottom location
+        # and expand by padding (more padding done later for width)
+        rects = fov_rects.setdefault(img_v['fov'], [])
+        for chnl_peak, peak_ends in six.iteritems(img_v['channels']):
+            rects.append((max(peak_ends['closed_end_px'] - chan_lp, 0),
+                          min(peak_ends['open_end_px'] + chan_lp, image_rows),
+                          max(chnl_peak - crop_wp, 0),
+                          min(chnl_peak + crop_wp, image_cols)))
 
     # max width and length across all fovs. channels will get expanded by these values
     # this important for later updates to the masks, which should be the same
@@ -1438,66 +3202,52 @@ def make_masks(analyzed_imgs):
     max_chnl_mask_wid = 0
 
     # for each fov make a channel_mask dictionary from consensus mask
-    for fov in fovs:
-        # initialize a the dict and consensus mask
+    for fov, rects in six.iteritems(fov_rects):
         channel_masks_1fov = {} # dict which holds channel masks {peak : [[y1, y2],[x1,x2]],...}
-        consensus_mask = np.zeros([image_rows, image_cols]) # mask for labeling
-
-        # bring up information for each image
-        for img_k in analyzed_imgs.keys():
-            img_v = analyzed_imgs[img_k]
-            # skip this one if it is not of the current fov
-            if img_v['fov'] != fov:
-                continue
 
-            # for each channel in each image make a single mask
-            img_chnl_mask = np.zeros([image_rows, image_cols])
-
-            # and add the channel mask to it
-            for chnl_peak, peak_ends in six.iteritems(img_v['channels']):
-                # pull out the peak location and top and bottom location
-                # and expand by padding (more padding done later for width)
-                x1 = max(chnl_peak - crop_wp, 0)
-                x2 = min(chnl_peak + crop_wp, image_cols)
-                y1 = max(peak_ends['closed_end_px'] - chan_lp, 0)
-                y2 = min(peak_ends['open_end_px'] + chan_lp, image_rows)
-
-                # add it to the mask for this image
-                img_chnl_mask[y1:y2, x1:x2] = 1
-
-            # add it to the consensus mask
-            consensus_mask += img_chnl_mask
-
-        # Normalize concensus mask between 0 and 1.
-        consensus_mask = consensus_mask.astype('float32') / float(np.amax(consensus_mask))
-
-        # threshhold and homogenize each channel mask within the mask, label them
-        # label when value is above 0.1 (so 90% occupancy), transpose.
-        # the [0] is for the array ([1] is the number of regions)
-        # It transposes and then transposes again so regions are labeled left to right
-        # clear border it to make sure the channels are off the edge
-        consensus_mask = ndi.label(consensus_mask)[0]
-
-        # go through each label
-        for label in np.unique(consensus_mask):
-            if label == 0: # label zero is the background
+        # channels are usually found at the same place in most images, so only the
+        # distinct rectangles are needed. Empty ones are dropped.
+        rects = np.array(rects, dtype='int64').reshape(-1, 4)
+        rects = rects[(rects[:,1] > rects[:,0]) & (rects[:,3] > rects[:,2])]
+        if len(rects) == 0:
+            warning('No channels found in the images of FOV %d.' % fov)
+            channel_masks[fov] = {}
+            continue
+        rects = np.unique(rects, axis=0)
+
+        # the consensus mask is the area covered by any image's channels. Coverage is
+        # summed from the rectangle corners with a 2-D difference array, instead of
+        # painting a full frame for every image.
+        corners = np.zeros([image_rows + 1, image_cols + 1], dtype='int64')
+        np.add.at(corners, (rects[:,0], rects[:,2]), 1)
+        np.add.at(corners, (rects[:,0], rects[:,3]), -1)
+        np.add.at(corners, (rects[:,1], rects[:,2]), -1)
+        np.add.at(corners, (rects[:,1], rects[:,3]), 1)
+        coverage = corners.cumsum(axis=0).cumsum(axis=1)[:image_rows, :image_cols]
+
+        # label each channel region, the [0] is for the array ([1] is the number of regions)
+        consensus_mask = ndi.label(coverage > 0)[0]
+
+        # go through each label, only looking at its bounding box
+        for label_index, label_slice in enumerate(ndi.find_objects(consensus_mask)):
+            if label_slice is None:
                 continue
-            binary_core = consensus_mask == label
+            binary_core = consensus_mask[label_slice] == label_index + 1
 
             # clean up the rough edges
-            poscols = np.any(binary_core, axis = 0) # column positions where true (any)
-            posrows = np.any(binary_core, axis = 1) # row positions where true (any)
+            poscols = np.where(np.any(binary_core, axis = 0))[0] + label_slice[1].start # column positions where true (any)
+            posrows = np.where(np.any(binary_core, axis = 1))[0] + label_slice[0].start # row positions where true (any)
 
             # channel_id givin by horizontal position
             # this is important. later updates to the positions will have to check
             # if their channels contain this median value to match up
-            channel_id = int(np.median(np.where(poscols)[0]))
+            channel_id = int(np.median(poscols))
 
             # store the edge locations of the channel mask in the dictionary. Will be ints
-            min_row = np.min(np.where(posrows)[0])
-            max_row = np.max(np.where(posrows)[0])
-            min_col = np.min(np.where(poscols)[0])
-            max_col = np.max(np.where(poscols)[0])
+            min_row = np.min(posrows)
+            max_row = np.max(posrows)
+            min_col = np.min(poscols)
+            max_col = np.max(poscols)
 
             # if the min/max cols are within the image bounds,
             # add the mask, as 4 points, to the dictionary
@@ -1721,16 +3471,18 @@ def channel_xcorr(fov_id, peak_id):
     # Use this number of images to calculate cross correlations
     number_of_images = 20
 
-    # load the phase contrast images
-    image_data = load_stack(fov_id, peak_id, color=params['phase_plane'])
+    # find how many images there are without loading them
+    n_images = stack_length(fov_id, peak_id, color=params['phase_plane'])
 
     # if there are more images than number_of_images, use number_of_images images evenly
-    # spaced across the range
-    if image_data.shape[0] > number_of_images:
-        spacing = int(image_data.shape[0] / number_of_images)
-        image_data = image_data[::spacing,:,:]
-        if image_data.shape[0] > number_of_images:
-            image_data = image_data[:number_of_images,:,:]
+    # spaced across the range. Only these images are loaded
+    frames = np.arange(n_images)
+    if n_images > number_of_images:
+        spacing = int(n_images / number_of_images)
+        frames = frames[::spacing][:number_of_images]
+
+    # load the phase contrast images
+    image_data = load_stack(fov_id, peak_id, color=params['phase_plane'], frames=frames)
 
     # we will compare all images to this one, needs to be padded to account for image drift
     first_img = np.pad(image_data[0,:,:], pad_size, mode='reflect')
@@ -1759,7 +3511,7 @@ def average_empties_stack(fov_id, specs, color='c1', align=True):
     color : string
         Which plane to use.
     align : boolean
-        Flag that is passed to the worker function average_empties, indicates
+        Flag that is passed to the worker function average_empties_batch, indicates
         whether images should be aligned be for averaging (use False for fluorescent images)
 
     Returns
@@ -1803,45 +3555,69 @@ def average_empties_stack(fov_id, specs, color='c1', align=True):
 
         information("%d empty channels designated for FOV %d." % (len(empty_stacks), fov_id))
 
-        # go through time points and create list of averaged empties
-        avg_empty_stack = [] # list will be later concatentated into numpy array
-        time_points = range(image_data.shape[0]) # index is time
-        for t in time_points:
-            # get images from one timepoint at a time and send to alignment and averaging
-            imgs = [stack[t] for stack in empty_stacks]
-            avg_empty = average_empties(imgs, align=align) # function is in mm3
-            avg_empty_stack.append(avg_empty)
-
-        # concatenate list and then save out to tiff stack
-        avg_empty_stack = np.stack(avg_empty_stack, axis=0)
+        # align and average all time points at once
+        avg_empty_stack = average_empties_batch(empty_stacks, align=align) # function is in mm3
 
     # save out data
-    if params['output'] == 'TIFF':
-        # make new name and save it
-        empty_filename = params['experiment_name'] + '_xy%03d_empty_%s.tif' % (fov_id, color)
-        tiff.imsave(os.path.join(params['empty_dir'],empty_filename), avg_empty_stack, compress=4)
+    with StackStore(fov_id) as store:
+        # give attribute which says which channels contribute
+        store.write(None, 'empty_%s' % color, avg_empty_stack,
+                    attrs={'empty_channels' : empty_peak_ids})
 
-    if params['output'] == 'HDF5':
-        h5f = h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % fov_id), 'r+')
+    information("Saved empty channel for FOV %d." % fov_id)
 
-        # delete the dataset if it exists (important for debug)
-        if 'empty_%s' % color in h5f:
-            del h5f[u'empty_%s' % color]
+    return True
 
-        # the empty channel should be it's own dataset
-        h5ds = h5f.create_dataset(u'empty_%s' % color,
-                        data=avg_empty_stack,
-                        chunks=(1, avg_empty_stack.shape[1], avg_empty_stack.shape[2]),
-                        maxshape=(None, avg_empty_stack.shape[1], avg_empty_stack.shape[2]),
-                        compression="gzip", shuffle=True, fletcher32=True)
+# averages the stacks of empty channels for all time points at once
+def average_empties_batch(empty_stacks, align=True, method=None):
+    '''
+    Does what average_empties does for every time point of the empty stacks of an FOV.
+    For each other empty, all of its frames are aligned to the first empty together by
+    match_template_offsets and moved with align_empty_stack. The aligned frames are put
+    in a (time, empty, rows, columns) array and averaged over the empty axis.
 
-        # give attribute which says which channels contribute
-        h5ds.attrs.create('empty_channels', empty_peak_ids)
-        h5f.close()
+    Parameters
+    empty_stacks : list
+        (frames, rows, columns) stacks of the empty channels, all the same size.
+    align : boolean
+        Align the empties before averaging (use False for fluorescent images).
+    method : string
+        'mean', 'median', or 'trimmed_mean', which leaves out the highest and lowest
+        value of each pixel when there are at least three empties. Defaults to
+        params['subtract']['empty_average'].
 
-    information("Saved empty channel for FOV %d." % fov_id)
+    Returns
+    avg_empty_stack : np.array
+        uint16 stack of averaged empties.
 
-    return True
+    Called by
+    average_empties_stack
+    '''
+
+    if method is None:
+        method = params['subtract']['empty_average']
+
+    n_frames = min(stack.shape[0] for stack in empty_stacks)
+    ref_stack = np.asarray(empty_stacks[0][:n_frames])
+
+    aligned_stacks = np.empty((n_frames, len(empty_stacks)) + ref_stack.shape[1:], dtype=ref_stack.dtype)
+    aligned_stacks[:,0] = ref_stack
+    for n, stack in enumerate(empty_stacks[1:], start=1):
+        stack = np.asarray(stack[:n_frames])
+        if align:
+            aligned_stacks[:,n] = align_empty_stack(stack, match_template_offsets(ref_stack, stack))
+        else:
+            aligned_stacks[:,n] = stack
+
+    if method == 'median':
+        avg_empty_stack = np.median(aligned_stacks, axis=1)
+    elif method == 'trimmed_mean' and len(empty_stacks) >= 3:
+        avg_empty_stack = np.sort(aligned_stacks, axis=1)[:,1:-1].mean(axis=1)
+    else:
+        avg_empty_stack = aligned_stacks.mean(axis=1)
+
+    # change type back to unsigned 16 bit not floats
+    return avg_empty_stack.astype(dtype='uint16')
 
 # averages a list of empty channels
 def average_empties(imgs, align=True):
@@ -1856,8 +3632,7 @@ def average_empties(imgs, align=True):
     The images are then placed in a stack and aveaged. This image is trimmed so it is the size
     of the original images
 
-    Called by
-    average_empties_stack
+    Not used by average_empties_stack any more, which calls average_empties_batch.
     '''
 
     aligned_imgs = [] # list contains the aligned, padded images
@@ -1909,54 +3684,401 @@ def copy_empty_stack(from_fov, to_fov, color='c1'):
     avg_empty_stack = load_stack(from_fov, 0, color='empty_{}'.format(color))
 
     # save out data
-    if params['output'] == 'TIFF':
-        # make new name and save it
-        empty_filename = params['experiment_name'] + '_xy%03d_empty_%s.tif' % (to_fov, color)
-        tiff.imsave(os.path.join(params['empty_dir'],empty_filename), avg_empty_stack, compress=4)
+    with StackStore(to_fov) as store:
+        # give attribute which says which channels contribute. Just put 0
+        store.write(None, 'empty_%s' % color, avg_empty_stack,
+                    attrs={'empty_channels' : [0]})
 
-    if params['output'] == 'HDF5':
-        h5f = h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % to_fov), 'r+')
+    information("Saved empty channel for FOV %d." % to_fov)
 
-        # delete the dataset if it exists (important for debug)
-        if 'empty_%s' % color in h5f:
-            del h5f[u'empty_%s' % color]
+# Do subtraction for an fov over many timepoints
+# saves the phase alignment offsets of the channels of one FOV
+def save_subtract_offsets(fov_id, peak_offsets):
+    '''Saves the (frames, 2) offsets from phase subtraction of each peak in an FOV
+    to subtract_offsets/xy%03d.npz in the analysis directory, for aligning the
+    fluorescence planes later. See align_empty_stack for what the offsets mean.'''
+
+    offsets_dir = os.path.join(params['ana_dir'], 'subtract_offsets')
+    if not os.path.exists(offsets_dir):
+        os.makedirs(offsets_dir)
+
+    np.savez(os.path.join(offsets_dir, 'xy%03d.npz' % fov_id),
+             **{'p%04d' % peak_id : offsets for peak_id, offsets in six.iteritems(peak_offsets)})
+
+# loads the phase alignment offsets of the channels of one FOV
+def load_subtract_offsets(fov_id):
+    '''Returns a dictionary of peak_id : (frames, 2) offsets saved by the phase
+    subtraction of an FOV, which is empty if there are none.'''
+
+    offsets_path = os.path.join(params['ana_dir'], 'subtract_offsets', 'xy%03d.npz' % fov_id)
+    if not os.path.exists(offsets_path):
+        return {}
 
-        # the empty channel should be it's own dataset
-        h5ds = h5f.create_dataset(u'empty_%s' % color,
-                        data=avg_empty_stack,
-                        chunks=(1, avg_empty_stack.shape[1], avg_empty_stack.shape[2]),
-                        maxshape=(None, avg_empty_stack.shape[1], avg_empty_stack.shape[2]),
-                        compression="gzip", shuffle=True, fletcher32=True)
+    with np.load(offsets_path) as arrays:
+        return {int(name[1:]) : arrays[name] for name in arrays.files}
 
-        # give attribute which says which channels contribute. Just put 0
-        h5ds.attrs.create('empty_channels', [0])
-        h5f.close()
+# subtracts a block of time points of one channel, in a worker of SubtractionEngine
+def subtract_stack_block(block):
+    '''Subtracts time points t_start to t_end of a channel stack. The channel, empty,
+    output and offsets stacks are .npy files written by SubtractionEngine, which are
+    memory mapped here, so no frames are sent through the pool.
 
-    information("Saved empty channel for FOV %d." % to_fov)
+    For 'phase' the alignment offsets of each frame are written to offsets_path if it
+    is given. For 'fluor' the empty is moved by the offsets in offsets_path if it is
+    given, and is not aligned otherwise.
 
-# Do subtraction for an fov over many timepoints
-def subtract_fov_stack(fov_id, specs, color='c1', method='phase'):
+    Parameters
+    block : tuple of (method, image_path, empty_path, sub_path, offsets_path, t_start, t_end)
+
+    Called by
+    SubtractionEngine
+
+    Calls
+    mm3.subtract_phase_stack
+    mm3.subtract_fluor_stack
+    mm3.subtract_phase
+    mm3.subtract_fluor
+    '''
+
+    method, image_path, empty_path, sub_path, offsets_path, t_start, t_end = block
+
+    image_data = np.load(image_path, mmap_mode='r')
+    empty_data = np.load(empty_path, mmap_mode='r')
+    sub_data = np.load(sub_path, mmap_mode='r+')
+    if offsets_path is not None:
+        offsets = np.load(offsets_path, mmap_mode='r+' if method == 'phase' else 'r')
+
+    if method == 'phase' and params['subtract']['phase_alignment'] == 'fft':
+        sub_data[t_start:t_end], block_offsets = subtract_phase_stack(image_data[t_start:t_end],
+                                                                      empty_data[t_start:t_end],
+                                                                      return_offsets=True)
+        if offsets_path is not None:
+            offsets[t_start:t_end] = block_offsets
+
+    elif method == 'phase':
+        for t in range(t_start, t_end):
+            sub_data[t], frame_offset = subtract_phase((image_data[t], empty_data[t]), return_offset=True)
+            if offsets_path is not None:
+                offsets[t] = frame_offset
+
+    elif method == 'fluor' and offsets_path is not None:
+        sub_data[t_start:t_end] = subtract_fluor_stack(image_data[t_start:t_end],
+                                                       empty_data[t_start:t_end],
+                                                       offsets[t_start:t_end])
+
+    elif method == 'fluor':
+        for t in range(t_start, t_end):
+            sub_data[t] = subtract_fluor((image_data[t], empty_data[t]))
+
+    sub_data.flush()
+    if offsets_path is not None and method == 'phase':
+        offsets.flush()
+
+    return t_end - t_start
+
+# segments a block of time points of a subtracted channel, in a worker of SubtractionEngine or SegmentationEngine
+def segment_stack_block(block):
+    '''Segments time points t_start to t_end of a subtracted stack with segment_image,
+    reading and writing the .npy files made by SubtractionEngine or SegmentationEngine.
+
+    Parameters
+    block : tuple of (sub_path, seg_path, t_start, t_end)
+
+    Called by
+    SubtractionEngine
+    SegmentationEngine
+
+    Calls
+    mm3.segment_image
+    '''
+
+    sub_path, seg_path, t_start, t_end = block
+
+    sub_data = np.load(sub_path, mmap_mode='r')
+    seg_data = np.load(seg_path, mmap_mode='r+')
+
+    for t in range(t_start, t_end):
+        seg_data[t] = segment_image(sub_data[t])
+
+    seg_data.flush()
+
+    return t_end - t_start
+
+# does background subtraction for many FOVs with one pool of processes
+class SubtractionEngine():
+    '''
+    Subtracts the analyzed channels of FOVs with one pool of worker processes which is
+    kept for the whole run. The empty stack of each FOV and the stack of each channel
+    are written once to .npy files in shared memory (/dev/shm where there is one)
+    and the workers memory map them, so frames are not pickled to the workers. Each
+    channel is split into blocks of time points, and the next channel is read while
+    the workers subtract the last one.
+
+    Several planes can be subtracted in one pass. The phase plane is then done first,
+    and its alignment offsets are used to align the empties of the other planes.
+
+    With segment, each subtracted phase stack is segmented with segment_image right
+    away, from the copy in shared memory, instead of being read back from disk by
+    mm3_Segment-Otsu.py. Stacks are written in a background thread while the workers
+    go on, and with write_subtracted False only the segmented phase stack is saved.
+
+    Use it as a context manager, or call close when done.
+    '''
+
+    def __init__(self, n_processes=None, block_size=None, segment=False, write_subtracted=True):
+        if n_processes is None:
+            n_processes = params['num_analyzers']
+        self.n_processes = n_processes
+        self.block_size = block_size # time points per task, None splits each channel over all processes
+        self.segment = segment # segment subtracted phase stacks in the same pass
+        self.write_subtracted = write_subtracted # save subtracted phase stacks when segmenting
+
+        shared_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        self.work_dir = tempfile.mkdtemp(prefix='mm3_subtract_', dir=shared_dir)
+        self.pool = Pool(processes=n_processes)
+
+        # one thread writes stacks in order. Reads and writes of the store share a lock
+        self.writer = ThreadPool(1)
+        self.store_lock = threading.Lock()
+        self.writes = []
+        self.segment_jobs = collections.deque()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close() # tells the process nothing more will be added.
+            self.pool.join() # blocks script until everything has been processed and workers exit
+            self.pool = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer.join()
+            self.writer = None
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def write_later(self, store, peak_id, color, img_stack):
+        '''Saves a stack through the store in the writer thread.'''
+
+        def write():
+            with self.store_lock:
+                store.write(peak_id, color, img_stack)
+            information("Saved %s for channel %d." % (color, peak_id))
+
+        self.writes.append(self.writer.apply_async(write))
+
+    def wait_writes(self):
+        '''Waits until all stacks are written, raising any error from the writer.'''
+        for result in self.writes:
+            result.get()
+        self.writes = []
+
+    def finish_segments(self, store, keep=0):
+        '''Waits for all but the last keep segmentations and saves them.'''
+
+        while len(self.segment_jobs) > keep:
+            peak_id, sub_path, seg_path, results = self.segment_jobs.popleft()
+            for result in results:
+                result.get()
+
+            segmented_stack = np.array(np.load(seg_path, mmap_mode='r'))
+            os.remove(sub_path)
+            os.remove(seg_path)
+
+            self.write_later(store, peak_id, params['seg_img'], segmented_stack)
+
+    def share(self, name, img_stack):
+        '''Writes a stack to a .npy file in the shared directory and returns its path.'''
+        path = os.path.join(self.work_dir, name + '.npy')
+        np.save(path, img_stack)
+        return path
+
+    def submit(self, fov_id, peak_id, color, image_data, empty_path, n_empty, method, offsets=None):
+        '''Sends the subtraction of one plane of a channel to the pool. Phase offsets are
+        recorded for 'phase', and offsets given for 'fluor' are used to align the empty.
+        Returns the job to pass to finish.'''
+
+        # as with zip, only time points with both an image and an empty are used
+        n_frames = min(image_data.shape[0], n_empty)
+
+        name = 'xy%03d_p%04d_%s' % (fov_id, peak_id, color)
+        image_path = self.share(name, image_data)
+        sub_path = os.path.join(self.work_dir, name + '_sub.npy')
+        np.lib.format.open_memmap(sub_path, mode='w+', dtype='uint16',
+                                  shape=(n_frames,) + image_data.shape[1:]).flush()
+
+        offsets_path = None
+        if method == 'phase':
+            offsets_path = os.path.join(self.work_dir, name + '_offsets.npy')
+            np.lib.format.open_memmap(offsets_path, mode='w+', dtype='int32', shape=(n_frames, 2)).flush()
+        elif offsets is not None and offsets.shape[0] >= n_frames:
+            offsets_path = self.share(name + '_offsets', offsets[:n_frames])
+
+        if self.block_size:
+            block_size = self.block_size
+        else:
+            block_size = max(int(np.ceil(n_frames / self.n_processes)), 1)
+
+        results = [self.pool.apply_async(subtract_stack_block,
+                                         ((method, image_path, empty_path, sub_path, offsets_path,
+                                           t_start, min(t_start + block_size, n_frames)),))
+                   for t_start in range(0, n_frames, block_size)]
+
+        return peak_id, color, method, image_path, sub_path, offsets_path, results
+
+    def finish(self, store, job):
+        '''Waits for the subtraction of one plane of a channel and saves it. Returns the
+        alignment offsets for a phase plane, None otherwise.'''
+
+        peak_id, color, method, image_path, sub_path, offsets_path, results = job
+
+        for result in results:
+            result.get()
+
+        subtracted_stack = np.array(np.load(sub_path, mmap_mode='r'))
+        os.remove(image_path)
+
+        offsets = None
+        if offsets_path is not None:
+            if method == 'phase':
+                offsets = np.array(np.load(offsets_path, mmap_mode='r'))
+            os.remove(offsets_path)
+
+        segment = self.segment and method == 'phase'
+        if segment:
+            # segment the subtracted stack from shared memory, it is removed afterwards
+            seg_path = os.path.join(self.work_dir, os.path.basename(sub_path)[:-len('_sub.npy')] + '_seg.npy')
+            np.lib.format.open_memmap(seg_path, mode='w+', dtype='uint8',
+                                      shape=subtracted_stack.shape).flush()
+
+            n_frames = subtracted_stack.shape[0]
+            block_size = self.block_size or max(int(np.ceil(n_frames / self.n_processes)), 1)
+            results = [self.pool.apply_async(segment_stack_block,
+                                             ((sub_path, seg_path, t_start, min(t_start + block_size, n_frames)),))
+                       for t_start in range(0, n_frames, block_size)]
+            self.segment_jobs.append((peak_id, sub_path, seg_path, results))
+        else:
+            os.remove(sub_path)
+
+        # save out the subtracted stack
+        if self.write_subtracted or not segment:
+            self.write_later(store, peak_id, 'sub_%s' % color, subtracted_stack)
+
+        return offsets
+
+    def subtract_fov(self, fov_id, peak_ids, empty_stacks, phase_color=None, peak_offsets=None):
+        '''Subtracts the channels peak_ids of one FOV for every plane in empty_stacks,
+        a dictionary of color : averaged empty stack, and saves them. Each stack is read
+        once.
+
+        If phase_color is one of the planes, it is subtracted first and its offsets are
+        used to align the other planes of the same channel. Otherwise the other planes
+        use peak_offsets, a dictionary of peak_id : offsets from an earlier phase pass,
+        and are not aligned for peaks without offsets.
+
+        Returns the offsets of the phase plane by peak_id.
+        '''
+
+        if peak_offsets is None:
+            peak_offsets = {}
+        new_offsets = {}
+
+        empty_paths = {color : self.share('xy%03d_empty_%s' % (fov_id, color), empty_stack)
+                       for color, empty_stack in six.iteritems(empty_stacks)}
+        n_empty = {color : empty_stack.shape[0] for color, empty_stack in six.iteritems(empty_stacks)}
+
+        def submit_fluor(peak_id, fluor_stacks, offsets):
+            return [self.submit(fov_id, peak_id, color, image_data, empty_paths[color], n_empty[color],
+                                'fluor', offsets=offsets)
+                    for color, image_data in six.iteritems(fluor_stacks)]
+
+        def finish_peak(peak_id, fluor_stacks, jobs):
+            for job in jobs:
+                offsets = self.finish(store, job)
+                if offsets is not None:
+                    new_offsets[peak_id] = offsets
+
+            # planes which were waiting for the phase offsets of this channel
+            for job in submit_fluor(peak_id, fluor_stacks, new_offsets.get(peak_id)):
+                self.finish(store, job)
+
+            # keep the newest segmentation running while the next channel is subtracted
+            self.finish_segments(store, keep=1)
+
+        # the HDF5 file is opened on the first write and kept open for all peaks
+        with StackStore(fov_id) as store:
+            pending = collections.deque()
+            for peak_id in peak_ids:
+                information('Subtracting peak %d.' % peak_id)
+
+                with self.store_lock:
+                    stacks = collections.OrderedDict((color, store.read(peak_id, color))
+                                                     for color in empty_stacks.keys())
+
+                if phase_color in stacks:
+                    jobs = [self.submit(fov_id, peak_id, phase_color, stacks.pop(phase_color),
+                                        empty_paths[phase_color], n_empty[phase_color], 'phase')]
+                else:
+                    jobs = submit_fluor(peak_id, stacks, peak_offsets.get(peak_id))
+                    stacks = {}
+                pending.append((peak_id, stacks, jobs))
+
+                # keep one channel queued while the workers are busy with the other
+                if len(pending) > 1:
+                    finish_peak(*pending.popleft())
+
+            while pending:
+                finish_peak(*pending.popleft())
+
+            # everything must be written before the store is closed
+            self.finish_segments(store)
+            self.wait_writes()
+
+        for empty_path in empty_paths.values():
+            os.remove(empty_path)
+
+        return new_offsets
+
+def subtract_fov_stack(fov_id, specs, color='c1', method='phase', engine=None):
     '''
     For a given FOV, loads the precomputed empty stack and does subtraction on
     all peaks in the FOV designated to be analyzed
 
     Parameters
     ----------
-    color : string, 'c1', 'c2', etc.
+    color : string, 'c1', 'c2', etc., or a list of them
         This is the channel to subtraction. will be appended to the word empty.
+        With a list, all planes are subtracted in one pass and the phase plane, if it
+        is in the list, is used to align the others.
+    method : 'phase' or 'fluor'
+        For a single color. The phase alignment offsets are saved, and fluorescence
+        uses saved offsets if subtract.align_fluor_to_phase is set.
+    engine : SubtractionEngine
+        Engine to do the subtraction with, so its pool can be reused for all FOVs.
+        If None, one is made for this FOV.
 
     Called by
     mm3_Subtract.py
 
     Calls
-    mm3.subtract_phase
-
+    mm3.SubtractionEngine
     '''
 
     information('Subtracting peaks for FOV %d.' % fov_id)
 
+    if isinstance(color, six.string_types):
+        colors = [color]
+        phase_color = color if method == 'phase' else None
+    else:
+        colors = list(color)
+        phase_color = params['phase_plane'] if params['phase_plane'] in colors else None
+
     # load empty stack feed dummy peak number to get empty
-    avg_empty_stack = load_stack(fov_id, 0, color='empty_{}'.format(color))
+    empty_stacks = collections.OrderedDict((plane, load_stack(fov_id, 0, color='empty_{}'.format(plane)))
+                                           for plane in colors)
 
     # determine which peaks are to be analyzed
     ana_peak_ids = []
@@ -1970,63 +4092,24 @@ def subtract_fov_stack(fov_id, specs, color='c1', method='phase'):
     if not ana_peak_ids:
         return False
 
-    # load images for the peak and get phase images
-    for peak_id in ana_peak_ids:
-        information('Subtracting peak %d.' % peak_id)
-
-        image_data = load_stack(fov_id, peak_id, color=color)
+    # offsets from an earlier phase subtraction, used to align fluorescence
+    peak_offsets = None
+    if phase_color is None and params['subtract']['align_fluor_to_phase']:
+        peak_offsets = load_subtract_offsets(fov_id)
 
-        # make a list for all time points to send to a multiprocessing pool
-        # list will length of image_data with tuples (image, empty)
-        subtract_pairs = zip(image_data, avg_empty_stack)
-
-        # set up multiprocessing pool to do subtraction. Should wait until finished
-        pool = Pool(processes=params['num_analyzers'])
-
-        if method == 'phase':
-            subtracted_imgs = pool.map(subtract_phase, subtract_pairs, chunksize=10)
-        elif method == 'fluor':
-            subtracted_imgs = pool.map(subtract_fluor, subtract_pairs, chunksize=10)
-
-        pool.close() # tells the process nothing more will be added.
-        pool.join() # blocks script until everything has been processed and workers exit
-
-        # linear loop for debug
-        # subtracted_imgs = [subtract_phase(subtract_pair) for subtract_pair in subtract_pairs]
-
-        # stack them up along a time axis
-        subtracted_stack = np.stack(subtracted_imgs, axis=0)
-
-        # save out the subtracted stack
-        if params['output'] == 'TIFF':
-            sub_filename = params['experiment_name'] + '_xy%03d_p%04d_sub_%s.tif' % (fov_id, peak_id, color)
-            tiff.imsave(os.path.join(params['sub_dir'],sub_filename), subtracted_stack, compress=4) # save it
-
-        if params['output'] == 'HDF5':
-            h5f = h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % fov_id), 'r+')
-
-            # put subtracted channel in correct group
-            h5g = h5f['channel_%04d' % peak_id]
-
-            # delete the dataset if it exists (important for debug)
-            if 'p%04d_sub_%s' % (peak_id, color) in h5g:
-                del h5g['p%04d_sub_%s' % (peak_id, color)]
-
-            h5ds = h5g.create_dataset(u'p%04d_sub_%s' % (peak_id, color),
-                            data=subtracted_stack,
-                            chunks=(1, subtracted_stack.shape[1], subtracted_stack.shape[2]),
-                            maxshape=(None, subtracted_stack.shape[1], subtracted_stack.shape[2]),
-                            compression="gzip", shuffle=True, fletcher32=True)
-
-        information("Saved subtracted channel %d." % peak_id)
+    if engine is None:
+        with SubtractionEngine() as engine:
+            new_offsets = engine.subtract_fov(fov_id, ana_peak_ids, empty_stacks, phase_color, peak_offsets)
+    else:
+        new_offsets = engine.subtract_fov(fov_id, ana_peak_ids, empty_stacks, phase_color, peak_offsets)
 
-    if params['output'] == 'HDF5':
-        h5f.close()
+    if phase_color is not None:
+        save_subtract_offsets(fov_id, new_offsets)
 
     return True
 
 # subtracts one phase contrast image from another.
-def subtract_phase(image_pair):
+def subtract_phase(image_pair, return_offset=False):
     '''subtract_phase aligns and subtracts a .
     Modified from subtract_phase_only by jt on 20160511
     The subtracted image returned is the same size as the image given. It may however include
@@ -2036,13 +4119,15 @@ def subtract_phase(image_pair):
 
     Parameters
     image_pair : tuple of length two with; (image, empty_mean)
+    return_offset : bool
+        Also return the (row, column) offset of the empty, as in align_empty_stack.
 
     Returns
     channel_subtracted : np.array
         The subtracted image
 
     Called by
-    subtract_fov_stack
+    subtract_stack_block
     '''
     # get out data and pad
     cropped_channel, empty_channel = image_pair # [channel slice, empty slice]
@@ -2074,6 +4159,158 @@ def subtract_phase(image_pair):
     channel_subtracted[channel_subtracted < 0] = 0
     channel_subtracted = channel_subtracted.astype('uint16') # change back to 16bit
 
+    if return_offset:
+        return channel_subtracted, (pad_size - y, pad_size - x)
+    return channel_subtracted
+
+# indices into an axis of length n as if it were padded with mode='reflect'
+def reflect_indices(indices, n):
+    if n == 1:
+        return np.zeros_like(indices)
+    period = 2 * (n - 1)
+    indices = np.mod(indices, period)
+    return np.where(indices > n - 1, period - indices, indices)
+
+# sums of all (h, w) windows of each image in a stack
+def window_sums(img_stack, h, w):
+    '''Returns the sum of every (h, w) window of each image in a (frames, rows, columns)
+    stack, from an integral image. The result has shape (frames, rows-h+1, columns-w+1).'''
+    integral = np.zeros((img_stack.shape[0], img_stack.shape[1]+1, img_stack.shape[2]+1))
+    integral[:,1:,1:] = img_stack.cumsum(axis=1).cumsum(axis=2)
+    return (integral[:,h:,w:] - integral[:,:-h,w:] - integral[:,h:,:-w] + integral[:,:-h,:-w])
+
+# alignment of a stack of images to a stack of reference images
+def match_template_offsets(ref_stack, img_stack):
+    '''Finds, for every frame, where an image best matches its reference image within
+    params['subtract']['alignment_pad'] pixels. The score is the normalized
+    cross-correlation match_template gives for the image against the reference padded
+    with mode='reflect', but the correlations of all frames are computed together by
+    FFT. Returns (frames, 2) offsets for align_empty_stack, which moves the images onto
+    their references. The images and references must have the same shape.
+
+    Called by
+    subtract_phase_stack
+    average_empties_batch
+    '''
+
+    pad_size = params['subtract']['alignment_pad'] # pixel size to use for padding (ammount that alignment could be off)
+    n_frames, h, w = img_stack.shape
+
+    # pad the references like subtract_phase does, all frames at once
+    padded_chnl = np.pad(ref_stack.astype('float64'),
+                         ((0,0), (pad_size,pad_size), (pad_size,pad_size)), mode='reflect')
+    fft_shape = padded_chnl.shape[1:]
+
+    # cross-correlation of each padded reference with its zero mean image. Positions
+    #    where the image fits in the padded reference don't wrap around
+    template = img_stack.astype('float64')
+    template = template - template.mean(axis=(1,2), keepdims=True)
+    xcorr = np.fft.irfft2(np.fft.rfft2(padded_chnl, axes=(1,2)) *
+                          np.conj(np.fft.rfft2(template, s=fft_shape, axes=(1,2))),
+                          s=fft_shape, axes=(1,2))[:,:2*pad_size+1,:2*pad_size+1]
+
+    # normalize as match_template does
+    window_sum = window_sums(padded_chnl, h, w)
+    window_sum2 = window_sums(padded_chnl**2, h, w)
+    denominator = np.sqrt(np.maximum(window_sum2 - window_sum**2 / (h*w), 0) *
+                          (template**2).sum(axis=(1,2))[:,np.newaxis,np.newaxis])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        match_result = np.where(denominator > np.finfo('float64').eps, xcorr / denominator, 0)
+
+    # get row and colum of max correlation value for each frame
+    y, x = np.unravel_index(np.argmax(match_result.reshape(n_frames, -1), axis=1), match_result.shape[1:])
+
+    # the image placed at (y, x) in the padded reference, trimmed back to the reference size
+    return np.stack((pad_size - y, pad_size - x), axis=1)
+
+# moves each frame of an empty stack by its alignment offset
+def align_empty_stack(empty_stack, offsets):
+    '''Returns the empty stack with each frame moved by its (row, column) offset, so that
+    aligned_empty[t, r, c] = empty_stack[t, r + offsets[t,0], c + offsets[t,1]]. Pixels
+    moved in from outside the frame are reflected, as np.pad does with mode='reflect'.
+    The offsets are those returned by subtract_phase_stack and subtract_phase.'''
+
+    n_frames, h, w = empty_stack.shape
+    offsets = np.asarray(offsets, dtype='int64')
+
+    rows = reflect_indices(np.arange(h)[np.newaxis,:] + offsets[:,0,np.newaxis], h)
+    cols = reflect_indices(np.arange(w)[np.newaxis,:] + offsets[:,1,np.newaxis], w)
+    return empty_stack[np.arange(n_frames)[:,np.newaxis,np.newaxis],
+                       rows[:,:,np.newaxis], cols[:,np.newaxis,:]]
+
+# subtracts a stack of empty phase images from a stack of phase images
+def subtract_phase_stack(image_stack, empty_stack, return_offsets=False):
+    '''Does what subtract_phase does for every frame of a channel stack at once.
+
+    Each empty frame is aligned to its channel frame by match_template_offsets, which
+    does the alignment of all frames together by FFT, and the aligned empties are made
+    by indexing the empty stack with reflected indices instead of padding each frame.
+    If the empty is not the same size as the channel, frames are aligned and subtracted
+    one at a time by subtract_phase.
+
+    Parameters
+    image_stack : np.array
+        (frames, rows, columns) phase stack of a channel.
+    empty_stack : np.array
+        Empty stack with the same number of frames.
+    return_offsets : bool
+        Also return the (frames, 2) offsets of the empty, for align_empty_stack.
+
+    Returns
+    channel_subtracted : np.array
+        The subtracted stack, uint16
+
+    Called by
+    subtract_stack_block
+    '''
+
+    if image_stack.shape[1:] != empty_stack.shape[1:]:
+        results = [subtract_phase((image, empty), return_offset=True)
+                   for image, empty in zip(image_stack, empty_stack)]
+        channel_subtracted = np.stack([result[0] for result in results], axis=0)
+        if return_offsets:
+            offsets = np.array([result[1] for result in results], dtype='int64').reshape(-1, 2)
+            return channel_subtracted, offsets
+        return channel_subtracted
+
+    offsets = match_template_offsets(image_stack, empty_stack)
+    aligned_empty = align_empty_stack(empty_stack, offsets)
+
+    ### Compute the difference between the empty and channel phase contrast images
+    # subtract cropped cell image from empty channel.
+    channel_subtracted = aligned_empty.astype('int32') - image_stack.astype('int32')
+
+    # just zero out anything less than 0. This is what Sattar does
+    channel_subtracted[channel_subtracted < 0] = 0
+    channel_subtracted = channel_subtracted.astype('uint16') # change back to 16bit
+
+    if return_offsets:
+        return channel_subtracted, offsets
+    return channel_subtracted
+
+# subtracts a stack of empty fluorescence images using the phase alignment
+def subtract_fluor_stack(image_stack, empty_stack, offsets):
+    '''Subtracts the empty from a fluorescence stack like subtract_fluor, but first moves
+    each empty frame by the offsets found when subtracting the phase plane of the same
+    channel. If the empty is not the same size as the channel, frames are subtracted
+    one at a time without alignment by subtract_fluor.
+
+    Called by
+    subtract_stack_block
+    '''
+
+    if image_stack.shape[1:] != empty_stack.shape[1:]:
+        return np.stack([subtract_fluor((image, empty)) for image, empty in zip(image_stack, empty_stack)], axis=0)
+
+    aligned_empty = align_empty_stack(empty_stack, offsets)
+
+    ### Compute the difference between the empty and channel images
+    channel_subtracted = image_stack.astype('int32') - aligned_empty.astype('int32')
+
+    # just zero out anything less than 0.
+    channel_subtracted[channel_subtracted < 0] = 0
+    channel_subtracted = channel_subtracted.astype('uint16') # change back to 16bit
+
     return channel_subtracted
 
 # subtract one fluorescence image from another.
@@ -2089,7 +4326,7 @@ def subtract_fluor(image_pair):
         The subtracted image.
 
     Called by
-    subtract_fov_stack
+    subtract_stack_block
     '''
     # get out data and pad
     cropped_channel, empty_channel = image_pair # [channel slice, empty slice]
@@ -2124,74 +4361,184 @@ def subtract_fluor(image_pair):
 ### functions that deal with segmentation and lineages
 
 # Do segmentation for an channel time stack
-def segment_chnl_stack(fov_id, peak_id):
+def segment_chnl_stack(fov_id, peak_id, engine=None):
     '''
     For a given fov and peak (channel), do segmentation for all images in the
     subtracted .tif stack.
 
+    Parameters
+    ----------
+    engine : SegmentationEngine
+        Engine to do the segmentation with, so its pool can be reused for all channels.
+        If None, one is made for this channel. To segment many channels, pass them all
+        to SegmentationEngine.segment_peaks instead, so they are segmented in parallel.
+
     Called by
     mm3_Segment.py
 
     Calls
-    mm3.segment_image
+    mm3.SegmentationEngine
     '''
 
-    information('Segmenting FOV %d, channel %d.' % (fov_id, peak_id))
-
-    # load subtracted images
-    sub_stack = load_stack(fov_id, peak_id, color='sub_{}'.format(params['phase_plane']))
-
-    # set up multiprocessing pool to do segmentation. Will do everything before going on.
-    pool = Pool(processes=params['num_analyzers'])
-
-    # send the 3d array to multiprocessing
-    segmented_imgs = pool.map(segment_image, sub_stack, chunksize=8)
-
-    pool.close() # tells the process nothing more will be added.
-    pool.join() # blocks script until everything has been processed and workers exit
-
-    # # image by image for debug
-    # segmented_imgs = []
-    # for sub_image in sub_stack:
-    #     segmented_imgs.append(segment_image(sub_image))
-
-    # stack them up along a time axis
-    segmented_imgs = np.stack(segmented_imgs, axis=0)
-    segmented_imgs = segmented_imgs.astype('uint8')
-
-    # save out the segmented stack
-    if params['output'] == 'TIFF':
-        seg_filename = params['experiment_name'] + '_xy%03d_p%04d_%s.tif' % (fov_id, peak_id, params['seg_img'])
-        tiff.imsave(os.path.join(params['seg_dir'],seg_filename),
-                    segmented_imgs, compress=5)
-
-    if params['output'] == 'HDF5':
-        h5f = h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % fov_id), 'r+')
-
-        # put segmented channel in correct group
-        h5g = h5f['channel_%04d' % peak_id]
-
-        # delete the dataset if it exists (important for debug)
-        if 'p%04d_%s' % (peak_id, params['seg_img']) in h5g:
-            del h5g['p%04d_%s' % (peak_id, params['seg_img'])]
+    if engine is None:
+        with SegmentationEngine() as engine:
+            engine.segment_peaks([(fov_id, peak_id)])
+    else:
+        engine.segment_peaks([(fov_id, peak_id)])
 
-        h5ds = h5g.create_dataset(u'p%04d_%s' % (peak_id, params['seg_img']),
-                        data=segmented_imgs,
-                        chunks=(1, segmented_imgs.shape[1], segmented_imgs.shape[2]),
-                        maxshape=(None, segmented_imgs.shape[1], segmented_imgs.shape[2]),
-                        compression="gzip", shuffle=True, fletcher32=True)
-        h5f.close()
+    return True
 
-    information("Saved segmented channel %d." % peak_id)
+# segments many channels with one pool of processes
+class SegmentationEngine():
+    '''
+    Segments the subtracted phase channels of many FOVs with segment_image, using one
+    pool of worker processes which is kept for the whole run. Each channel is a task,
+    and channels longer than block_size time points are split into blocks of time
+    points, so short channels do not each start a pool and long ones still use all
+    processes. The subtracted stacks are written once to .npy files in shared memory
+    (/dev/shm where there is one) and the workers memory map them, so frames are not
+    pickled to the workers.
+
+    Channels of all FOVs are queued together, up to max_queued at a time, and each
+    segmented stack is saved as soon as it is done, in whatever order they finish.
+
+    Use it as a context manager, or call close when done.
+    '''
 
-    return True
+    def __init__(self, n_processes=None, block_size=200, max_queued=None):
+        if n_processes is None:
+            n_processes = params['num_analyzers']
+        self.n_processes = n_processes
+        self.block_size = block_size # most time points per task, None does each channel as one task
+        if max_queued is None:
+            max_queued = 2 * n_processes
+        self.max_queued = max_queued # channels in shared memory at once
+
+        shared_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+        self.work_dir = tempfile.mkdtemp(prefix='mm3_segment_', dir=shared_dir)
+        self.pool = Pool(processes=n_processes)
+
+        # channels whose blocks are all segmented, or which failed
+        self.done = six.moves.queue.Queue()
+        self.remaining = {} # blocks left by channel
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close() # tells the process nothing more will be added.
+            self.pool.join() # blocks script until everything has been processed and workers exit
+            self.pool = None
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def submit(self, fov_id, peak_id, sub_stack):
+        '''Sends the segmentation of one channel to the pool. It is put on self.done
+        when finished.'''
+
+        name = 'xy%03d_p%04d' % (fov_id, peak_id)
+        sub_path = os.path.join(self.work_dir, name + '_sub.npy')
+        np.save(sub_path, sub_stack)
+        seg_path = os.path.join(self.work_dir, name + '_seg.npy')
+        np.lib.format.open_memmap(seg_path, mode='w+', dtype='uint8', shape=sub_stack.shape).flush()
+
+        job = (fov_id, peak_id, sub_path, seg_path)
+        n_frames = sub_stack.shape[0]
+        block_size = self.block_size or n_frames
+        t_starts = list(range(0, n_frames, block_size))
+
+        if not t_starts:
+            self.done.put((job, None))
+            return
+
+        # the callbacks are all run in the result thread of the pool, one at a time
+        self.remaining[job] = len(t_starts)
+
+        def block_done(result):
+            self.remaining[job] -= 1
+            if self.remaining[job] == 0:
+                del self.remaining[job]
+                self.done.put((job, None))
+
+        def block_failed(error):
+            self.done.put((job, error))
+
+        for t_start in t_starts:
+            self.pool.apply_async(segment_stack_block,
+                                  ((sub_path, seg_path, t_start, min(t_start + block_size, n_frames)),),
+                                  callback=block_done, error_callback=block_failed)
+
+    def save(self, store, job):
+        '''Saves a segmented channel and removes its shared files.'''
+
+        fov_id, peak_id, sub_path, seg_path = job
+
+        segmented_stack = np.array(np.load(seg_path, mmap_mode='r'))
+        os.remove(sub_path)
+        os.remove(seg_path)
+
+        store.write(peak_id, params['seg_img'], segmented_stack)
+        information("Saved segmented channel %d of FOV %d." % (peak_id, fov_id))
+
+    def segment_peaks(self, fov_peak_ids):
+        '''Segments and saves the channels in fov_peak_ids, a list of (fov_id, peak_id).
+        Channels are read in order while the workers segment the ones before.'''
+
+        fov_peak_ids = list(fov_peak_ids)
+
+        # the store of a FOV is kept open until all its channels are saved
+        unsaved = collections.Counter(fov_id for fov_id, peak_id in fov_peak_ids)
+        stores = {}
+
+        def save_next():
+            job, error = self.done.get()
+            if error is not None:
+                raise error
+
+            fov_id = job[0]
+            self.save(stores[fov_id], job)
+            unsaved[fov_id] -= 1
+            if unsaved[fov_id] == 0:
+                stores.pop(fov_id).close()
+
+        queued = 0
+        try:
+            for fov_id, peak_id in fov_peak_ids:
+                # save what is done, and wait if too many channels are queued
+                while queued and (queued >= self.max_queued or not self.done.empty()):
+                    save_next()
+                    queued -= 1
+
+                information('Segmenting FOV %d, channel %d.' % (fov_id, peak_id))
+                if fov_id not in stores:
+                    stores[fov_id] = StackStore(fov_id)
+                sub_stack = stores[fov_id].read(peak_id, 'sub_{}'.format(params['phase_plane']))
+
+                self.submit(fov_id, peak_id, np.asarray(sub_stack))
+                queued += 1
+
+            while queued:
+                save_next()
+                queued -= 1
+        finally:
+            for store in stores.values():
+                store.close()
 
 # segmentation algorithm
-def segment_image(image):
+def segment_image(image, engine=None):
     '''Segments a subtracted image and returns a labeled image
 
     Parameters
     image : a ndarray which is an image. This should be the subtracted image
+    engine : string
+        How the markers are grown into cells. 'random_walker' (diffusion watershed),
+        'watershed' (marker watershed on the inverted image) or 'watershed_distance'
+        (marker watershed on the distance to the background). Defaults to
+        params['segment']['otsu_engine']. The watersheds are much faster, see
+        aux/mm3_benchmark_segmentation.py for how their labels compare.
 
     Returns
     labeled_image : a ndarray which is also an image. Labeled values, which
@@ -2200,6 +4547,8 @@ def segment_image(image):
     '''
 
     # load in segmentation parameters
+    if engine is None:
+        engine = params['segment']['otsu_engine']
     OTSU_threshold = params['segment']['OTSU_threshold']
     first_opening_size = params['segment']['first_opening_size']
     distance_threshold = params['segment']['distance_threshold']
@@ -2265,6 +4614,16 @@ def segment_image(image):
     threshholded_watershed = threshholded
     threshholded_watershed = segmentation.clear_border(threshholded_watershed)
 
+    # label using a marker watershed, flooding the cells from the markers within the threshold
+    if engine in ('watershed', 'watershed_distance'):
+        if engine == 'watershed':
+            # cells are bright, so the dim gaps between them are the ridges
+            landscape = -1 * image.astype('float64')
+        else:
+            landscape = -1 * ndi.distance_transform_edt(threshholded_watershed)
+        labeled_image = watershed(landscape, markers, mask=threshholded_watershed)
+        return labeled_image
+
     # label using the random walker (diffusion watershed) algorithm
     try:
         # set anything outside of OTSU threshold to -1 so it will not be labeled
@@ -2372,107 +4731,91 @@ def segment_cells_unet(ana_peak_ids, fov_id, pad_dict, unet_shape, model):
                         workers=params['num_analyzers'],
                         verbose=1)
 
-    for peak_id in ana_peak_ids:
-        information('Segmenting peak {}.'.format(peak_id))
-
-        img_stack = load_stack(fov_id, peak_id, color=params['phase_plane'])
-
-        if params['segment']['normalize_to_one']:
-            med_stack = np.zeros(img_stack.shape)
-            selem = morphology.disk(1)
-
-            for frame_idx in range(img_stack.shape[0]):
-                tmpImg = img_stack[frame_idx,...]
-                med_stack[frame_idx,...] = median(tmpImg, selem)
-
-            # robust normalization of peak's image stack to 1
-            max_val = np.max(med_stack)
-            img_stack = img_stack/max_val
-            img_stack[img_stack > 1] = 1
-
-        # trim and pad image to correct size
-        img_stack = img_stack[:, :unet_shape[0], :unet_shape[1]]
-        img_stack = np.pad(img_stack,
-                           ((0,0),
-                           (pad_dict['top_pad'],pad_dict['bottom_pad']),
-                           (pad_dict['left_pad'],pad_dict['right_pad'])),
-                           mode='constant')
-        img_stack = np.expand_dims(img_stack, -1) # TF expects images to be 4D
-        # set up image generator
-        # image_generator = CellSegmentationDataGenerator(img_stack, **data_gen_args)
-        image_datagen = ImageDataGenerator()
-        image_generator = image_datagen.flow(x=img_stack,
-                                             batch_size=batch_size,
-                                             shuffle=False) # keep same order
-
-        # predict cell locations. This has multiprocessing built in but I need to mess with the parameters to see how to best utilize it. ***
-        predictions = model.predict_generator(image_generator, **predict_args)
-
-        # post processing
-        # remove padding including the added last dimension
-        predictions = predictions[:, pad_dict['top_pad']:unet_shape[0]-pad_dict['bottom_pad'],
-                                     pad_dict['left_pad']:unet_shape[1]-pad_dict['right_pad'], 0]
-
-        # pad back incase the image had been trimmed
-        predictions = np.pad(predictions,
-                             ((0,0),
-                             (0,pad_dict['bottom_trim']),
-                             (0,pad_dict['right_trim'])),
-                             mode='constant')
-
-        if params['segment']['save_predictions']:
-            pred_filename = params['experiment_name'] + '_xy%03d_p%04d_%s.tif' % (fov_id, peak_id, params['pred_img'])
-            if not os.path.isdir(params['pred_dir']):
-                os.makedirs(params['pred_dir'])
-            int_preds = (predictions * 255).astype('uint8')
-            tiff.imsave(os.path.join(params['pred_dir'], pred_filename),
-                            int_preds, compress=4)
-
-        # binarized and label (if there is a threshold value, otherwise, save a grayscale for debug)
-        if cellClassThreshold:
-            predictions[predictions >= cellClassThreshold] = 1
-            predictions[predictions < cellClassThreshold] = 0
-            predictions = predictions.astype('uint8')
-
-            segmented_imgs = np.zeros(predictions.shape, dtype='uint8')
-            # process and label each frame of the channel
-            for frame in range(segmented_imgs.shape[0]):
-                # get rid of small holes
-                predictions[frame,:,:] = morphology.remove_small_holes(predictions[frame,:,:], min_object_size)
-                # get rid of small objects.
-                predictions[frame,:,:] = morphology.remove_small_objects(morphology.label(predictions[frame,:,:], connectivity=1), min_size=min_object_size)
-                # remove labels which touch the boarder
-                predictions[frame,:,:] = segmentation.clear_border(predictions[frame,:,:])
-                # relabel now
-                segmented_imgs[frame,:,:] = morphology.label(predictions[frame,:,:], connectivity=1)
-
-        else: # in this case you just want to scale the 0 to 1 float image to 0 to 255
-            information('Converting predictions to grayscale.')
-            segmented_imgs = np.around(predictions * 100)
-
-        # both binary and grayscale should be 8bit. This may be ensured above and is unneccesary
-        segmented_imgs = segmented_imgs.astype('uint8')
-
-        # save out the segmented stacks
-        if params['output'] == 'TIFF':
-            seg_filename = params['experiment_name'] + '_xy%03d_p%04d_%s.tif' % (fov_id, peak_id, params['seg_img'])
-            tiff.imsave(os.path.join(params['seg_dir'], seg_filename),
-                            segmented_imgs, compress=4)
-
-        if params['output'] == 'HDF5':
-            h5f = h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % fov_id), 'r+')
-            # put segmented channel in correct group
-            h5g = h5f['channel_%04d' % peak_id]
-            # delete the dataset if it exists (important for debug)
-            if 'p%04d_%s' % (peak_id, params['seg_img']) in h5g:
-                del h5g['p%04d_%s' % (peak_id, params['seg_img'])]
-
-            h5ds = h5g.create_dataset(u'p%04d_%s' % (peak_id, params['seg_img']),
-                                data=segmented_imgs,
-                                chunks=(1, segmented_imgs.shape[1], segmented_imgs.shape[2]),
-                                maxshape=(None, segmented_imgs.shape[1], segmented_imgs.shape[2]),
-                                compression="gzip", shuffle=True, fletcher32=True)
-            h5f.close()
+    # the HDF5 file is opened on the first write and kept open for all peaks
+    with StackStore(fov_id) as store:
+        for peak_id in ana_peak_ids:
+            information('Segmenting peak {}.'.format(peak_id))
+
+            img_stack = store.read(peak_id, params['phase_plane'])
+
+            if params['segment']['normalize_to_one']:
+                med_stack = np.zeros(img_stack.shape)
+                selem = morphology.disk(1)
+
+                for frame_idx in range(img_stack.shape[0]):
+                    tmpImg = img_stack[frame_idx,...]
+                    med_stack[frame_idx,...] = median(tmpImg, selem)
+
+                # robust normalization of peak's image stack to 1
+                max_val = np.max(med_stack)
+                img_stack = img_stack/max_val
+                img_stack[img_stack > 1] = 1
+
+            # trim and pad image to correct size
+            img_stack = img_stack[:, :unet_shape[0], :unet_shape[1]]
+            img_stack = np.pad(img_stack,
+                               ((0,0),
+                               (pad_dict['top_pad'],pad_dict['bottom_pad']),
+                               (pad_dict['left_pad'],pad_dict['right_pad'])),
+                               mode='constant')
+            img_stack = np.expand_dims(img_stack, -1) # TF expects images to be 4D
+            # set up image generator
+            # image_generator = CellSegmentationDataGenerator(img_stack, **data_gen_args)
+            image_datagen = ImageDataGenerator()
+            image_generator = image_datagen.flow(x=img_stack,
+                                                 batch_size=batch_size,
+                                                 shuffle=False) # keep same order
+
+            # predict cell locations. This has multiprocessing built in but I need to mess with the parameters to see how to best utilize it. ***
+            predictions = model.predict_generator(image_generator, **predict_args)
+
+            # post processing
+            # remove padding including the added last dimension
+            predictions = predictions[:, pad_dict['top_pad']:unet_shape[0]-pad_dict['bottom_pad'],
+                                         pad_dict['left_pad']:unet_shape[1]-pad_dict['right_pad'], 0]
+
+            # pad back incase the image had been trimmed
+            predictions = np.pad(predictions,
+                                 ((0,0),
+                                 (0,pad_dict['bottom_trim']),
+                                 (0,pad_dict['right_trim'])),
+                                 mode='constant')
+
+            if params['segment']['save_predictions']:
+                pred_filename = params['experiment_name'] + '_xy%03d_p%04d_%s.tif' % (fov_id, peak_id, params['pred_img'])
+                if not os.path.isdir(params['pred_dir']):
+                    os.makedirs(params['pred_dir'])
+                int_preds = (predictions * 255).astype('uint8')
+                tiff.imsave(os.path.join(params['pred_dir'], pred_filename),
+                                int_preds, compress=4)
+
+            # binarized and label (if there is a threshold value, otherwise, save a grayscale for debug)
+            if cellClassThreshold:
+                predictions[predictions >= cellClassThreshold] = 1
+                predictions[predictions < cellClassThreshold] = 0
+                predictions = predictions.astype('uint8')
+
+                segmented_imgs = np.zeros(predictions.shape, dtype='uint8')
+                # process and label each frame of the channel
+                for frame in range(segmented_imgs.shape[0]):
+                    # get rid of small holes
+                    predictions[frame,:,:] = morphology.remove_small_holes(predictions[frame,:,:], min_object_size)
+                    # get rid of small objects.
+                    predictions[frame,:,:] = morphology.remove_small_objects(morphology.label(predictions[frame,:,:], connectivity=1), min_size=min_object_size)
+                    # remove labels which touch the boarder
+                    predictions[frame,:,:] = segmentation.clear_border(predictions[frame,:,:])
+                    # relabel now
+                    segmented_imgs[frame,:,:] = morphology.label(predictions[frame,:,:], connectivity=1)
+
+            else: # in this case you just want to scale the 0 to 1 float image to 0 to 255
+                information('Converting predictions to grayscale.')
+                segmented_imgs = np.around(predictions * 100)
+
+            # both binary and grayscale should be 8bit. This may be ensured above and is unneccesary
+            segmented_imgs = segmented_imgs.astype('uint8')
+
+            # save out the segmented stacks
+            store.write(peak_id, params['seg_img'], segmented_imgs)
 
 #@profile
 def segment_fov_unet(fov_id, specs, model, color=None):
@@ -2539,83 +4882,67 @@ def segment_foci_unet(ana_peak_ids, fov_id, pad_dict, unet_shape, model):
                         # workers=params['num_analyzers'],
                         verbose=1)
 
-    for peak_id in ana_peak_ids:
-        information('Segmenting foci in peak {}.'.format(peak_id))
-        # print(peak_id) # debugging a shape error at some traps
-
-        img_stack = load_stack(fov_id, peak_id, color=params['foci']['foci_plane'])
-
-        # pad image to correct size
-        img_stack = np.pad(img_stack,
-                           ((0,0),
-                           (pad_dict['top_pad'],pad_dict['bottom_pad']),
-                           (pad_dict['left_pad'],pad_dict['right_pad'])),
-                           mode='constant')
-        img_stack = np.expand_dims(img_stack, -1)
-        # set up image generator
-        image_generator = FocusSegmentationDataGenerator(img_stack, **data_gen_args)
-
-        # predict foci locations.
-        predictions = model.predict_generator(image_generator, **predict_args)
-
-        # post processing
-        # remove padding including the added last dimension
-        predictions = predictions[:, pad_dict['top_pad']:unet_shape[0]-pad_dict['bottom_pad'],
-                                     pad_dict['left_pad']:unet_shape[1]-pad_dict['right_pad'], 0]
-
-        if params['foci']['save_predictions']:
-            pred_filename = params['experiment_name'] + '_xy%03d_p%04d_%s.tif' % (fov_id, peak_id, params['pred_img'])
-            if not os.path.isdir(params['foci_pred_dir']):
-                os.makedirs(params['foci_pred_dir'])
-            int_preds = (predictions * 255).astype('uint8')
-            tiff.imsave(os.path.join(params['foci_pred_dir'], pred_filename),
-                            int_preds, compress=4)
-
-        # binarized and label (if there is a threshold value, otherwise, save a grayscale for debug)
-        if focusClassThreshold:
-            predictions[predictions >= focusClassThreshold] = 1
-            predictions[predictions < focusClassThreshold] = 0
-            predictions = predictions.astype('uint8')
-
-            segmented_imgs = np.zeros(predictions.shape, dtype='uint8')
-            # process and label each frame of the channel
-            for frame in range(segmented_imgs.shape[0]):
-                # get rid of small holes
-                # predictions[frame,:,:] = morphology.remove_small_holes(predictions[frame,:,:], min_object_size)
-                # get rid of small objects.
-                # predictions[frame,:,:] = morphology.remove_small_objects(morphology.label(predictions[frame,:,:], connectivity=1), min_size=min_object_size)
-                # remove labels which touch the boarder
-                predictions[frame,:,:] = segmentation.clear_border(predictions[frame,:,:])
-                # relabel now
-                segmented_imgs[frame,:,:] = morphology.label(predictions[frame,:,:], connectivity=2)
-
-        else: # in this case you just want to scale the 0 to 1 float image to 0 to 255
-            information('Converting predictions to grayscale.')
-            segmented_imgs = np.around(predictions * 100)
-
-        # both binary and grayscale should be 8bit. This may be ensured above and is unneccesary
-        segmented_imgs = segmented_imgs.astype('uint8')
-
-        # save out the segmented stacks
-        if params['output'] == 'TIFF':
-            seg_filename = params['experiment_name'] + '_xy%03d_p%04d_%s.tif' % (fov_id, peak_id, params['seg_img'])
-            tiff.imsave(os.path.join(params['foci_seg_dir'], seg_filename),
-                            segmented_imgs, compress=4)
-
-        if params['output'] == 'HDF5':
-            h5f = h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % fov_id), 'r+')
-            # put segmented channel in correct group
-            h5g = h5f['channel_%04d' % peak_id]
-            # delete the dataset if it exists (important for debug)
-            if 'p%04d_%s' % (peak_id, params['seg_img']) in h5g:
-                del h5g['p%04d_%s' % (peak_id, params['seg_img'])]
-
-            h5ds = h5g.create_dataset(u'p%04d_%s' % (peak_id, params['seg_img']),
-                                data=segmented_imgs,
-                                chunks=(1, segmented_imgs.shape[1], segmented_imgs.shape[2]),
-                                maxshape=(None, segmented_imgs.shape[1], segmented_imgs.shape[2]),
-                                compression="gzip", shuffle=True, fletcher32=True)
-            h5f.close()
+    # the HDF5 file is opened on the first write and kept open for all peaks
+    with StackStore(fov_id) as store:
+        for peak_id in ana_peak_ids:
+            information('Segmenting foci in peak {}.'.format(peak_id))
+            # print(peak_id) # debugging a shape error at some traps
+
+            img_stack = store.read(peak_id, params['foci']['foci_plane'])
+
+            # pad image to correct size
+            img_stack = np.pad(img_stack,
+                               ((0,0),
+                               (pad_dict['top_pad'],pad_dict['bottom_pad']),
+                               (pad_dict['left_pad'],pad_dict['right_pad'])),
+                               mode='constant')
+            img_stack = np.expand_dims(img_stack, -1)
+            # set up image generator
+            image_generator = FocusSegmentationDataGenerator(img_stack, **data_gen_args)
+
+            # predict foci locations.
+            predictions = model.predict_generator(image_generator, **predict_args)
+
+            # post processing
+            # remove padding including the added last dimension
+            predictions = predictions[:, pad_dict['top_pad']:unet_shape[0]-pad_dict['bottom_pad'],
+                                         pad_dict['left_pad']:unet_shape[1]-pad_dict['right_pad'], 0]
+
+            if params['foci']['save_predictions']:
+                pred_filename = params['experiment_name'] + '_xy%03d_p%04d_%s.tif' % (fov_id, peak_id, params['pred_img'])
+                if not os.path.isdir(params['foci_pred_dir']):
+                    os.makedirs(params['foci_pred_dir'])
+                int_preds = (predictions * 255).astype('uint8')
+                tiff.imsave(os.path.join(params['foci_pred_dir'], pred_filename),
+                                int_preds, compress=4)
+
+            # binarized and label (if there is a threshold value, otherwise, save a grayscale for debug)
+            if focusClassThreshold:
+                predictions[predictions >= focusClassThreshold] = 1
+                predictions[predictions < focusClassThreshold] = 0
+                predictions = predictions.astype('uint8')
+
+                segmented_imgs = np.zeros(predictions.shape, dtype='uint8')
+                # process and label each frame of the channel
+                for frame in range(segmented_imgs.shape[0]):
+                    # get rid of small holes
+                    # predictions[frame,:,:] = morphology.remove_small_holes(predictions[frame,:,:], min_object_size)
+                    # get rid of small objects.
+                    # predictions[frame,:,:] = morphology.remove_small_objects(morphology.label(predictions[frame,:,:], connectivity=1), min_size=min_object_size)
+                    # remove labels which touch the boarder
+                    predictions[frame,:,:] = segmentation.clear_border(predictions[frame,:,:])
+                    # relabel now
+                    segmented_imgs[frame,:,:] = morphology.label(predictions[frame,:,:], connectivity=2)
+
+            else: # in this case you just want to scale the 0 to 1 float image to 0 to 255
+                information('Converting predictions to grayscale.')
+                segmented_imgs = np.around(predictions * 100)
+
+            # both binary and grayscale should be 8bit. This may be ensured above and is unneccesary
+            segmented_imgs = segmented_imgs.astype('uint8')
+
+            # save out the segmented stacks
+            store.write(peak_id, params['seg_img'], segmented_imgs)
 
 def segment_fov_foci_unet(fov_id, specs, model, color=None):
     '''
@@ -6055,13 +8382,7 @@ def find_cell_intensities_worker(fov_id, peak_id, Cells, midline=True, channel='
     seg_stack = load_stack(fov_id, peak_id, color='seg_otsu')
 
     # determine absolute time index
-    time_table = params['time_table']
-    times_all = []
-    for fov in params['time_table']:
-        times_all = np.append(times_all, [int(x) for x in time_table[fov].keys()])
-    times_all = np.unique(times_all)
-    times_all = np.sort(times_all)
-    times_all = np.array(times_all,np.int_)
+    times_all = time_table_all_times()
     t0 = times_all[0] # first time index
 
     # Loop through cells
@@ -6113,12 +8434,7 @@ def find_cell_intensities(fov_id, peak_id, Cells, midline=False, channel_name='s
     seg_stack = load_stack(fov_id, peak_id, color='seg_unet')
 
     # determine absolute time index
-    times_all = []
-    for fov in params['time_table']:
-        times_all = np.append(times_all, time_table[fov].keys())
-    times_all = np.unique(times_all)
-    times_all = np.sort(times_all)
-    times_all = np.array(times_all,np.int_)
+    times_all = time_table_all_times()
     t0 = times_all[0] # first time index
 
     # Loop through cells
@@ -6178,12 +8494,7 @@ def foci_analysis(fov_id, peak_id, Cells):
                                color='sub_{}'.format(params['foci']['foci_plane']))
 
     # determine absolute time index
-    times_all = []
-    for fov, times in params['time_table'].items():
-        times_all = np.append(times_all, list(times.keys()))
-    times_all = np.unique(times_all)
-    times_all = np.sort(times_all)
-    times_all = np.array(times_all, np.int_)
+    times_all = time_table_all_times()
     t0 = times_all[0] # first time index
 
     for cell_id, cell in six.iteritems(Cells):
@@ -6255,7 +8566,7 @@ def foci_analysis_pool(fov_id, peak_id, Cells):
                                color='sub_{}'.format(params['foci']['foci_plane']))
 
     # Load time table to determine first image index.
-    times_all = np.array(np.sort(params['time_table'][fov_id].keys()), np.int_)
+    times_all = params['time_table'][fov_id].times
     t0 = times_all[0] # first time index
     tN = times_all[-1] # last time index
 
@@ -7066,7 +9377,7 @@ def ring_analysis(fov_id, peak_id, Cells, ring_plane='c2'):
 
     # Load time table to determine first image index.
     time_table = load_time_table()
-    times_all = np.array(np.sort(time_table[fov_id].keys()), np.int_)
+    times_all = time_table[fov_id].times
     t0 = times_all[0] # first time index
 
     # Loop through cells
@@ -7166,12 +9477,7 @@ def profile_analysis(fov_id, peak_id, Cells, profile_plane='c2'):
 
     # Load time table to determine first image index.
     # load_time_table()
-    times_all = []
-    for fov in params['time_table']:
-        times_all = np.append(times_all, list(params['time_table'][fov].keys()))
-    times_all = np.unique(times_all)
-    times_all = np.sort(times_all)
-    times_all = np.array(times_all,np.int_)
+    times_all = time_table_all_times()
     t0 = times_all[0] # first time index
 
     # Loop through cells
@@ -11,6 +11,10 @@ from skimage import io
 from skimage.external import tifffile as tiff
 import argparse
 import inspect
+import json
+import multiprocessing
+from multiprocessing import Pool
+import six
 
 # user modules
 # realpath() will make your script run, even if you symlink it
@@ -42,6 +46,82 @@ def warning(*objs):
 def information(*objs):
     print(time.strftime("%H:%M:%S", time.localtime()), *objs, file=sys.stdout)
 
+# size and modification time of the source images, to tell if a conversion is out of date
+def source_stats(file_name_list):
+    return [[imgname, os.path.getsize(imgname), os.path.getmtime(imgname)] for imgname in file_name_list]
+
+# reads the manifest of converted images
+def load_manifest(manifest_path):
+    '''Returns a dictionary of output file name : source stats for images which were
+    already converted. Later lines replace earlier ones for the same output.'''
+
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as manifest_file:
+            for line in manifest_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # partly written last line
+                manifest[entry['output']] = entry['sources']
+
+    return manifest
+
+# converts one time point of one stage position
+def convert_image(file_name_list, new_name, y_crop, x_crop):
+    '''Stacks the images of each channel into one multipage TIFF and crops it.
+    Returns the output file name and the source stats for the manifest.'''
+
+    imgs = []
+    for imgname in file_name_list:
+        with tiff.TiffFile(imgname) as tif:
+            imgs.append(tif.asarray())
+
+    img_data = np.stack(imgs, axis=0) # combine channels into a stacked tiff
+
+    # crop image. Set defaults incase there are Nones
+    y_crop = [y_crop[0] or 0, y_crop[1] or img_data.shape[1]]
+    x_crop = [x_crop[0] or 0, x_crop[1] or img_data.shape[2]]
+
+    img_data = img_data[:, y_crop[0]:y_crop[1], x_crop[0]:x_crop[1]]
+
+    # save out image. Written under a temporary name so a stopped run never leaves
+    # a partial image which looks converted
+    information("Saving {}.".format(new_name))
+    tmp_name = new_name + '.tmp.tif'
+    io.imsave(tmp_name, img_data)
+    os.replace(tmp_name, new_name)
+
+    return os.path.basename(new_name), source_stats(file_name_list)
+
+# unpacks the arguments for convert_image, for Pool.imap
+def convert_image_task(args):
+    return convert_image(*args)
+
+# slices newly converted images into the HDF5 files
+def compile_images(new_files, channel_masks, metadata_index):
+    '''Reads the metadata of the converted images and appends them to the per FOV HDF5
+    files with the channel masks, like mm3_Compile.py --follow does.
+
+    The metadata is read here in the main process. The conversion pool has all of its
+    tasks queued already, so anything sent to it would wait for the conversion to end.'''
+
+    new_imgs = {fn : mm3.get_initial_tif_params(fn) for fn in new_files}
+    metadata_index.add(new_imgs)
+
+    fov_images = {}
+    for fn, idata in six.iteritems(new_imgs):
+        if 'fov' in idata:
+            fov_images.setdefault(idata['fov'], []).append([fn, idata['t']])
+
+    for fov_id, images_to_write in sorted(six.iteritems(fov_images)):
+        if fov_id not in channel_masks:
+            mm3.warning('No channel masks for FOV %03d, not compiling it.' % fov_id)
+            continue
+        mm3.hdf5_stack_slice_and_write_blocks(sorted(images_to_write, key=lambda image: image[1]),
+                                              channel_masks, new_imgs,
+                                              block_size=len(images_to_write), append=True)
+
 # runs if script is run from terminal
 if __name__ == '__main__':
     '''Edit TIFFs from Jeremy's format to the one expected by mm3.'''
@@ -51,6 +131,10 @@ if __name__ == '__main__':
                                      description='Identifies and slices out channels into individual TIFF stacks through time.')
     parser.add_argument('-f', '--paramfile',  type=str,
                         required=True, help='Yaml file containing parameters.')
+    parser.add_argument('-j', '--nproc', type=int,
+                        required=False, help='Number of processes to convert images with.')
+    parser.add_argument('--compile', action='store_true',
+                        required=False, help='Also slice converted images into the HDF5 files using existing channel masks.')
     namespace = parser.parse_args()
 
     # Load the project parameters file
@@ -93,8 +177,15 @@ if __name__ == '__main__':
         if x_crop[i] == "None":
             x_crop[i] = None
 
-    new_name_list = []
+    if namespace.nproc:
+        p['num_analyzers'] = namespace.nproc
+
+    # images which were converted by an earlier run are skipped if their sources are unchanged
+    manifest_path = os.path.join(dest_dir, 'metamorph_manifest.txt')
+    manifest = load_manifest(manifest_path)
 
+    tasks = [] # (time point, stage position, source file names, output file name)
+    converted_files = [] # images converted by an earlier run
     for i in range(len(file_name_dict[file_name_filters[0]])):
 
         file_name_list = [file_name_dict[file_name_filter][i] for file_name_filter in file_name_filters]
@@ -116,22 +207,61 @@ if __name__ == '__main__':
                                                                           frame,
                                                                           stagePosition))
 
-        imgs = []
-        for imgname in file_name_list:
-            with tiff.TiffFile(imgname) as tif:
-                imgs.append(tif.asarray())
+        if (os.path.exists(new_name) and
+                manifest.get(os.path.basename(new_name)) == source_stats(file_name_list)):
+            converted_files.append(os.path.basename(new_name))
+            continue
+
+        tasks.append((frame, stagePosition, file_name_list, new_name))
+
+    tasks = sorted(tasks, key=lambda task: task[0])
+    information('Converting {} images, {} already converted.'.format(len(tasks), len(converted_files)))
+
+    if namespace.compile:
+        if p['output'] != 'HDF5':
+            mm3.warning("--compile needs output: 'HDF5'.")
+            sys.exit(1)
+
+        # the converted images are read from here by the compile helpers
+        p['TIFF_dir'] = dest_dir
+        if not os.path.exists(p['hdf5_dir']):
+            os.makedirs(p['hdf5_dir'])
+
+        # masks come from running mm3_Compile.py on the first converted images
+        channel_masks = mm3.load_channel_masks()
+        metadata_index = mm3.TiffMetadataIndex()
+
+        # images converted before, which may not have been compiled yet
+        new_files = converted_files
+        # compile after every time point of all stage positions
+        compile_batch = max(len(set(task[1] for task in tasks)), 1)
+
+    pool = Pool(p['num_analyzers'])
+
+    with open(manifest_path, 'a') as manifest_file:
+        # results come back in time order while later images are still being converted
+        results = pool.imap(convert_image_task, [(file_name_list, new_name, y_crop, x_crop)
+                                                 for frame, stagePosition, file_name_list, new_name in tasks])
+        for output_name, sources in results:
+            manifest_file.write(json.dumps({'output' : output_name, 'sources' : sources}) + '\n')
+            manifest_file.flush()
+
+            if namespace.compile:
+                new_files.append(output_name)
+                if len(new_files) >= compile_batch:
+                    compile_images(new_files, channel_masks, metadata_index)
+                    new_files = []
 
-        img_data = np.stack(imgs, axis=0) # combine channels into a stacked tiff
+    if namespace.compile:
+        if new_files:
+            compile_images(new_files, channel_masks, metadata_index)
 
-        # crop image. Set defaults incase there are Nones
-        if not y_crop[0]: y_crop[0] = 0
-        if not y_crop[1]: y_crop[1] = img_data.shape[1]
-        if not x_crop[0]: x_crop[0] = 0
-        if not x_crop[1]: x_crop[1] = img_data.shape[2]
+        # time table for every compiled image
+        mm3.make_time_table({fn : idata for fn, idata in six.iteritems(metadata_index.to_dict())
+                             if 'fov' in idata})
+        metadata_index.close()
 
-        img_data = img_data[:, y_crop[0]:y_crop[1], x_crop[0]:x_crop[1]]
+    pool.close()
+    pool.join()
 
-        # save out image
-        information("Saving {}.".format(new_name))
-        # print(os.path.join(dest_dir,new_name))
-        io.imsave(os.path.join(dest_dir, new_name), img_data)
+    information('Finished converting images.')